@@ -0,0 +1,72 @@
+'''
+生成可复现的合成语料：中英文混合的文本块，包含型号、错误码等关键词，便于同时测试向量检索与关键词检索
+'''
+import os
+import random
+from typing import List
+
+from langchain.docstore.document import Document
+
+
+_ZH_WORDS = ("知识库 向量 检索 模型 文档 问答 服务 配置 启动 部署 接口 数据库 用户 系统 错误 日志 版本 升级 "
+             "参数 文件 上传 删除 更新 缓存 索引 查询 结果 分数 阈值 切分 加载 解析 并发 请求 响应 流式 输出").split()
+_EN_WORDS = ("api server model embedding faiss milvus vector search query token stream chunk index cache "
+             "latency config deploy upload delete update error timeout retry worker thread process").split()
+_PUNCTS = ["，", "。", "；", "！", "？", ", ", ". "]
+
+
+def make_text(rng: random.Random, n_words: int) -> str:
+    words = []
+    for i in range(n_words):
+        r = rng.random()
+        if r < 0.6:
+            words.append(rng.choice(_ZH_WORDS))
+        elif r < 0.9:
+            words.append(rng.choice(_EN_WORDS))
+        else:
+            words.append(f"E-{rng.randint(1000, 9999)}")
+        if i % 8 == 7:
+            words.append(rng.choice(_PUNCTS))
+    return " ".join(words)
+
+
+def make_chunks(n_chunks: int, seed: int = 0, words_per_chunk: int = 40) -> List[str]:
+    rng = random.Random(seed)
+    return [make_text(rng, words_per_chunk) for _ in range(n_chunks)]
+
+
+def make_docs(n_chunks: int, n_files: int = 100, seed: int = 0) -> List[Document]:
+    '''
+    生成 n_chunks 个 Document，平均分属于 n_files 个文件（metadata["source"]）
+    '''
+    return [Document(page_content=text, metadata={"source": f"bench_{i % n_files}.txt"})
+            for i, text in enumerate(make_chunks(n_chunks, seed=seed))]
+
+
+def make_queries(n: int, seed: int = 1) -> List[str]:
+    return make_chunks(n, seed=seed, words_per_chunk=8)
+
+
+def make_long_text(n_chars: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    paragraphs = []
+    size = 0
+    while size < n_chars:
+        paragraph = make_text(rng, rng.randint(20, 200))
+        paragraphs.append(paragraph)
+        size += len(paragraph) + 2
+    return "\n\n".join(paragraphs)[:n_chars]
+
+
+def write_corpus_files(dir: str, n_files: int, chars_per_file: int, seed: int = 0) -> List[str]:
+    '''
+    在 dir 中写入 n_files 个 txt 文件，返回文件名列表
+    '''
+    os.makedirs(dir, exist_ok=True)
+    files = []
+    for i in range(n_files):
+        filename = f"bench_{i}.txt"
+        with open(os.path.join(dir, filename), "w", encoding="utf-8") as fp:
+            fp.write(make_long_text(chars_per_file, seed=seed + i))
+        files.append(filename)
+    return files
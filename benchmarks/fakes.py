@@ -0,0 +1,157 @@
+'''
+离线基准测试使用的替身模型：
+    FakeEmbeddings: 以文本哈希为随机种子生成固定维度的单位向量，相同文本总是得到相同的向量
+    FakeLLMServer: 兼容 OpenAI /v1/chat/completions 接口的流式假 LLM 服务，按固定间隔逐个返回 token
+install_fake_embeddings() 与 FakeLLMServer.install() 将项目中的向量化与 LLM 调用替换为上述替身，不需要下载模型或启动 fastchat。
+'''
+import hashlib
+import json
+import socket
+import threading
+import time
+from typing import List
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+
+class FakeEmbeddings(Embeddings):
+    def __init__(self, dim: int = 768):
+        self.dim = dim
+
+    def _embed(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+def install_fake_embeddings(dim: int = 768, embedding_cache: bool = False) -> FakeEmbeddings:
+    '''
+    替换 server.embeddings_api 中实际调用模型的函数，以及向量库加载时使用的 Embeddings 对象。
+    embedding_cache=False 时同时关闭磁盘向量缓存，使每次测量都经过向量化
+    '''
+    import server.embeddings_api as embeddings_api
+    from server.knowledge_base.kb_cache.base import CachePool
+    from server.utils import BaseResponse
+
+    fake = FakeEmbeddings(dim)
+
+    def _embed_texts(texts: List[str], embed_model: str = None, to_query: bool = False) -> BaseResponse:
+        return BaseResponse(data=fake.embed_documents(texts))
+
+    async def _aembed_texts(texts: List[str], embed_model: str = None, to_query: bool = False) -> BaseResponse:
+        return _embed_texts(texts, embed_model, to_query)
+
+    embeddings_api._embed_texts = _embed_texts
+    embeddings_api._aembed_texts = _aembed_texts
+    embeddings_api.EMBEDDING_CACHE_ENABLED = embedding_cache
+    CachePool.load_kb_embeddings = lambda self, *args, **kwargs: fake
+    return fake
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve_in_thread(app, port: int):
+    '''
+    在后台线程中以 uvicorn 运行 ASGI 应用，返回 (server, thread)，设置 server.should_exit = True 即可停止
+    '''
+    import uvicorn
+
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True, name=f"bench-server-{port}")
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+class FakeLLMServer:
+    '''
+    在后台线程中运行的假 LLM 服务。每个请求返回 n_tokens 个 token，token 之间间隔 token_interval 秒，
+    用于测量服务端自身（检索、拼装 prompt、SSE 转发）的开销与并发能力
+    '''
+    def __init__(self, n_tokens: int = 64, token_interval: float = 0.005, port: int = None):
+        self.n_tokens = n_tokens
+        self.token_interval = token_interval
+        self.port = port or free_port()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def create_app(self):
+        import asyncio
+        from fastapi import FastAPI, Request
+        from sse_starlette import EventSourceResponse
+
+        app = FastAPI()
+
+        @app.post("/v1/chat/completions")
+        async def chat_completions(request: Request):
+            body = await request.json()
+            model = body.get("model", "fake-llm")
+
+            def chunk(content: str = None, finish_reason: str = None) -> str:
+                delta = {"role": "assistant", "content": content} if content is not None else {}
+                return json.dumps({
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                })
+
+            async def stream():
+                for i in range(self.n_tokens):
+                    if self.token_interval > 0:
+                        await asyncio.sleep(self.token_interval)
+                    yield chunk(f"词{i} ")
+                yield chunk(finish_reason="stop")
+                yield "[DONE]"
+
+            if body.get("stream"):
+                return EventSourceResponse(stream())
+            content = "".join(f"词{i} " for i in range(self.n_tokens))
+            return {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": self.n_tokens, "total_tokens": self.n_tokens},
+            }
+
+        return app
+
+    def start(self) -> "FakeLLMServer":
+        self._server, self._thread = serve_in_thread(self.create_app(), self.port)
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.should_exit = True
+            self._thread.join()
+
+    def install(self):
+        '''
+        使 get_ChatOpenAI 等函数使用本服务作为所有模型的 API 地址
+        '''
+        import server.utils
+
+        base_url = self.base_url
+        server.utils.get_model_worker_config = lambda model_name=None: {"api_base_url": base_url,
+                                                                         "api_key": "EMPTY"}
@@ -0,0 +1,313 @@
+'''
+知识库检索与入库的离线基准测试，使用 benchmarks/fakes.py 中的替身模型，不需要下载模型或启动 LLM 服务。
+
+用法：
+    python benchmarks/run.py --sizes 1000,10000 --output bench.json
+    python benchmarks/run.py --only faiss_search,splitter --sizes 100000
+
+结果以 JSON 输出（默认输出到标准输出），每一项形如：
+    {"name": "faiss_search", "params": {...}, "count": 操作次数, "seconds": 总耗时,
+     "throughput": 每秒操作数, "latency": {"mean", "p50", "p95", "p99", "max"}}
+测试会创建并在结束后删除名为 benchmark_* 的知识库。
+'''
+import sys
+from pathlib import Path
+
+root_path = Path(__file__).parent.parent
+sys.path.append(str(root_path))
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from benchmarks.corpus import make_docs, make_queries, make_long_text, write_corpus_files
+from benchmarks.fakes import install_fake_embeddings, FakeLLMServer, free_port, serve_in_thread
+
+
+def summarize(name: str, params: Dict, latencies: List[float], count: int = None, seconds: float = None) -> Dict:
+    '''
+    latencies: 每次操作的耗时（秒）；count 为处理的条目数（如文本块数），默认与操作次数相同
+    '''
+    latencies = np.asarray(latencies, dtype=np.float64)
+    seconds = float(latencies.sum()) if seconds is None else seconds
+    count = len(latencies) if count is None else count
+    return {
+        "name": name,
+        "params": params,
+        "count": count,
+        "seconds": round(seconds, 6),
+        "throughput": round(count / seconds, 3) if seconds > 0 else None,
+        "latency": {
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+            "p99": float(np.percentile(latencies, 99)),
+            "max": float(latencies.max()),
+        } if len(latencies) else None,
+    }
+
+
+def timeit(func: Callable, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def new_kb(name: str, embed_model: str):
+    from server.knowledge_base.kb_service.base import KBServiceFactory
+
+    kb = KBServiceFactory.get_service(name, "faiss", embed_model)
+    if kb.exists():
+        kb.drop_kb()
+    kb.create_kb()
+    return kb
+
+
+def bench_faiss(size: int, args) -> List[Dict]:
+    '''
+    FaissKBService 的 do_add_doc、do_search、save_vector_store、加载与 do_delete_doc
+    '''
+    from server.knowledge_base.kb_cache.faiss_cache import kb_faiss_pool
+    from server.knowledge_base.utils import KnowledgeFile
+
+    results = []
+    params = {"size": size, "dim": args.dim}
+    kb = new_kb(f"benchmark_faiss_{size}", args.embed_model)
+    try:
+        docs = make_docs(size, n_files=args.files)
+        if "faiss_add_doc" in args.only:
+            latencies = []
+            for i in range(0, size, args.batch_size):
+                latencies.append(timeit(kb.do_add_doc, docs[i:i + args.batch_size], not_refresh_vs_cache=True))
+            results.append(summarize("faiss_add_doc", {**params, "batch_size": args.batch_size},
+                                     latencies, count=size))
+        else:
+            for i in range(0, size, args.batch_size):
+                kb.do_add_doc(docs[i:i + args.batch_size], not_refresh_vs_cache=True)
+
+        if "faiss_search" in args.only:
+            queries = make_queries(args.queries)
+            kb.do_search(queries[0], args.top_k)  # 预热
+            latencies = [timeit(kb.do_search, q, args.top_k) for q in queries]
+            results.append(summarize("faiss_search", {**params, "top_k": args.top_k}, latencies))
+
+        if "faiss_save_load" in args.only:
+            latencies = [timeit(kb.save_vector_store)]
+            results.append(summarize("faiss_save", params, latencies))
+            with kb_faiss_pool.atomic:
+                kb_faiss_pool.pop((kb.kb_name, kb.vector_name))
+            latencies = [timeit(kb.load_vector_store)]
+            results.append(summarize("faiss_load", params, latencies))
+
+        if "faiss_delete_doc" in args.only:
+            n = min(args.files, args.delete_files)
+            files = [KnowledgeFile(f"bench_{i}.txt", kb.kb_name) for i in range(n)]
+            latencies = [timeit(kb.do_delete_doc, f, not_refresh_vs_cache=True) for f in files]
+            results.append(summarize("faiss_delete_doc", {**params, "chunks_per_file": size // args.files},
+                                     latencies))
+    finally:
+        kb.drop_kb()
+    return results
+
+
+def bench_files2docs(args) -> List[Dict]:
+    from server.knowledge_base.utils import files2docs_in_thread, get_doc_path
+
+    kb = new_kb("benchmark_files2docs", args.embed_model)
+    try:
+        files = write_corpus_files(get_doc_path(kb.kb_name), args.files, args.file_chars)
+        start = time.perf_counter()
+        chunks = 0
+        for status, result in files2docs_in_thread([(f, kb.kb_name) for f in files]):
+            if status:
+                chunks += len(result[2])
+        seconds = time.perf_counter() - start
+    finally:
+        kb.drop_kb()
+    result = summarize("files2docs_in_thread", {"files": args.files, "chars_per_file": args.file_chars},
+                       [], count=args.files, seconds=seconds)
+    result["chunks"] = chunks
+    return [result]
+
+
+def bench_splitter(args) -> List[Dict]:
+    from configs import CHUNK_SIZE, OVERLAP_SIZE
+    from text_splitter import ChineseRecursiveTextSplitter
+    from text_splitter.chinese_recursive_text_splitter import SAMPLE_TEXT
+
+    # 合成语料与重复的《中国对外贸易形势报告》样例，split_text 为按偏移量切分的实现，_split_text 为逐级切分子串的原实现
+    splitter = ChineseRecursiveTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=OVERLAP_SIZE)
+    texts = {"synthetic": make_long_text(args.splitter_chars),
+             "sample_75_pages": (SAMPLE_TEXT * (args.splitter_chars // len(SAMPLE_TEXT) + 1))[:args.splitter_chars]}
+    results = []
+    for corpus, text in texts.items():
+        for name, func in [("chinese_recursive_text_splitter", splitter.split_text),
+                           ("chinese_recursive_text_splitter_legacy",
+                            lambda x: splitter._split_text(x, splitter._separators))]:
+            latencies = [timeit(func, text) for _ in range(args.repeat)]
+            result = summarize(name, {"corpus": corpus, "chars": len(text),
+                                      "chunk_size": CHUNK_SIZE, "chunk_overlap": OVERLAP_SIZE}, latencies)
+            result["chars_per_second"] = round(len(text) * len(latencies) / sum(latencies), 3)
+            results.append(result)
+    return results
+
+
+async def _chat_requests(base_url: str, kb_name: str, queries: List[str], concurrency: int) -> Dict:
+    import httpx
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, first_tokens, errors = [], [], 0
+
+    async def request(client: httpx.AsyncClient, query: str):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            first = None
+            try:
+                data = {"query": query, "knowledge_base_name": kb_name, "stream": True, "history": []}
+                async with client.stream("POST", "/chat/knowledge_base_chat", json=data) as r:
+                    async for line in r.aiter_lines():
+                        if first is None and line.startswith("data:"):
+                            first = time.perf_counter() - start
+                latencies.append(time.perf_counter() - start)
+                first_tokens.append(first or latencies[-1])
+            except Exception:
+                errors += 1
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=None) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[request(client, q) for q in queries])
+        seconds = time.perf_counter() - start
+    return {"latencies": latencies, "first_tokens": first_tokens, "errors": errors, "seconds": seconds}
+
+
+def bench_kb_chat(args) -> List[Dict]:
+    '''
+    端到端 /chat/knowledge_base_chat：API 服务与假 LLM 服务均在本进程的后台线程中运行
+    '''
+    import server.chat.knowledge_base_chat as kb_chat
+    from server.api import create_app
+    from server.knowledge_base.kb_cache.search_cache import search_result_cache, query_embedding_cache
+
+    if not args.with_caches:
+        kb_chat.ANSWER_CACHE_ENABLED = False
+        search_result_cache.max_size = 0
+        query_embedding_cache.max_size = 0
+    kb_chat.USE_RERANKER = False
+
+    llm = FakeLLMServer(n_tokens=args.llm_tokens, token_interval=args.llm_token_interval).start()
+    llm.install()
+    kb = new_kb("benchmark_chat", args.embed_model)
+    port = free_port()
+    api_server, api_thread = serve_in_thread(create_app(), port)
+    results = []
+    try:
+        docs = make_docs(args.chat_kb_size, n_files=args.files)
+        for i in range(0, len(docs), args.batch_size):
+            kb.do_add_doc(docs[i:i + args.batch_size], not_refresh_vs_cache=True)
+        queries = make_queries(args.chat_requests)
+        for concurrency in args.concurrency:
+            r = asyncio.run(_chat_requests(f"http://127.0.0.1:{port}", kb.kb_name, queries, concurrency))
+            params = {"concurrency": concurrency, "kb_size": args.chat_kb_size,
+                      "llm_tokens": args.llm_tokens, "llm_token_interval": args.llm_token_interval,
+                      "with_caches": args.with_caches}
+            result = summarize("kb_chat", params, r["latencies"], seconds=r["seconds"])
+            result["first_token"] = summarize("kb_chat_first_token", params, r["first_tokens"])["latency"]
+            result["errors"] = r["errors"]
+            results.append(result)
+    finally:
+        api_server.should_exit = True
+        api_thread.join()
+        llm.stop()
+        kb.drop_kb()
+    return results
+
+
+def environment() -> Dict:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=root_path,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        commit = None
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+BENCHMARKS = ["faiss_add_doc", "faiss_search", "faiss_save_load", "faiss_delete_doc",
+              "files2docs", "splitter", "kb_chat"]
+
+
+def parse_args(argv: List[str] = None):
+    def int_list(s: str) -> List[int]:
+        return [int(x) for x in s.split(",") if x]
+
+    parser = argparse.ArgumentParser(description="知识库检索与入库的离线基准测试")
+    parser.add_argument("--only", type=lambda s: s.split(","), default=BENCHMARKS,
+                        help=f"要运行的测试，逗号分隔，可选：{','.join(BENCHMARKS)}")
+    parser.add_argument("--sizes", type=int_list, default=[1000, 10000],
+                        help="FAISS 测试的文本块数量，逗号分隔，如 1000,100000,1000000")
+    parser.add_argument("--dim", type=int, default=768, help="假向量的维度")
+    parser.add_argument("--embed-model", default="bge-large-zh-v1.5", help="知识库使用的 Embeddings 模型名称（仅作为标识）")
+    parser.add_argument("--batch-size", type=int, default=1000, help="do_add_doc 每次添加的文本块数")
+    parser.add_argument("--files", type=int, default=100, help="文本块所属的文件数 / files2docs 测试的文件数")
+    parser.add_argument("--delete-files", type=int, default=20, help="do_delete_doc 测试删除的文件数")
+    parser.add_argument("--queries", type=int, default=200, help="do_search 测试的查询数")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--file-chars", type=int, default=20000, help="files2docs 测试中每个文件的字符数")
+    parser.add_argument("--splitter-chars", type=int, default=1000000, help="切分测试的文本长度")
+    parser.add_argument("--repeat", type=int, default=3, help="切分测试的重复次数")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 8, 32], help="端到端测试的并发数，逗号分隔")
+    parser.add_argument("--chat-requests", type=int, default=64, help="端到端测试每个并发数下的请求数")
+    parser.add_argument("--chat-kb-size", type=int, default=10000, help="端到端测试知识库的文本块数")
+    parser.add_argument("--llm-tokens", type=int, default=64, help="假 LLM 每个回答的 token 数")
+    parser.add_argument("--llm-token-interval", type=float, default=0.005, help="假 LLM 的 token 间隔（秒）")
+    parser.add_argument("--with-caches", action="store_true", help="端到端测试时保留答案缓存与检索缓存")
+    parser.add_argument("--output", default="", help="结果 JSON 文件路径，默认输出到标准输出")
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None):
+    args = parse_args(argv)
+    unknown = set(args.only) - set(BENCHMARKS)
+    if unknown:
+        raise SystemExit(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    from server.knowledge_base.migrate import create_tables
+
+    install_fake_embeddings(dim=args.dim)
+    create_tables()
+
+    results = []
+    if set(args.only) & {"faiss_add_doc", "faiss_search", "faiss_save_load", "faiss_delete_doc"}:
+        for size in args.sizes:
+            results += bench_faiss(size, args)
+    if "files2docs" in args.only:
+        results += bench_files2docs(args)
+    if "splitter" in args.only:
+        results += bench_splitter(args)
+    if "kb_chat" in args.only:
+        results += bench_kb_chat(args)
+
+    report = json.dumps({"environment": environment(), "results": results}, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            fp.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
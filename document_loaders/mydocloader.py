@@ -1,68 +1,70 @@
-from langchain.document_loaders.unstructured import UnstructuredFileLoader
-from typing import List
+from typing import Dict, Iterator, List, Tuple
+from document_loaders.ocr import ImageType, image_key
+from document_loaders.paged_loader import PagedOCRLoader, Segment
 import tqdm
 
 
-class RapidOCRDocLoader(UnstructuredFileLoader):
-    def _get_elements(self) -> List:
-        def doc2text(filepath):
-            from docx.table import _Cell, Table
-            from docx.oxml.table import CT_Tbl
-            from docx.oxml.text.paragraph import CT_P
-            from docx.text.paragraph import Paragraph
-            from docx import Document, ImagePart
-            from PIL import Image
-            from io import BytesIO
-            import numpy as np
-            from rapidocr_onnxruntime import RapidOCR
-            ocr = RapidOCR()
-            doc = Document(filepath)
-            resp = ""
+class RapidOCRDocLoader(PagedOCRLoader):
+    def _iter_pages(self) -> Iterator[Tuple[int, List[Segment], Dict[str, ImageType]]]:
+        '''
+        docx 文件本身不记录分页，按 Word 保存时写入的分页位置（w:lastRenderedPageBreak）及手动分页符划分页面
+        '''
+        from docx.table import _Cell, Table
+        from docx.oxml.table import CT_Tbl
+        from docx.oxml.text.paragraph import CT_P
+        from docx.text.paragraph import Paragraph
+        from docx import Document, ImagePart
+        doc = Document(self.file_path)
+        page = 1
+        segments = []
+        image_blobs = {}  # {图片键: 图片数据}
+        seen = set()
 
-            def iter_block_items(parent):
-                from docx.document import Document
-                if isinstance(parent, Document):
-                    parent_elm = parent.element.body
-                elif isinstance(parent, _Cell):
-                    parent_elm = parent._tc
-                else:
-                    raise ValueError("RapidOCRDocLoader parse fail")
+        def iter_block_items(parent):
+            from docx.document import Document
+            if isinstance(parent, Document):
+                parent_elm = parent.element.body
+            elif isinstance(parent, _Cell):
+                parent_elm = parent._tc
+            else:
+                raise ValueError("RapidOCRDocLoader parse fail")
 
-                for child in parent_elm.iterchildren():
-                    if isinstance(child, CT_P):
-                        yield Paragraph(child, parent)
-                    elif isinstance(child, CT_Tbl):
-                        yield Table(child, parent)
+            for child in parent_elm.iterchildren():
+                if isinstance(child, CT_P):
+                    yield Paragraph(child, parent)
+                elif isinstance(child, CT_Tbl):
+                    yield Table(child, parent)
 
-            b_unit = tqdm.tqdm(total=len(doc.paragraphs)+len(doc.tables),
-                               desc="RapidOCRDocLoader block index: 0")
-            for i, block in enumerate(iter_block_items(doc)):
-                b_unit.set_description(
-                    "RapidOCRDocLoader  block index: {}".format(i))
-                b_unit.refresh()
-                if isinstance(block, Paragraph):
-                    resp += block.text.strip() + "\n"
-                    images = block._element.xpath('.//pic:pic')  # 获取所有图片
-                    for image in images:
-                        for img_id in image.xpath('.//a:blip/@r:embed'):  # 获取图片id
-                            part = doc.part.related_parts[img_id]  # 根据图片id获取对应的图片
-                            if isinstance(part, ImagePart):
-                                image = Image.open(BytesIO(part._blob))
-                                result, _ = ocr(np.array(image))
-                                if result:
-                                    ocr_result = [line[1] for line in result]
-                                    resp += "\n".join(ocr_result)
-                elif isinstance(block, Table):
-                    for row in block.rows:
-                        for cell in row.cells:
-                            for paragraph in cell.paragraphs:
-                                resp += paragraph.text.strip() + "\n"
-                b_unit.update(1)
-            return resp
-
-        text = doc2text(self.file_path)
-        from unstructured.partition.text import partition_text
-        return partition_text(text=text, **self.unstructured_kwargs)
+        b_unit = tqdm.tqdm(total=len(doc.paragraphs)+len(doc.tables),
+                           desc="RapidOCRDocLoader block index: 0")
+        for i, block in enumerate(iter_block_items(doc)):
+            b_unit.set_description(
+                "RapidOCRDocLoader  block index: {}".format(i))
+            b_unit.refresh()
+            if isinstance(block, Paragraph):
+                if segments and block._element.xpath('.//w:lastRenderedPageBreak|.//w:br[@w:type="page"]'):
+                    yield page, segments, image_blobs
+                    page += 1
+                    segments, image_blobs = [], {}
+                segments.append(block.text.strip() + "\n")
+                images = block._element.xpath('.//pic:pic')  # 获取所有图片
+                for image in images:
+                    for img_id in image.xpath('.//a:blip/@r:embed'):  # 获取图片id
+                        part = doc.part.related_parts[img_id]  # 根据图片id获取对应的图片
+                        if isinstance(part, ImagePart):
+                            key = image_key(part._blob)
+                            if key not in seen:
+                                seen.add(key)
+                                image_blobs[key] = part._blob
+                            segments.append((key,))
+            elif isinstance(block, Table):
+                for row in block.rows:
+                    for cell in row.cells:
+                        for paragraph in cell.paragraphs:
+                            segments.append(paragraph.text.strip() + "\n")
+            b_unit.update(1)
+        if segments:
+            yield page, segments, image_blobs
 
 
 if __name__ == '__main__':
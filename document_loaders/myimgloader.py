@@ -1,18 +1,12 @@
 from typing import List
 from langchain.document_loaders.unstructured import UnstructuredFileLoader
-from document_loaders.ocr import get_ocr
+from document_loaders.ocr import ocr_images
 
 
 class RapidOCRLoader(UnstructuredFileLoader):
     def _get_elements(self) -> List:
         def img2text(filepath):
-            resp = ""
-            ocr = get_ocr()
-            result, _ = ocr(filepath)
-            if result:
-                ocr_result = [line[1] for line in result]
-                resp += "\n".join(ocr_result)
-            return resp
+            return ocr_images([filepath])[0]
 
         text = img2text(self.file_path)
         from unstructured.partition.text import partition_text
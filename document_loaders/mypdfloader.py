@@ -1,15 +1,15 @@
-from typing import List
-from langchain.document_loaders.unstructured import UnstructuredFileLoader
+from typing import Dict, Iterator, List, Tuple
 import cv2
 from PIL import Image
 import numpy as np
 from configs import PDF_OCR_THRESHOLD
-from document_loaders.ocr import get_ocr
+from document_loaders.ocr import ImageType, image_key
+from document_loaders.paged_loader import PagedOCRLoader, Segment
 import tqdm
 
 
-class RapidOCRPDFLoader(UnstructuredFileLoader):
-    def _get_elements(self) -> List:
+class RapidOCRPDFLoader(PagedOCRLoader):
+    def _iter_pages(self) -> Iterator[Tuple[int, List[Segment], Dict[str, ImageType]]]:
         def rotate_img(img, angle):
             '''
             img   --image
@@ -33,20 +33,17 @@ class RapidOCRPDFLoader(UnstructuredFileLoader):
 
             rotated_img = cv2.warpAffine(img, M, (new_w, new_h))
             return rotated_img
-        
-        def pdf2text(filepath):
-            import fitz # pyMuPDF里面的fitz包，不要与pip install fitz混淆
-            import numpy as np
-            ocr = get_ocr()
-            doc = fitz.open(filepath)
-            resp = ""
 
+        import fitz # pyMuPDF里面的fitz包，不要与pip install fitz混淆
+        # fitz 不是线程安全的，页面文本与图片在当前线程中依次提取，图片由 PagedOCRLoader 分批并行识别
+        xref_keys = {}  # {(xref, 旋转角度): 图片键}，同一图片在多个页面中出现时只提取一次
+        with fitz.open(self.file_path) as doc:
             b_unit = tqdm.tqdm(total=doc.page_count, desc="RapidOCRPDFLoader context page index: 0")
             for i, page in enumerate(doc):
                 b_unit.set_description("RapidOCRPDFLoader context page index: {}".format(i))
                 b_unit.refresh()
-                text = page.get_text("")
-                resp += text + "\n"
+                segments = [page.get_text("") + "\n"]
+                images = {}
 
                 img_list = page.get_image_info(xrefs=True)
                 for img in img_list:
@@ -56,29 +53,23 @@ class RapidOCRPDFLoader(UnstructuredFileLoader):
                         if ((bbox[2] - bbox[0]) / (page.rect.width) < PDF_OCR_THRESHOLD[0]
                             or (bbox[3] - bbox[1]) / (page.rect.height) < PDF_OCR_THRESHOLD[1]):
                             continue
-                        pix = fitz.Pixmap(doc, xref)
-                        samples = pix.samples
-                        if int(page.rotation)!=0:  #如果Page有旋转角度，则旋转图片
-                            img_array = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, -1)
-                            tmp_img = Image.fromarray(img_array);
-                            ori_img = cv2.cvtColor(np.array(tmp_img),cv2.COLOR_RGB2BGR)
-                            rot_img = rotate_img(img=ori_img, angle=360-page.rotation)
-                            img_array = cv2.cvtColor(rot_img, cv2.COLOR_RGB2BGR)
-                        else:
-                            img_array = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, -1)
-
-                        result, _ = ocr(img_array)
-                        if result:
-                            ocr_result = [line[1] for line in result]
-                            resp += "\n".join(ocr_result)
+                        if (key := xref_keys.get((xref, page.rotation))) is None:
+                            pix = fitz.Pixmap(doc, xref)
+                            if int(page.rotation)!=0:  #如果Page有旋转角度，则旋转图片
+                                img_array = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, -1)
+                                tmp_img = Image.fromarray(img_array);
+                                ori_img = cv2.cvtColor(np.array(tmp_img),cv2.COLOR_RGB2BGR)
+                                rot_img = rotate_img(img=ori_img, angle=360-page.rotation)
+                                img_array = cv2.cvtColor(rot_img, cv2.COLOR_RGB2BGR)
+                            else:
+                                img_array = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, -1)
+                            key = xref_keys[(xref, page.rotation)] = image_key(img_array)
+                            images[key] = img_array
+                        segments.append((key,))
 
+                yield i + 1, segments, images
                 # 更新进度
                 b_unit.update(1)
-            return resp
-
-        text = pdf2text(self.file_path)
-        from unstructured.partition.text import partition_text
-        return partition_text(text=text, **self.unstructured_kwargs)
 
 
 if __name__ == "__main__":
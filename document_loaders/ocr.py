@@ -1,4 +1,14 @@
-from typing import TYPE_CHECKING
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from configs import OCR_WORKERS, OCR_CACHE_SIZE, OCR_BATCH_MAX_SIDE, OCR_BATCH_MAX_HEIGHT
 
 
 if TYPE_CHECKING:
@@ -8,7 +18,19 @@ if TYPE_CHECKING:
         from rapidocr_onnxruntime import RapidOCR
 
 
-def get_ocr(use_cuda: bool = True) -> "RapidOCR":
+# 图片：np.ndarray，编码后的图片数据（bytes，按 PIL 解码），或图片文件路径（交由 OCR 引擎读取）
+ImageType = Union[np.ndarray, bytes, str]
+
+_process_ocr = None  # 文档解析子进程中常驻的 OCR 引擎，由 init_process_ocr 初始化
+_thread_ocr = threading.local()  # 各 OCR 线程常驻的引擎
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+_BATCH_GAP = 32  # 拼接小图片时的间隔（像素）
+
+
+def new_ocr(use_cuda: bool = True) -> "RapidOCR":
     try:
         from rapidocr_paddle import RapidOCR
         ocr = RapidOCR(det_use_cuda=use_cuda, cls_use_cuda=use_cuda, rec_use_cuda=use_cuda)
@@ -16,3 +38,201 @@ def get_ocr(use_cuda: bool = True) -> "RapidOCR":
         from rapidocr_onnxruntime import RapidOCR
         ocr = RapidOCR()
     return ocr
+
+
+def init_process_ocr(use_cuda: bool = True):
+    '''
+    在文档解析子进程启动时加载 OCR 模型，此后该进程中的 get_ocr 都返回这个实例
+    '''
+    global _process_ocr
+    _process_ocr = new_ocr(use_cuda=use_cuda)
+
+
+def get_ocr(use_cuda: bool = True) -> "RapidOCR":
+    '''
+    解析子进程中返回进程常驻的引擎，否则每个线程创建并复用一个引擎
+    '''
+    if _process_ocr is not None:
+        return _process_ocr
+    if (ocr := getattr(_thread_ocr, "ocr", None)) is None:
+        ocr = _thread_ocr.ocr = new_ocr(use_cuda=use_cuda)
+    return ocr
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor, _executor_pid
+    with _executor_lock:
+        # fork 得到的子进程中不能使用父进程的线程池
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(OCR_WORKERS, thread_name_prefix="ocr")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+class _OCRCache:
+    '''
+    按图片内容缓存 OCR 结果的 LRU 缓存
+    '''
+    def __init__(self, max_size: int = OCR_CACHE_SIZE):
+        self.max_size = max_size
+        self._cache: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if (text := self._cache.get(key)) is not None:
+                self._cache.move_to_end(key)
+            return text
+
+    def set(self, key: str, text: str):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._cache[key] = text
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+
+ocr_cache = _OCRCache()
+
+
+def image_key(image: ImageType) -> str:
+    '''
+    图片的缓存键：图片数据的哈希值
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(image, np.ndarray):
+        h.update(str(image.shape).encode())
+        h.update(np.ascontiguousarray(image).data)
+    elif isinstance(image, str):
+        with open(image, "rb") as fp:
+            while chunk := fp.read(1024 * 1024):
+                h.update(chunk)
+    else:
+        h.update(image)
+    return h.hexdigest()
+
+
+def _image_size(image: ImageType) -> Optional[Tuple[int, int]]:
+    '''
+    返回图片的 (宽, 高)，编码后的图片只读取文件头
+    '''
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    if isinstance(image, bytes):
+        from PIL import Image
+        try:
+            return Image.open(BytesIO(image)).size
+        except Exception:
+            return None
+    return None
+
+
+def _load_image(image: ImageType) -> Union[np.ndarray, str]:
+    if isinstance(image, bytes):
+        from PIL import Image
+        return np.array(Image.open(BytesIO(image)))
+    return image
+
+
+def _to_rgb(img: np.ndarray) -> np.ndarray:
+    if img.ndim == 2:
+        img = img[:, :, None]
+    if img.shape[2] < 3:
+        img = np.repeat(img[:, :, :1], 3, axis=2)
+    return np.ascontiguousarray(img[:, :, :3], dtype=np.uint8)
+
+
+def _ocr_text(result) -> str:
+    if result:
+        return "\n".join(line[1] for line in result)
+    return ""
+
+
+def _ocr_single(image: ImageType) -> str:
+    result, _ = get_ocr()(_load_image(image))
+    return _ocr_text(result)
+
+
+def _ocr_batch(images: List[ImageType]) -> List[str]:
+    '''
+    将多张小图片纵向拼接为一张后识别一次，按文本框中心的纵坐标把识别结果分配回各图片
+    '''
+    arrays = [_to_rgb(_load_image(x)) for x in images]
+    width = max(x.shape[1] for x in arrays)
+    height = sum(x.shape[0] for x in arrays) + _BATCH_GAP * (len(arrays) - 1)
+    canvas = np.full((height, width, 3), 255, dtype=np.uint8)
+    offsets = []
+    y = 0
+    for img in arrays:
+        canvas[y:y + img.shape[0], :img.shape[1]] = img
+        offsets.append((y, y + img.shape[0]))
+        y += img.shape[0] + _BATCH_GAP
+
+    lines = [[] for _ in arrays]
+    result, _ = get_ocr()(canvas)
+    for box, text, *_ in result or []:
+        center = sum(p[1] for p in box) / len(box)
+        # 中心落在间隔中的文本框分配给最近的图片
+        i = min(range(len(offsets)),
+                key=lambda i: 0 if offsets[i][0] <= center < offsets[i][1]
+                else min(abs(center - offsets[i][0]), abs(center - offsets[i][1])))
+        lines[i].append(text)
+    return ["\n".join(x) for x in lines]
+
+
+def _make_tasks(images: Dict[str, ImageType]) -> List[List[str]]:
+    '''
+    将待识别的图片分组：小图片按拼接后的高度分批，其余图片单独识别
+    '''
+    tasks = []
+    batch, batch_height = [], 0
+    for key, image in images.items():
+        size = _image_size(image) if OCR_BATCH_MAX_SIDE > 0 else None
+        if size is None or max(size) > OCR_BATCH_MAX_SIDE:
+            tasks.append([key])
+            continue
+        if batch and batch_height + _BATCH_GAP + size[1] > OCR_BATCH_MAX_HEIGHT:
+            tasks.append(batch)
+            batch, batch_height = [], 0
+        batch_height += size[1] + (_BATCH_GAP if batch else 0)
+        batch.append(key)
+    if batch:
+        tasks.append(batch)
+    return tasks
+
+
+def ocr_images(images: Sequence[ImageType], keys: Sequence[str] = None) -> List[str]:
+    '''
+    识别多张图片，返回各图片的文本（各行以换行符连接，没有文本时为空字符串）。
+    keys 为各图片的缓存键，不指定时使用图片内容的哈希值。相同的图片只识别一次，已识别过的图片直接使用缓存结果；
+    小图片拼接后一次识别；各组图片由 OCR 线程池并行识别，解析子进程中则在当前线程中顺序识别
+    '''
+    if keys is None:
+        keys = [image_key(x) for x in images]
+    texts: Dict[str, str] = {}
+    pending: Dict[str, ImageType] = {}
+    for key, image in zip(keys, images):
+        if key in texts or key in pending:
+            continue
+        if (text := ocr_cache.get(key)) is not None:
+            texts[key] = text
+        else:
+            pending[key] = image
+
+    def run(task: List[str]) -> List[str]:
+        if len(task) == 1:
+            return [_ocr_single(pending[task[0]])]
+        return _ocr_batch([pending[key] for key in task])
+
+    tasks = _make_tasks(pending)
+    if _process_ocr is not None or OCR_WORKERS <= 1 or len(tasks) <= 1:
+        results = map(run, tasks)
+    else:
+        results = _get_executor().map(run, tasks)
+    for task, task_texts in zip(tasks, results):
+        for key, text in zip(task, task_texts):
+            texts[key] = text
+            ocr_cache.set(key, text)
+    return [texts[key] for key in keys]
@@ -0,0 +1,74 @@
+from typing import Dict, Iterator, List, Tuple, Union
+
+from langchain.docstore.document import Document
+from langchain.document_loaders.unstructured import UnstructuredFileLoader
+
+from configs import OCR_WORKERS
+from document_loaders.ocr import ImageType, ocr_images
+
+
+# 页面内容：文本与 (图片键,) 按原有顺序排列，图片识别后以其文本替换
+Segment = Union[str, Tuple[str]]
+
+
+class PagedOCRLoader(UnstructuredFileLoader):
+    '''
+    逐页解析文件的加载器基类，lazy_load 每解析完一页（幻灯片）即返回该页的 Document，metadata 中 page 为页码，
+    调用方可以在后续页面仍在解析时开始切分、向量化已返回的页面，内存占用也不再与整个文件的文本量成正比。
+
+    子类实现 _iter_pages，依次返回 (页码, 内容片段, 新出现的图片)。图片在积累 OCR_WORKERS * 2 页后一起并行识别；
+    已经出现过的图片只需在内容片段中引用其图片键，不必再次提供
+    '''
+    def _iter_pages(self) -> Iterator[Tuple[int, List[Segment], Dict[str, ImageType]]]:
+        raise NotImplementedError
+
+    def _iter_texts(self) -> Iterator[Tuple[int, str]]:
+        window_size = max(1, OCR_WORKERS * 2)
+        window_pages = []  # [(页码, 内容片段)]
+        window_images = {}  # {图片键: 图片}
+        known = {}  # {图片键: 识别结果}
+
+        def flush() -> Iterator[Tuple[int, str]]:
+            if window_images:
+                keys = list(window_images)
+                for key, text in zip(keys, ocr_images(list(window_images.values()), keys=keys)):
+                    known[key] = text
+            for page, segments in window_pages:
+                yield page, "".join(known[x[0]] if isinstance(x, tuple) else x for x in segments)
+            window_pages.clear()
+            window_images.clear()
+
+        for page, segments, images in self._iter_pages():
+            window_pages.append((page, segments))
+            window_images.update({k: v for k, v in images.items() if k not in known})
+            # 没有待识别的图片时不必等待，直接返回
+            if not window_images or len(window_pages) >= window_size:
+                yield from flush()
+        yield from flush()
+
+    def _get_elements(self) -> List:
+        from unstructured.partition.text import partition_text
+        text = "".join(text for _, text in self._iter_texts())
+        return partition_text(text=text, **self.unstructured_kwargs)
+
+    def lazy_load(self) -> Iterator[Document]:
+        from unstructured.partition.text import partition_text
+        for page, text in self._iter_texts():
+            if not text.strip():
+                continue
+            elements = partition_text(text=text, **self.unstructured_kwargs)
+            self._post_process_elements(elements)
+            if self.mode == "elements":
+                for element in elements:
+                    metadata = self._get_metadata()
+                    metadata.update(element.metadata.to_dict())
+                    metadata["category"] = element.category
+                    metadata["page"] = page
+                    yield Document(page_content=str(element), metadata=metadata)
+            elif elements:
+                metadata = self._get_metadata()
+                metadata["page"] = page
+                yield Document(page_content="\n\n".join(str(el) for el in elements), metadata=metadata)
+
+    def load(self) -> List[Document]:
+        return list(self.lazy_load())
@@ -47,6 +47,16 @@ if __name__ == "__main__":
             '''
         )
     )
+    parser.add_argument(
+        "-m",
+        "--update-modified",
+        action="store_true",
+        help=('''
+            update vector store for files exist in database and modified on disk since last vectorization.
+            unchanged files are skipped, and only changed chunks of modified files are embedded or deleted.
+            '''
+        )
+    )
     parser.add_argument(
         "-i",
         "--increment",
@@ -109,6 +119,8 @@ if __name__ == "__main__":
         import_from_db(args.import_db)
     elif args.update_in_db:
         folder2db(kb_names=args.kb_name, mode="update_in_db", embed_model=args.embed_model)
+    elif args.update_modified:
+        folder2db(kb_names=args.kb_name, mode="update_modified", embed_model=args.embed_model)
     elif args.increment:
         folder2db(kb_names=args.kb_name, mode="increment", embed_model=args.embed_model)
     elif args.prune_db:
@@ -5,23 +5,24 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
 from configs import VERSION
-from configs.model_config import NLTK_DATA_PATH
+from configs.model_config import NLTK_DATA_PATH, USE_RERANKER
 from configs.server_config import OPEN_CROSS_DOMAIN
 import argparse
 import uvicorn
 from fastapi import Body
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import RedirectResponse
+from starlette.responses import RedirectResponse, PlainTextResponse
 from server.chat.chat import chat
 from server.chat.search_engine_chat import search_engine_chat
 from server.chat.completion import completion
 from server.chat.feedback import chat_feedback
 from server.embeddings_api import embed_texts_endpoint
+from server.metrics import registry
 from server.llm_api import (list_running_models, list_config_models,
                             change_llm_model, stop_llm_model,
                             get_model_config, list_search_engines)
 from server.utils import (BaseResponse, ListResponse, FastAPI, MakeFastAPIOffline,
-                          get_server_configs, get_prompt_template)
+                          get_server_configs, get_prompt_template, close_httpx_clients)
 from typing import List, Literal
 
 nltk.data.path = [NLTK_DATA_PATH] + nltk.data.path
@@ -49,6 +50,8 @@ def create_app(run_mode: str = None):
             allow_headers=["*"],
         )
     mount_app_routes(app, run_mode=run_mode)
+    # 退出时关闭共享的 httpx 连接池
+    app.add_event_handler("shutdown", close_httpx_clients)
     return app
 
 
@@ -115,6 +118,43 @@ def mount_app_routes(app: FastAPI, run_mode: str = None):
              summary="获取服务器支持的搜索引擎",
              )(list_search_engines)
 
+    @app.post("/server/query_embed_batch_stats",
+              tags=["Server State"],
+              summary="获取查询向量微批处理的批大小直方图")
+    def query_embed_batch_stats() -> BaseResponse:
+        from server.knowledge_base.kb_cache.base import query_embeddings_batcher_pool
+        return BaseResponse(data=query_embeddings_batcher_pool.stats())
+
+    @app.post("/server/reranker_stats",
+              tags=["Server State"],
+              summary="获取常驻 reranker 模型的排队与分数缓存命中情况")
+    def reranker_stats() -> BaseResponse:
+        if not USE_RERANKER:
+            return BaseResponse(data=[])
+        from server.reranker.reranker import reranker_pool
+        return BaseResponse(data=reranker_pool.stats())
+
+    @app.post("/server/answer_cache_stats",
+              tags=["Server State"],
+              summary="获取语义答案缓存的大小与命中情况")
+    def answer_cache_stats() -> BaseResponse:
+        from server.chat.answer_cache import answer_cache
+        return BaseResponse(data=answer_cache.stats())
+
+    @app.post("/server/search_cache_stats",
+              tags=["Server State"],
+              summary="获取知识库检索结果缓存与查询向量缓存的命中情况")
+    def search_cache_stats() -> BaseResponse:
+        from server.knowledge_base.kb_cache.search_cache import search_result_cache, query_embedding_cache
+        return BaseResponse(data={"search_results": search_result_cache.stats(),
+                                  "query_embeddings": query_embedding_cache.stats()})
+
+    @app.get("/metrics",
+             tags=["Server State"],
+             summary="以 Prometheus 文本格式输出各接口分阶段耗时、缓存锁等待时间及缓存池状态")
+    def metrics() -> PlainTextResponse:
+        return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
     @app.post("/server/get_prompt_template",
              tags=["Server State"],
              summary="获取服务区配置的 prompt 模板")
@@ -144,7 +184,7 @@ def mount_knowledge_routes(app: FastAPI):
     from server.knowledge_base.kb_doc_api import (list_files, upload_docs, delete_docs,
                                                 update_docs, download_doc, recreate_vector_store,
                                                 search_docs, DocumentWithVSId, update_info,
-                                                update_docs_by_id,)
+                                                update_docs_by_id, update_index)
 
     app.post("/chat/knowledge_base_chat",
              tags=["Chat"],
@@ -213,6 +253,12 @@ def mount_knowledge_routes(app: FastAPI):
              response_model=BaseResponse,
              summary="更新知识库介绍"
              )(update_info)
+
+    app.post("/knowledge_base/update_index",
+             tags=["Knowledge Base Management"],
+             response_model=BaseResponse,
+             summary="修改FAISS知识库的索引类型，并就地重建向量库"
+             )(update_index)
     app.post("/knowledge_base/update_docs",
              tags=["Knowledge Base Management"],
              response_model=BaseResponse,
@@ -16,6 +16,7 @@ from server.agent.custom_agent.ChatGLM3Agent import initialize_glm3_agent
 from server.agent.tools_select import tools, tool_names
 from server.agent.callbacks import CustomAsyncIteratorCallbackHandler, Status
 from server.chat.utils import History
+from server.metrics import span, instrument_stream, trace_tokens
 from server.agent import model_container
 from server.agent.custom_template import CustomOutputParser, CustomPromptTemplate
 
@@ -55,7 +56,8 @@ async def agent_chat(query: str = Body(..., description="用户输入", examples
             callbacks=[callback],
         )
 
-        kb_list = {x["kb_name"]: x for x in get_kb_details()}
+        with span("list_kbs"):
+            kb_list = {x["kb_name"]: x for x in get_kb_details()}
         model_container.DATABASE = {name: details['kb_info'] for name, details in kb_list.items()}
 
         if Agent_MODEL:
@@ -115,7 +117,7 @@ async def agent_chat(query: str = Body(..., description="用户输入", examples
                 pass
 
         if stream:
-            async for chunk in callback.aiter():
+            async for chunk in trace_tokens(callback.aiter()):
                 tools_use = []
                 # Use server-sent-events to stream the response
                 data = json.loads(chunk)
@@ -146,7 +148,7 @@ async def agent_chat(query: str = Body(..., description="用户输入", examples
         else:
             answer = ""
             final_answer = ""
-            async for chunk in callback.aiter():
+            async for chunk in trace_tokens(callback.aiter()):
                 data = json.loads(chunk)
                 if data["status"] == Status.start or data["status"] == Status.complete:
                     continue
@@ -171,8 +173,9 @@ async def agent_chat(query: str = Body(..., description="用户输入", examples
             yield json.dumps({"answer": answer, "final_answer": final_answer}, ensure_ascii=False)
         await task
 
-    return EventSourceResponse(agent_chat_iterator(query=query,
-                                                   history=history,
-                                                   model_name=model_name,
-                                                   prompt_name=prompt_name),
+    return EventSourceResponse(instrument_stream(agent_chat_iterator(query=query,
+                                                                     history=history,
+                                                                     model_name=model_name,
+                                                                     prompt_name=prompt_name),
+                                                 "agent_chat"),
                                )
@@ -0,0 +1,168 @@
+import asyncio
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncIterable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from configs import (EMBEDDING_MODEL, ANSWER_CACHE_ENABLED, ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL,
+                     ANSWER_CACHE_MAX_SIZE, ANSWER_CACHE_STREAM_CHUNK, ANSWER_CACHE_STREAM_DELAY,
+                     logger, log_verbose)
+from server.knowledge_base.kb_service.base import EmbeddingsFunAdapter, kb_versions
+
+
+class CachedAnswer:
+    def __init__(self, query: str, embedding: np.ndarray, answer: str, docs: List = None):
+        self.query = query
+        self.embedding = embedding
+        self.answer = answer
+        self.docs = docs or []
+        self.created = time.monotonic()
+
+
+class AnswerCache:
+    '''
+    语义答案缓存。
+    键为 (知识库名称, 知识库内容版本, 模型名称, prompt 模板, temperature 分档, 其它影响答案的参数)，
+    同一个键下的问题向量构成一个小的平面索引，与新问题的余弦相似度最高且不低于 threshold 时命中。
+    条目超过 ttl 秒后失效，超出 max_size 时淘汰最久未使用的条目；知识库内容变化时清除该知识库的全部条目。
+    '''
+    def __init__(
+            self,
+            max_size: int = ANSWER_CACHE_MAX_SIZE,
+            ttl: float = ANSWER_CACHE_TTL,
+            threshold: float = ANSWER_CACHE_THRESHOLD,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries: OrderedDict = OrderedDict()  # {entry_id: (key, CachedAnswer)}，最久未使用的在前
+        self._buckets: Dict[Tuple, Dict] = {}  # {key: {"ids": [entry_id], "matrix": np.ndarray | None}}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(
+            kb_name: Optional[str],
+            model_name: str,
+            prompt_name: str,
+            temperature: float,
+            **kwargs,
+    ) -> Tuple:
+        '''
+        生成缓存键。kb_name 不为空时加入知识库当前的内容版本，知识库变化后旧的条目不会再被命中。
+        kwargs 为其它会影响答案的参数，如 top_k、score_threshold
+        '''
+        kb_name = kb_name.lower() if kb_name else None
+        version = kb_versions.get(kb_name) if kb_name else 0
+        return (kb_name, version, model_name, prompt_name, round(temperature or 0, 1),
+                tuple(sorted(kwargs.items())))
+
+    def _remove(self, entry_id: int):
+        key, _ = self._entries.pop(entry_id)
+        bucket = self._buckets[key]
+        bucket["ids"].remove(entry_id)
+        bucket["matrix"] = None
+        if not bucket["ids"]:
+            del self._buckets[key]
+
+    def _expire(self):
+        if self.ttl <= 0:
+            return
+        now = time.monotonic()
+        for entry_id in [k for k, (_, v) in self._entries.items() if now - v.created > self.ttl]:
+            self._remove(entry_id)
+
+    def get(self, key: Tuple, embedding: List[float]) -> Optional[CachedAnswer]:
+        query = _normalize(embedding)
+        with self._lock:
+            self._expire()
+            if not (bucket := self._buckets.get(key)):
+                self.misses += 1
+                return None
+            if bucket["matrix"] is None:
+                bucket["matrix"] = np.stack([self._entries[i][1].embedding for i in bucket["ids"]])
+            scores = bucket["matrix"] @ query
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            entry_id = bucket["ids"][best]
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            entry = self._entries[entry_id][1]
+        if log_verbose:
+            logger.info(f"answer cache hit: {entry.query} (similarity {scores[best]:.4f})")
+        return entry
+
+    def set(self, key: Tuple, query: str, embedding: List[float], answer: str, docs: List = None):
+        if self.max_size <= 0 or not answer:
+            return
+        entry = CachedAnswer(query, _normalize(embedding), answer, docs)
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = (key, entry)
+            bucket = self._buckets.setdefault(key, {"ids": [], "matrix": None})
+            bucket["ids"].append(entry_id)
+            bucket["matrix"] = None
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, kb_name: str):
+        '''
+        清除知识库的全部条目
+        '''
+        kb_name = kb_name.lower()
+        with self._lock:
+            for entry_id in [k for k, (key, _) in self._entries.items() if key[0] == kb_name]:
+                self._remove(entry_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def _normalize(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+async def aembed_query(query: str, embed_model: str = EMBEDDING_MODEL) -> Optional[List[float]]:
+    '''
+    计算用于查找答案缓存的问题向量，失败时返回 None（不使用缓存）
+    '''
+    try:
+        return await EmbeddingsFunAdapter(embed_model).aembed_query(query)
+    except Exception as e:
+        logger.error(f"{e.__class__.__name__}: failed to embed query for answer cache: {e}",
+                     exc_info=e if log_verbose else None)
+        return None
+
+
+async def replay_answer(
+        answer: str,
+        chunk_size: int = ANSWER_CACHE_STREAM_CHUNK,
+        delay: float = ANSWER_CACHE_STREAM_DELAY,
+) -> AsyncIterable[str]:
+    '''
+    将缓存的答案切分为小段逐段返回，模拟流式输出
+    '''
+    chunk_size = max(1, chunk_size)
+    for i in range(0, len(answer), chunk_size):
+        yield answer[i:i + chunk_size]
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+answer_cache = AnswerCache(max_size=ANSWER_CACHE_MAX_SIZE if ANSWER_CACHE_ENABLED else 0)
+kb_versions.add_listener(answer_cache.invalidate)
@@ -1,6 +1,6 @@
 from fastapi import Body
 from sse_starlette.sse import EventSourceResponse
-from configs import LLM_MODELS, TEMPERATURE
+from configs import LLM_MODELS, TEMPERATURE, ANSWER_CACHE_ENABLED
 from server.utils import wrap_done, get_ChatOpenAI
 from langchain.chains import LLMChain
 from langchain.callbacks import AsyncIteratorCallbackHandler
@@ -15,6 +15,8 @@ from server.utils import get_prompt_template
 from server.memory.conversation_db_buffer_memory import ConversationBufferDBMemory
 from server.db.repository import add_message_to_db
 from server.callback_handler.conversation_callback_handler import ConversationCallbackHandler
+from server.chat.answer_cache import answer_cache, aembed_query, replay_answer
+from server.metrics import span, instrument_stream, trace_tokens
 
 
 async def chat(query: str = Body(..., description="用户输入", examples=["恼羞成怒"]),
@@ -40,6 +42,27 @@ async def chat(query: str = Body(..., description="用户输入", examples=["恼
         callbacks = [callback]
         memory = None
 
+        if isinstance(max_tokens, int) and max_tokens <= 0:
+            max_tokens = None
+
+        # 不带历史消息的对话查找语义答案缓存，命中则直接返回缓存的答案
+        cache_key = query_embedding = None
+        # 采样生成（temperature > 0）的回答不缓存，否则相同的问题总是得到同一个采样结果
+        if ANSWER_CACHE_ENABLED and temperature <= 0 and not history and not (conversation_id and history_len > 0):
+            cache_key = answer_cache.make_key(None, model_name, prompt_name, temperature, max_tokens=max_tokens)
+            with span("answer_cache"):
+                query_embedding = await aembed_query(query)
+                cached = query_embedding is not None and answer_cache.get(cache_key, query_embedding)
+            if cached:
+                message_id = add_message_to_db(chat_type="llm_chat", query=query,
+                                               conversation_id=conversation_id, response=cached.answer)
+                if stream:
+                    async for token in replay_answer(cached.answer):
+                        yield json.dumps({"text": token, "message_id": message_id}, ensure_ascii=False)
+                else:
+                    yield json.dumps({"text": cached.answer, "message_id": message_id}, ensure_ascii=False)
+                return
+
         # 负责保存llm response到message db
         message_id = add_message_to_db(chat_type="llm_chat", query=query, conversation_id=conversation_id)
         conversation_callback = ConversationCallbackHandler(conversation_id=conversation_id, message_id=message_id,
@@ -47,9 +70,6 @@ async def chat(query: str = Body(..., description="用户输入", examples=["恼
                                                             query=query)
         callbacks.append(conversation_callback)
 
-        if isinstance(max_tokens, int) and max_tokens <= 0:
-            max_tokens = None
-
         model = get_ChatOpenAI(
             model_name=model_name,
             temperature=temperature,
@@ -84,20 +104,22 @@ async def chat(query: str = Body(..., description="用户输入", examples=["恼
             callback.done),
         )
 
+        answer = ""
         if stream:
-            async for token in callback.aiter():
+            async for token in trace_tokens(callback.aiter()):
+                answer += token
                 # Use server-sent-events to stream the response
                 yield json.dumps(
                     {"text": token, "message_id": message_id},
                     ensure_ascii=False)
         else:
-            answer = ""
-            async for token in callback.aiter():
+            async for token in trace_tokens(callback.aiter()):
                 answer += token
             yield json.dumps(
                 {"text": answer, "message_id": message_id},
                 ensure_ascii=False)
 
-        await task
+        if await task is not None and query_embedding is not None:
+            answer_cache.set(cache_key, query, query_embedding, answer)
 
-    return EventSourceResponse(chat_iterator())
+    return EventSourceResponse(instrument_stream(chat_iterator(), "chat"))
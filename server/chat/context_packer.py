@@ -0,0 +1,223 @@
+'''
+拼接检索结果作为 prompt 的上下文：
+    1. 合并同一文件中相邻或重叠（切分时的 OVERLAP_SIZE 部分）的文本块
+    2. 去除与已保留文本块近似重复的文本块
+    3. 按模型的 token 预算依次拼入，超出预算的部分截断或丢弃
+token 数使用各模型的 tokenizer 计算，tokenizer 按模型缓存
+'''
+import re
+import threading
+from functools import lru_cache
+from typing import Callable, List, Optional, Set, Tuple
+
+from langchain.docstore.document import Document
+
+from configs import (CONTEXT_DEDUP_THRESHOLD, CONTEXT_TOKEN_BUDGET,
+                     logger, log_verbose)
+from server.metrics import registry
+
+
+# 相邻文本块首尾重叠部分的最小长度，过短的重叠可能只是巧合
+MIN_OVERLAP_CHARS = 8
+SEPARATOR = "\n"
+
+_stats = {"requests": 0, "original_tokens": 0, "packed_tokens": 0}
+_stats_lock = threading.Lock()
+
+
+def _estimate_tokens(text: str) -> int:
+    '''
+    没有可用的 tokenizer 时的估算：每个中日韩字符计 1 个 token，其余每个单词或标点计 1 个 token
+    '''
+    return len(re.findall(r"[぀-ヿ㐀-鿿豈-﫿]|[A-Za-z0-9_]+|[^\sA-Za-z0-9_]", text))
+
+
+@lru_cache()
+def get_token_counter(model_name: str) -> Callable[[str], int]:
+    '''
+    返回计算 token 数的函数：本地模型使用其 tokenizer，在线 API 模型使用 tiktoken 的 cl100k_base，均不可用时按字符估算
+    '''
+    from server.utils import get_model_worker_config
+
+    config = get_model_worker_config(model_name)
+    if config.get("model_path_exists"):
+        try:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(config["model_path"], trust_remote_code=True)
+            lock = threading.Lock()  # tokenizers 的 Rust 对象不支持并发调用
+
+            def count(text: str) -> int:
+                with lock:
+                    return len(tokenizer.encode(text, add_special_tokens=False))
+            return count
+        except Exception as e:
+            logger.error(f"{e.__class__.__name__}: failed to load tokenizer for {model_name}: {e}",
+                         exc_info=e if log_verbose else None)
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception as e:
+        logger.warning(f"{e.__class__.__name__}: tiktoken is not available, estimating tokens by characters: {e}")
+    return _estimate_tokens
+
+
+def get_token_budget(model_name: str) -> int:
+    return CONTEXT_TOKEN_BUDGET.get(model_name, CONTEXT_TOKEN_BUDGET.get("default", 0))
+
+
+def _overlap(a: str, b: str) -> int:
+    '''
+    a 的结尾与 b 的开头相同部分的最大长度，不足 MIN_OVERLAP_CHARS 时返回 0
+    '''
+    if min(len(a), len(b)) < MIN_OVERLAP_CHARS:
+        return 0
+    head = b[:MIN_OVERLAP_CHARS]
+    start = max(0, len(a) - len(b))
+    while (pos := a.find(head, start)) != -1:
+        if b.startswith(a[pos:]):
+            return len(a) - pos
+        start = pos + 1
+    return 0
+
+
+def _merge(a: str, b: str) -> Optional[str]:
+    '''
+    合并同一文件中的两个文本块：一个包含另一个，或首尾重叠时返回合并后的文本，否则返回 None
+    '''
+    if b in a:
+        return a
+    if a in b:
+        return b
+    if n := _overlap(a, b):
+        return a + b[n:]
+    if n := _overlap(b, a):
+        return b + a[n:]
+    return None
+
+
+def _shingles(text: str, n: int = 3) -> Set[str]:
+    text = re.sub(r"\s+", "", text)
+    return {text[i:i + n] for i in range(max(1, len(text) - n + 1))}
+
+
+def _jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def merge_docs(docs: List[Document], dedup_threshold: float = CONTEXT_DEDUP_THRESHOLD) -> List[Document]:
+    '''
+    按原有顺序（相关度）合并同一文件的相邻、重叠文本块，并去除近似重复的文本块。合并后的文本块位于其中排名最靠前者的位置
+    '''
+    merged: List[Tuple[int, Document]] = []  # [(排名, 文本块)]
+    for rank, doc in enumerate(docs):
+        source = doc.metadata.get("source")
+        text = doc.page_content
+        best_rank, metadata = rank, doc.metadata
+        # 与已有文本块合并后可能与更多文本块相接，循环直到不再变化
+        changed = True
+        while changed:
+            changed = False
+            for i, (r, other) in enumerate(merged):
+                if (other.metadata.get("source") == source
+                        and (new_text := _merge(other.page_content, text)) is not None):
+                    text = new_text
+                    if r < best_rank:
+                        best_rank, metadata = r, other.metadata
+                    merged.pop(i)
+                    changed = True
+                    break
+        merged.append((best_rank, Document(page_content=text, metadata=metadata)))
+    merged = [doc for _, doc in sorted(merged, key=lambda x: x[0])]
+
+    if not 0 < dedup_threshold <= 1:
+        return merged
+
+    result = []
+    shingles = []
+    for doc in merged:
+        s = _shingles(doc.page_content)
+        if any(_jaccard(s, x) >= dedup_threshold for x in shingles):
+            continue
+        result.append(doc)
+        shingles.append(s)
+    return result
+
+
+def _truncate(text: str, max_tokens: int, count_tokens: Callable[[str], int]) -> str:
+    '''
+    二分查找不超过 max_tokens 的最长前缀
+    '''
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
+
+def pack_context(
+        docs: List[Document],
+        model_name: str,
+        token_budget: int = None,
+        dedup_threshold: float = CONTEXT_DEDUP_THRESHOLD,
+) -> Tuple[str, List[Document]]:
+    '''
+    返回 (上下文文本, 实际拼入的文本块)。token_budget 不指定时使用 CONTEXT_TOKEN_BUDGET 中该模型的配置，<= 0 表示不限制
+    '''
+    if not docs:
+        return "", []
+    if token_budget is None:
+        token_budget = get_token_budget(model_name)
+    count_tokens = get_token_counter(model_name)
+
+    original_tokens = count_tokens(SEPARATOR.join(doc.page_content for doc in docs))
+    packed = []
+    used = 0
+    sep_tokens = count_tokens(SEPARATOR)
+    for doc in merge_docs(docs, dedup_threshold=dedup_threshold):
+        tokens = count_tokens(doc.page_content) + (sep_tokens if packed else 0)
+        if token_budget > 0 and used + tokens > token_budget:
+            remaining = token_budget - used - (sep_tokens if packed else 0)
+            # 第一个文本块超出预算时截断，之后的文本块不再拼入，避免上下文中出现大量残缺的片段
+            if not packed and remaining > 0:
+                text = _truncate(doc.page_content, remaining, count_tokens)
+                packed.append(Document(page_content=text, metadata=doc.metadata))
+                used += count_tokens(text)
+            break
+        packed.append(doc)
+        used += tokens
+
+    context = SEPARATOR.join(doc.page_content for doc in packed)
+    packed_tokens = count_tokens(context)
+    with _stats_lock:
+        _stats["requests"] += 1
+        _stats["original_tokens"] += original_tokens
+        _stats["packed_tokens"] += packed_tokens
+    if log_verbose:
+        logger.info(f"context packed for {model_name}: {len(docs)} docs / {original_tokens} tokens -> "
+                    f"{len(packed)} docs / {packed_tokens} tokens, saved {original_tokens - packed_tokens} tokens")
+    return context, packed
+
+
+def stats() -> dict:
+    with _stats_lock:
+        result = dict(_stats)
+    result["saved_tokens"] = result["original_tokens"] - result["packed_tokens"]
+    return result
+
+
+def _collect() -> List:
+    s = stats()
+    return [("chatchat_context_tokens_total", "counter",
+             "Tokens of retrieved context before and after packing.",
+             [({"kind": "original"}, s["original_tokens"]),
+              ({"kind": "packed"}, s["packed_tokens"]),
+              ({"kind": "saved"}, s["saved_tokens"])])]
+
+
+registry.add_collector(_collect)
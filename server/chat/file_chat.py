@@ -1,7 +1,7 @@
 from fastapi import Body, File, Form, UploadFile
 from sse_starlette.sse import EventSourceResponse
 from configs import (LLM_MODELS, VECTOR_SEARCH_TOP_K, SCORE_THRESHOLD, TEMPERATURE,
-                     CHUNK_SIZE, OVERLAP_SIZE, ZH_TITLE_ENHANCE)
+                     CHUNK_SIZE, OVERLAP_SIZE, ZH_TITLE_ENHANCE, CONTEXT_PACK_ENABLED)
 from server.utils import (wrap_done, get_ChatOpenAI,
                         BaseResponse, get_prompt_template, get_temp_dir, run_in_thread_pool)
 from server.knowledge_base.kb_cache.faiss_cache import memo_faiss_pool
@@ -12,9 +12,13 @@ import asyncio
 from langchain.prompts.chat import ChatPromptTemplate
 from server.chat.utils import History
 from server.knowledge_base.kb_service.base import EmbeddingsFunAdapter
-from server.knowledge_base.utils import KnowledgeFile
+from server.knowledge_base.utils import KnowledgeFile, save_file_stream, commit_saved_file
+from server.metrics import span, instrument_stream, trace_tokens
+from server.chat.context_packer import pack_context
+from fastapi.concurrency import run_in_threadpool
 import json
 import os
+import threading
 from pathlib import Path
 
 
@@ -26,22 +30,28 @@ def _parse_files_in_thread(
     chunk_overlap: int,
 ):
     """
-    通过多线程将上传的文件保存到对应目录内。
+    通过多线程将上传的文件保存到对应目录内。上传内容分块写入磁盘，内容完全相同的文件只解析一次。
     生成器返回保存结果：[success or error, filename, msg, docs]
     """
+    seen_hashes = {}  # {sha256: 文件名}
+    seen_lock = threading.Lock()
+
     def parse_file(file: UploadFile) -> dict:
         '''
         保存单个文件。
         '''
+        tmp_path = None
         try:
             filename = file.filename
             file_path = os.path.join(dir, filename)
-            file_content = file.file.read()  # 读取上传文件的内容
-
-            if not os.path.isdir(os.path.dirname(file_path)):
-                os.makedirs(os.path.dirname(file_path))
-            with open(file_path, "wb") as f:
-                f.write(file_content)
+            tmp_path, file_hash = save_file_stream(file.file, file_path)
+            with seen_lock:
+                duplicate_of = seen_hashes.setdefault(file_hash, filename)
+            if duplicate_of != filename:
+                return True, filename, f"文件 {filename} 与 {duplicate_of} 内容相同，已跳过", []
+
+            commit_saved_file(tmp_path, file_path, file_hash)
+            tmp_path = None
             kb_file = KnowledgeFile(filename=filename, knowledge_base_name="temp")
             kb_file.filepath = file_path
             docs = kb_file.file2text(zh_title_enhance=zh_title_enhance,
@@ -51,6 +61,9 @@ def _parse_files_in_thread(
         except Exception as e:
             msg = f"{filename} 文件上传失败，报错信息为: {e}"
             return False, filename, msg, []
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
     params = [{"file": file} for file in files]
     for result in run_in_thread_pool(parse_file, params=params):
@@ -125,19 +138,25 @@ async def file_chat(query: str = Body(..., description="用户输入", examples=
             callbacks=[callback],
         )
         embed_func = EmbeddingsFunAdapter()
-        embeddings = await embed_func.aembed_query(query)
-        with memo_faiss_pool.acquire(knowledge_id) as vs:
-            docs = vs.similarity_search_with_score_by_vector(embeddings, k=top_k, score_threshold=score_threshold)
+        with span("embed_query"):
+            embeddings = await embed_func.aembed_query(query)
+        with memo_faiss_pool.acquire(knowledge_id, shared=True) as vs:
+            with span("search"):
+                docs = vs.similarity_search_with_score_by_vector(embeddings, k=top_k, score_threshold=score_threshold)
             docs = [x[0] for x in docs]
 
-        context = "\n".join([doc.page_content for doc in docs])
-        if len(docs) == 0: ## 如果没有找到相关文档，使用Empty模板
-            prompt_template = get_prompt_template("knowledge_base_chat", "empty")
-        else:
-            prompt_template = get_prompt_template("knowledge_base_chat", prompt_name)
-        input_msg = History(role="user", content=prompt_template).to_msg_template(False)
-        chat_prompt = ChatPromptTemplate.from_messages(
-            [i.to_msg_template() for i in history] + [input_msg])
+        with span("prompt"):
+            if CONTEXT_PACK_ENABLED:  # 合并重叠的文本块、去重，并按模型的 token 预算截取
+                context, docs = await run_in_threadpool(pack_context, docs, model_name)
+            else:
+                context = "\n".join([doc.page_content for doc in docs])
+            if len(docs) == 0: ## 如果没有找到相关文档，使用Empty模板
+                prompt_template = get_prompt_template("knowledge_base_chat", "empty")
+            else:
+                prompt_template = get_prompt_template("knowledge_base_chat", prompt_name)
+            input_msg = History(role="user", content=prompt_template).to_msg_template(False)
+            chat_prompt = ChatPromptTemplate.from_messages(
+                [i.to_msg_template() for i in history] + [input_msg])
 
         chain = LLMChain(prompt=chat_prompt, llm=model)
 
@@ -157,17 +176,17 @@ async def file_chat(query: str = Body(..., description="用户输入", examples=
             source_documents.append(f"""<span style='color:red'>未找到相关文档,该回答为大模型自身能力解答！</span>""")
 
         if stream:
-            async for token in callback.aiter():
+            async for token in trace_tokens(callback.aiter()):
                 # Use server-sent-events to stream the response
                 yield json.dumps({"answer": token}, ensure_ascii=False)
             yield json.dumps({"docs": source_documents}, ensure_ascii=False)
         else:
             answer = ""
-            async for token in callback.aiter():
+            async for token in trace_tokens(callback.aiter()):
                 answer += token
             yield json.dumps({"answer": answer,
                               "docs": source_documents},
                              ensure_ascii=False)
         await task
 
-    return EventSourceResponse(knowledge_base_chat_iterator())
+    return EventSourceResponse(instrument_stream(knowledge_base_chat_iterator(), "file_chat"))
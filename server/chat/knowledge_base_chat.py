@@ -8,12 +8,15 @@ from configs import (LLM_MODELS,
                      USE_RERANKER,
                      RERANKER_MODEL,
                      RERANKER_MAX_LENGTH,
-                     MODEL_PATH)
+                     MODEL_PATH,
+                     DEFAULT_SEARCH_MODE,
+                     ANSWER_CACHE_ENABLED,
+                     CONTEXT_PACK_ENABLED)
 from server.utils import wrap_done, get_ChatOpenAI
 from server.utils import BaseResponse, get_prompt_template
 from langchain.chains import LLMChain
 from langchain.callbacks import AsyncIteratorCallbackHandler
-from typing import AsyncIterable, List, Optional
+from typing import AsyncIterable, List, Optional, Literal
 import asyncio
 from langchain.prompts.chat import ChatPromptTemplate
 from server.chat.utils import History
@@ -21,7 +24,10 @@ from server.knowledge_base.kb_service.base import KBServiceFactory
 import json
 from urllib.parse import urlencode
 from server.knowledge_base.kb_doc_api import search_docs
-from server.reranker.reranker import LangchainReranker
+from server.reranker.reranker import reranker_pool
+from server.chat.answer_cache import answer_cache, aembed_query, replay_answer
+from server.chat.context_packer import pack_context
+from server.metrics import span, instrument_stream, trace_tokens
 from server.utils import embedding_device
 async def knowledge_base_chat(query: str = Body(..., description="用户输入", examples=["你好"]),
                               knowledge_base_name: str = Body(..., description="知识库名称", examples=["samples"]),
@@ -52,9 +58,14 @@ async def knowledge_base_chat(query: str = Body(..., description="用户输入",
                                   "default",
                                   description="使用的prompt模板名称(在configs/prompt_config.py中配置)"
                               ),
+                              search_mode: Literal["vector", "bm25", "hybrid"] = Body(
+                                  DEFAULT_SEARCH_MODE,
+                                  description="检索方式：vector 向量检索，bm25 关键词检索，hybrid 两者融合"
+                              ),
                               request: Request = None,
                               ):
-    kb = KBServiceFactory.get_service_by_name(knowledge_base_name)
+    with span("get_service", endpoint="knowledge_base_chat"):
+        kb = KBServiceFactory.get_service_by_name(knowledge_base_name)
     if kb is None:
         return BaseResponse(code=404, msg=f"未找到知识库 {knowledge_base_name}")
 
@@ -72,42 +83,81 @@ async def knowledge_base_chat(query: str = Body(..., description="用户输入",
         if isinstance(max_tokens, int) and max_tokens <= 0:
             max_tokens = None
 
+        def format_source_documents(docs) -> List[str]:
+            source_documents = []
+            for inum, doc in enumerate(docs):
+                filename = doc.metadata.get("source")
+                parameters = urlencode({"knowledge_base_name": knowledge_base_name, "file_name": filename})
+                base_url = request.base_url
+                url = f"{base_url}knowledge_base/download_doc?" + parameters
+                text = f"""Reference [{inum + 1}] [{filename}]({url}) \n\n{doc.page_content}\n\n"""
+                source_documents.append(text)
+
+            if len(source_documents) == 0:  # 没有找到相关文档
+                source_documents.append(f"<span style='color:red'>未找到相关文档,该回答为大模型自身能力解答！</span>")
+            return source_documents
+
+        # 无历史消息时查找语义答案缓存，命中则直接返回缓存的答案与出处
+        cache_key = query_embedding = None
+        if ANSWER_CACHE_ENABLED and not history:
+            cache_key = answer_cache.make_key(knowledge_base_name, model_name, prompt_name, temperature,
+                                              top_k=top_k, score_threshold=score_threshold,
+                                              search_mode=search_mode, max_tokens=max_tokens)
+            with span("answer_cache"):
+                query_embedding = await aembed_query(query, kb.embed_model)
+                cached = query_embedding is not None and answer_cache.get(cache_key, query_embedding)
+            if cached:
+                source_documents = format_source_documents(cached.docs)
+                if stream:
+                    async for token in replay_answer(cached.answer):
+                        yield json.dumps({"answer": token}, ensure_ascii=False)
+                    yield json.dumps({"docs": source_documents}, ensure_ascii=False)
+                else:
+                    yield json.dumps({"answer": cached.answer,
+                                      "docs": source_documents},
+                                     ensure_ascii=False)
+                return
+
         model = get_ChatOpenAI(
             model_name=model_name,
             temperature=temperature,
             max_tokens=max_tokens,
             callbacks=[callback],
         )
-        docs = await run_in_threadpool(search_docs,
-                                       query=query,
-                                       knowledge_base_name=knowledge_base_name,
-                                       top_k=top_k,
-                                       score_threshold=score_threshold)
+        with span("search"):
+            docs = await run_in_threadpool(search_docs,
+                                           query=query,
+                                           knowledge_base_name=knowledge_base_name,
+                                           top_k=top_k,
+                                           score_threshold=score_threshold,
+                                           file_name="",
+                                           metadata={},
+                                           search_params={},
+                                           search_mode=search_mode)
 
         # 加入reranker
         if USE_RERANKER:
-            reranker_model_path = MODEL_PATH["reranker"].get(RERANKER_MODEL,"BAAI/bge-reranker-large")
-            print("-----------------model path------------------")
-            print(reranker_model_path)
-            reranker_model = LangchainReranker(top_n=top_k,
-                                            device=embedding_device(),
-                                            max_length=RERANKER_MAX_LENGTH,
-                                            model_name_or_path=reranker_model_path
-                                            )
-            print(docs)
-            docs = reranker_model.compress_documents(documents=docs,
-                                                     query=query)
-            print("---------after rerank------------------")
-            print(docs)
-        context = "\n".join([doc.page_content for doc in docs])
+            with span("rerank"):
+                reranker_model_path = MODEL_PATH["reranker"].get(RERANKER_MODEL,"BAAI/bge-reranker-large")
+                # 模型常驻于 reranker_pool 中，仅首次请求时加载；打分由后台线程跨请求合批完成
+                reranker_model = await run_in_threadpool(reranker_pool.load_reranker,
+                                                         model_name_or_path=reranker_model_path,
+                                                         device=embedding_device())
+                docs = await reranker_model.arerank(query=query, documents=docs, top_n=top_k)
 
-        if len(docs) == 0:  # 如果没有找到相关文档，使用empty模板
-            prompt_template = get_prompt_template("knowledge_base_chat", "empty")
-        else:
-            prompt_template = get_prompt_template("knowledge_base_chat", prompt_name)
-        input_msg = History(role="user", content=prompt_template).to_msg_template(False)
-        chat_prompt = ChatPromptTemplate.from_messages(
-            [i.to_msg_template() for i in history] + [input_msg])
+        with span("prompt"):
+            if CONTEXT_PACK_ENABLED:  # 合并重叠的文本块、去重，并按模型的 token 预算截取
+                context, docs = await run_in_threadpool(pack_context, docs, model_name)
+            else:
+                context = "\n".join([doc.page_content for doc in docs])
+
+            if len(docs) == 0:  # 如果没有找到相关文档，使用empty模板
+                prompt_template = get_prompt_template("knowledge_base_chat", "empty")
+            else:
+                prompt_template = get_prompt_template("knowledge_base_chat", prompt_name)
+            input_msg = History(role="user", content=prompt_template).to_msg_template(False)
+            chat_prompt = ChatPromptTemplate.from_messages(
+                [i.to_msg_template() for i in history] + [input_msg])
 
         chain = LLMChain(prompt=chat_prompt, llm=model)
 
@@ -117,31 +167,24 @@ async def knowledge_base_chat(query: str = Body(..., description="用户输入",
             callback.done),
         )
 
-        source_documents = []
-        for inum, doc in enumerate(docs):
-            filename = doc.metadata.get("source")
-            parameters = urlencode({"knowledge_base_name": knowledge_base_name, "file_name": filename})
-            base_url = request.base_url
-            url = f"{base_url}knowledge_base/download_doc?" + parameters
-            text = f"""Reference [{inum + 1}] [{filename}]({url}) \n\n{doc.page_content}\n\n"""
-            source_documents.append(text)
-
-        if len(source_documents) == 0:  # 没有找到相关文档
-            source_documents.append(f"<span style='color:red'>未找到相关文档,该回答为大模型自身能力解答！</span>")
+        source_documents = format_source_documents(docs)
 
+        answer = ""
         if stream:
-            async for token in callback.aiter():
+            async for token in trace_tokens(callback.aiter()):
+                answer += token
                 # Use server-sent-events to stream the response
                 yield json.dumps({"answer": token}, ensure_ascii=False)
             yield json.dumps({"docs": source_documents}, ensure_ascii=False)
         else:
-            answer = ""
-            async for token in callback.aiter():
+            async for token in trace_tokens(callback.aiter()):
                 answer += token
             yield json.dumps({"answer": answer,
                               "docs": source_documents},
                              ensure_ascii=False)
-        await task
+        if await task is not None and query_embedding is not None:
+            answer_cache.set(cache_key, query, query_embedding, answer, docs)
 
-    return EventSourceResponse(knowledge_base_chat_iterator(query, top_k, history,model_name,prompt_name))
+    return EventSourceResponse(instrument_stream(knowledge_base_chat_iterator(query, top_k, history,model_name,prompt_name),
+                                                 "knowledge_base_chat"))
 
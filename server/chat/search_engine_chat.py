@@ -14,6 +14,7 @@ from sse_starlette import EventSourceResponse
 from server.utils import wrap_done, get_ChatOpenAI
 from server.utils import BaseResponse, get_prompt_template
 from server.chat.utils import History
+from server.metrics import span, instrument_stream, trace_tokens
 from typing import AsyncIterable
 import asyncio
 import json
@@ -161,13 +162,16 @@ async def search_engine_chat(query: str = Body(..., description="用户输入",
             callbacks=[callback],
         )
 
-        docs = await lookup_search_engine(query, search_engine_name, top_k, split_result=split_result)
-        context = "\n".join([doc.page_content for doc in docs])
+        with span("search"):
+            docs = await lookup_search_engine(query, search_engine_name, top_k, split_result=split_result)
 
-        prompt_template = get_prompt_template("search_engine_chat", prompt_name)
-        input_msg = History(role="user", content=prompt_template).to_msg_template(False)
-        chat_prompt = ChatPromptTemplate.from_messages(
-            [i.to_msg_template() for i in history] + [input_msg])
+        with span("prompt"):
+            context = "\n".join([doc.page_content for doc in docs])
+
+            prompt_template = get_prompt_template("search_engine_chat", prompt_name)
+            input_msg = History(role="user", content=prompt_template).to_msg_template(False)
+            chat_prompt = ChatPromptTemplate.from_messages(
+                [i.to_msg_template() for i in history] + [input_msg])
 
         chain = LLMChain(prompt=chat_prompt, llm=model)
 
@@ -186,23 +190,24 @@ async def search_engine_chat(query: str = Body(..., description="用户输入",
             source_documents.append(f"""<span style='color:red'>未找到相关文档,该回答为大模型自身能力解答！</span>""")
 
         if stream:
-            async for token in callback.aiter():
+            async for token in trace_tokens(callback.aiter()):
                 # Use server-sent-events to stream the response
                 yield json.dumps({"answer": token}, ensure_ascii=False)
             yield json.dumps({"docs": source_documents}, ensure_ascii=False)
         else:
             answer = ""
-            async for token in callback.aiter():
+            async for token in trace_tokens(callback.aiter()):
                 answer += token
             yield json.dumps({"answer": answer,
                               "docs": source_documents},
                              ensure_ascii=False)
         await task
 
-    return EventSourceResponse(search_engine_chat_iterator(query=query,
-                                                           search_engine_name=search_engine_name,
-                                                           top_k=top_k,
-                                                           history=history,
-                                                           model_name=model_name,
-                                                           prompt_name=prompt_name),
+    return EventSourceResponse(instrument_stream(search_engine_chat_iterator(query=query,
+                                                                             search_engine_name=search_engine_name,
+                                                                             top_k=top_k,
+                                                                             history=history,
+                                                                             model_name=model_name,
+                                                                             prompt_name=prompt_name),
+                                                 "search_engine_chat"),
                                )
@@ -16,6 +16,8 @@ class MessageModel(Base):
     response = Column(String(4096), comment='模型回答')
     # 记录知识库id等，以便后续扩展
     meta_data = Column(JSON, default={})
+    # 问题与回答的 token 数，按模型分别记录：{模型名称: [问题 token 数, 回答 token 数]}
+    token_counts = Column(JSON, default={})
     # 满分100 越高表示评价越好
     feedback_score = Column(Integer, default=-1, comment='用户评分')
     feedback_reason = Column(String(255), default="", comment='用户评分理由')
@@ -16,6 +16,15 @@ def add_kb_to_db(session, kb_name, kb_info, vs_type, embed_model):
     return True
 
 
+@with_session
+def update_kb_index_in_db(session, kb_name, index_type, index_params):
+    kb = session.query(KnowledgeBaseModel).filter(KnowledgeBaseModel.kb_name.ilike(kb_name)).first()
+    if kb:
+        kb.index_type = index_type
+        kb.index_params = index_params
+    return True
+
+
 @with_session
 def list_kbs_from_db(session, min_file_count: int = -1):
     kbs = session.query(KnowledgeBaseModel.kb_name).filter(KnowledgeBaseModel.file_count > min_file_count).all()
@@ -57,6 +66,8 @@ def get_kb_detail(session, kb_name: str) -> dict:
             "kb_info": kb.kb_info,
             "vs_type": kb.vs_type,
             "embed_model": kb.embed_model,
+            "index_type": kb.index_type,
+            "index_params": kb.index_params,
             "file_count": kb.file_count,
             "create_time": kb.create_time,
         }
@@ -2,7 +2,7 @@ from server.db.models.knowledge_base_model import KnowledgeBaseModel
 from server.db.models.knowledge_file_model import KnowledgeFileModel, FileDocModel
 from server.db.session import with_session
 from server.knowledge_base.utils import KnowledgeFile
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 
 @with_session
@@ -34,7 +34,15 @@ def list_docs_from_db(session,
     for k, v in metadata.items():
         docs = docs.filter(FileDocModel.meta_data[k].as_string() == str(v))
 
-    return [{"id": x.doc_id, "metadata": x.metadata} for x in docs.all()]
+    return [{"id": x.doc_id, "metadata": x.meta_data} for x in docs.all()]
+
+
+@with_session
+def count_docs_from_db(session, kb_name: str) -> int:
+    '''
+    统计某知识库的 Document 数量
+    '''
+    return session.query(FileDocModel).filter(FileDocModel.kb_name.ilike(kb_name)).count()
 
 
 @with_session
@@ -107,10 +115,12 @@ def add_file_to_db(session,
                                              .first())
         mtime = kb_file.get_mtime()
         size = kb_file.get_size()
+        file_hash = kb_file.get_hash()
 
         if existing_file:
             existing_file.file_mtime = mtime
             existing_file.file_size = size
+            existing_file.file_hash = file_hash
             existing_file.docs_count = docs_count
             existing_file.custom_docs = custom_docs
             existing_file.file_version += 1
@@ -124,6 +134,7 @@ def add_file_to_db(session,
                 text_splitter_name=kb_file.text_splitter_name or "SpacyTextSplitter",
                 file_mtime=mtime,
                 file_size=size,
+                file_hash=file_hash,
                 docs_count=docs_count,
                 custom_docs=custom_docs,
             )
@@ -174,6 +185,36 @@ def file_exists_in_db(session, kb_file: KnowledgeFile):
     return True if existing_file else False
 
 
+@with_session
+def get_file_name_by_hash(session, kb_name: str, file_hash: str) -> Optional[str]:
+    '''
+    返回知识库中内容哈希为 file_hash 的文件名，不存在时返回 None
+    '''
+    if not file_hash:
+        return None
+    file = (session.query(KnowledgeFileModel.file_name)
+            .filter(KnowledgeFileModel.kb_name.ilike(kb_name),
+                    KnowledgeFileModel.file_hash == file_hash)
+            .first())
+    return file[0] if file else None
+
+
+@with_session
+def update_file_mtime(session, kb_name: str, filename: str, file_mtime: float) -> bool:
+    '''
+    仅更新文件的修改时间记录，用于内容未变化（哈希一致）但修改时间变化的文件
+    '''
+    file: KnowledgeFileModel = (session.query(KnowledgeFileModel)
+                                .filter(KnowledgeFileModel.file_name.ilike(filename),
+                                        KnowledgeFileModel.kb_name.ilike(kb_name))
+                                .first())
+    if file:
+        file.file_mtime = file_mtime
+        session.add(file)
+        return True
+    return False
+
+
 @with_session
 def get_file_detail(session, kb_name: str, filename: str) -> dict:
     file: KnowledgeFileModel = (session.query(KnowledgeFileModel)
@@ -191,6 +232,7 @@ def get_file_detail(session, kb_name: str, filename: str) -> dict:
             "create_time": file.create_time,
             "file_mtime": file.file_mtime,
             "file_size": file.file_size,
+            "file_hash": file.file_hash,
             "custom_docs": file.custom_docs,
             "docs_count": file.docs_count,
         }
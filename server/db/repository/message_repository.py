@@ -1,9 +1,66 @@
 from server.db.session import with_session
-from typing import Dict, List
+from typing import Dict, List, Optional
+from collections import OrderedDict
+import threading
 import uuid
+from configs import MESSAGE_WINDOW_CACHE_SIZE
 from server.db.models.message_model import MessageModel
 
 
+class MessageWindowCache:
+    '''
+    按对话缓存最近的已完成聊天记录（按时间正序），连续多轮对话读取历史消息时不必每次查询数据库。
+    通过本模块的函数新增或更新聊天记录时同步更新缓存，超出 max_size 个对话时淘汰最久未使用的
+    '''
+    def __init__(self, max_size: int = MESSAGE_WINDOW_CACHE_SIZE):
+        self.max_size = max_size
+        self._windows: OrderedDict = OrderedDict()  # {conversation_id: (limit, [record])}
+        self._lock = threading.Lock()
+
+    def get(self, conversation_id: str, limit: int) -> Optional[List[Dict]]:
+        with self._lock:
+            item = self._windows.get(conversation_id)
+            if item is None or item[0] < limit:
+                return None
+            self._windows.move_to_end(conversation_id)
+            return item[1][-limit:] if limit > 0 else []
+
+    def set(self, conversation_id: str, limit: int, records: List[Dict]):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._windows[conversation_id] = (limit, list(records))
+            self._windows.move_to_end(conversation_id)
+            while len(self._windows) > self.max_size:
+                self._windows.popitem(last=False)
+
+    def put_message(self, conversation_id: str, record: Dict):
+        '''
+        新增或更新一条已完成的聊天记录，仅对已缓存的对话生效
+        '''
+        with self._lock:
+            if (item := self._windows.get(conversation_id)) is None:
+                return
+            limit, records = item
+            for i, r in enumerate(records):
+                if r["id"] == record["id"]:
+                    records[i] = record
+                    return
+            records.append(record)
+            del records[:-limit or len(records)]
+
+    def invalidate(self, conversation_id: str):
+        with self._lock:
+            self._windows.pop(conversation_id, None)
+
+
+message_window_cache = MessageWindowCache()
+
+
+def _message_to_dict(m: MessageModel) -> Dict:
+    return {"id": m.id, "query": m.query, "response": m.response, "token_counts": dict(m.token_counts or {})}
+
+
 @with_session
 def add_message_to_db(session, conversation_id: str, chat_type, query, response="", message_id=None,
                       metadata: Dict = {}):
@@ -17,6 +74,8 @@ def add_message_to_db(session, conversation_id: str, chat_type, query, response=
                      meta_data=metadata)
     session.add(m)
     session.commit()
+    if response:
+        message_window_cache.put_message(conversation_id, _message_to_dict(m))
     return m.id
 
 
@@ -33,6 +92,21 @@ def update_message(session, message_id, response: str = None, metadata: Dict = N
             m.meta_data = metadata
         session.add(m)
         session.commit()
+        if m.response:
+            message_window_cache.put_message(m.conversation_id, _message_to_dict(m))
+        return m.id
+
+
+@with_session
+def update_message_token_counts(session, message_id, token_counts: Dict[str, List[int]]):
+    """
+    记录聊天记录在各模型下的 token 数：{模型名称: [问题 token 数, 回答 token 数]}
+    """
+    m = session.query(MessageModel).filter_by(id=message_id).first()
+    if m is not None:
+        # JSON 字段需要整体赋值才会被更新
+        m.token_counts = {**(m.token_counts or {}), **token_counts}
+        session.commit()
         return m.id
 
 
@@ -68,5 +142,16 @@ def filter_message(session, conversation_id: str, limit: int = 10):
     # 直接返回 List[MessageModel] 报错
     data = []
     for m in messages:
-        data.append({"query": m.query, "response": m.response})
+        data.append(_message_to_dict(m))
     return data
+
+
+def get_recent_messages(conversation_id: str, limit: int = 10) -> List[Dict]:
+    """
+    按时间正序返回对话最近 limit 条已完成的聊天记录，优先使用 message_window_cache
+    """
+    if (records := message_window_cache.get(conversation_id, limit)) is not None:
+        return records
+    records = list(reversed(filter_message(conversation_id=conversation_id, limit=limit)))
+    message_window_cache.set(conversation_id, limit, records)
+    return records
@@ -1,14 +1,51 @@
 from langchain.docstore.document import Document
-from configs import EMBEDDING_MODEL, logger
+from configs import EMBEDDING_MODEL, EMBEDDING_CACHE_ENABLED, logger
 from server.model_workers.base import ApiEmbeddingsParams
 from server.utils import BaseResponse, get_model_worker_config, list_embed_models, list_online_embed_models
 from fastapi import Body
 from fastapi.concurrency import run_in_threadpool
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
 
 online_embed_models = list_online_embed_models()
 
 
+def _lookup_cache(
+        texts: List[str],
+        embed_model: str,
+        to_query: bool,
+) -> Tuple[List[Optional[List[float]]], List[bytes], List[int]]:
+    '''
+    从向量缓存中查找文本向量。返回 (命中结果, 各文本的缓存键, 未命中文本的下标)
+    '''
+    from server.knowledge_base.kb_cache.embeddings_cache import embeddings_cache_pool, make_cache_key
+
+    cache = embeddings_cache_pool.load_cache(embed_model)
+    keys = [make_cache_key(embed_model, text, to_query) for text in texts]
+    embeddings = cache.get_many(keys)
+    missing = [i for i, x in enumerate(embeddings) if x is None]
+    return embeddings, keys, missing
+
+
+def _update_cache(
+        embed_model: str,
+        embeddings: List[Optional[List[float]]],
+        keys: List[bytes],
+        missing: List[int],
+        resp: BaseResponse,
+) -> BaseResponse:
+    '''
+    将新计算的向量写入缓存，并与命中的结果合并
+    '''
+    from server.knowledge_base.kb_cache.embeddings_cache import embeddings_cache_pool
+
+    if resp is None or resp.code != 200 or resp.data is None:
+        return resp
+    embeddings_cache_pool.load_cache(embed_model).set_many([keys[i] for i in missing], resp.data)
+    for i, embedding in zip(missing, resp.data):
+        embeddings[i] = embedding
+    return BaseResponse(data=embeddings)
+
+
 def embed_texts(
         texts: List[str],
         embed_model: str = EMBEDDING_MODEL,
@@ -16,7 +53,42 @@ def embed_texts(
 ) -> BaseResponse:
     '''
     对文本进行向量化。返回数据格式：BaseResponse(data=List[List[float]])
+    开启 EMBEDDING_CACHE_ENABLED 时，仅对缓存中不存在的文本进行向量化。
+    '''
+    if not EMBEDDING_CACHE_ENABLED or not texts:
+        return _embed_texts(texts=texts, embed_model=embed_model, to_query=to_query)
+
+    embeddings, keys, missing = _lookup_cache(texts, embed_model, to_query)
+    if not missing:
+        return BaseResponse(data=embeddings)
+    resp = _embed_texts(texts=[texts[i] for i in missing], embed_model=embed_model, to_query=to_query)
+    return _update_cache(embed_model, embeddings, keys, missing, resp)
+
+
+async def aembed_texts(
+    texts: List[str],
+    embed_model: str = EMBEDDING_MODEL,
+    to_query: bool = False,
+) -> BaseResponse:
+    '''
+    对文本进行向量化。返回数据格式：BaseResponse(data=List[List[float]])
+    开启 EMBEDDING_CACHE_ENABLED 时，仅对缓存中不存在的文本进行向量化。
     '''
+    if not EMBEDDING_CACHE_ENABLED or not texts:
+        return await _aembed_texts(texts=texts, embed_model=embed_model, to_query=to_query)
+
+    embeddings, keys, missing = _lookup_cache(texts, embed_model, to_query)
+    if not missing:
+        return BaseResponse(data=embeddings)
+    resp = await _aembed_texts(texts=[texts[i] for i in missing], embed_model=embed_model, to_query=to_query)
+    return _update_cache(embed_model, embeddings, keys, missing, resp)
+
+
+def _embed_texts(
+        texts: List[str],
+        embed_model: str = EMBEDDING_MODEL,
+        to_query: bool = False,
+) -> BaseResponse:
     try:
         if embed_model in list_embed_models():  # 使用本地Embeddings模型
             from server.utils import load_local_embeddings
@@ -40,14 +112,11 @@ def embed_texts(
         return BaseResponse(code=500, msg=f"文本向量化过程中出现错误：{e}")
 
 
-async def aembed_texts(
+async def _aembed_texts(
     texts: List[str],
     embed_model: str = EMBEDDING_MODEL,
     to_query: bool = False,
 ) -> BaseResponse:
-    '''
-    对文本进行向量化。返回数据格式：BaseResponse(data=List[List[float]])
-    '''
     try:
         if embed_model in list_embed_models(): # 使用本地Embeddings模型
             from server.utils import load_local_embeddings
@@ -56,7 +125,7 @@ async def aembed_texts(
             return BaseResponse(data=await embeddings.aembed_documents(texts))
 
         if embed_model in list_online_embed_models(): # 使用在线API
-            return await run_in_threadpool(embed_texts,
+            return await run_in_threadpool(_embed_texts,
                                            texts=texts,
                                            embed_model=embed_model,
                                            to_query=to_query)
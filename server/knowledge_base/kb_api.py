@@ -1,7 +1,7 @@
 import urllib
 from server.utils import BaseResponse, ListResponse
 from server.knowledge_base.utils import validate_kb_name
-from server.knowledge_base.kb_service.base import KBServiceFactory
+from server.knowledge_base.kb_service.base import KBServiceFactory, SupportedVSType
 from server.db.repository.knowledge_base_repository import list_kbs_from_db
 from configs import EMBEDDING_MODEL, logger, log_verbose
 from fastapi import Body
@@ -15,6 +15,8 @@ def list_kbs():
 def create_kb(knowledge_base_name: str = Body(..., examples=["samples"]),
               vector_store_type: str = Body("faiss"),
               embed_model: str = Body(EMBEDDING_MODEL),
+              index_type: str = Body("", description="FAISS 索引类型，为空时使用 FAISS_INDEX_TYPE"),
+              index_params: dict = Body({}, description="FAISS 索引参数"),
               ) -> BaseResponse:
     # Create selected knowledge base
     if not validate_kb_name(knowledge_base_name):
@@ -29,6 +31,8 @@ def create_kb(knowledge_base_name: str = Body(..., examples=["samples"]),
     kb = KBServiceFactory.get_service(knowledge_base_name, vector_store_type, embed_model)
     try:
         kb.create_kb()
+        if index_type and kb.vs_type() == SupportedVSType.FAISS:
+            kb.set_index_type(index_type, index_params)
     except Exception as e:
         msg = f"An error occurred while creating the knowledge base: {e}"
         logger.error(f'{e.__class__.__name__}: {msg}',
@@ -2,12 +2,82 @@ import torch
 from langchain.embeddings.base import Embeddings
 from langchain.vectorstores.faiss import FAISS
 import threading
+import queue
+import time
+from concurrent.futures import Future
 from configs import (EMBEDDING_MODEL, CHUNK_SIZE,
+                     QUERY_EMBED_BATCH_SIZE, QUERY_EMBED_BATCH_WAIT_MS, QUERY_EMBED_QUEUE_SIZE,
                      logger, log_verbose)
 from server.utils import embedding_device, get_model_path, list_online_embed_models
+from server.metrics import observe_lock_wait
 from contextlib import contextmanager
 from collections import OrderedDict
-from typing import List, Any, Union, Tuple
+from typing import List, Any, Union, Tuple, Dict, Literal, Optional
+
+
+class RWLock:
+    '''
+    读写锁：多个读者可以并发持有，写者独占。
+    写者可重入，并可在持有写锁时再获取读锁；读者同样可重入。
+    有写者等待时，新的读者需排队，避免写者饥饿。
+    例外是有快照读者（snapshot=True，如保存向量库时长时间持有读锁）时：写者本就要等快照结束，
+    新的读者不必排在写者之后，检索不会因为一次保存与一个等待中的写入而阻塞数秒。
+    '''
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers: Dict[int, int] = {}  # {thread_id: 重入次数}
+        self._writer = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+        self._snapshots = 0
+
+    def acquire_read(self, snapshot: bool = False):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+            else:
+                while self._writer is not None or (self._writers_waiting and not self._snapshots):
+                    self._cond.wait()
+                self._readers[me] = 1
+            if snapshot:
+                self._snapshots += 1
+
+    def release_read(self, snapshot: bool = False):
+        me = threading.get_ident()
+        with self._cond:
+            if snapshot:
+                self._snapshots -= 1
+            self._readers[me] -= 1
+            if self._readers[me] == 0:
+                del self._readers[me]
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writer_depth -= 1
+            if self._writer_depth == 0:
+                self._writer = None
+                self._cond.notify_all()
+
+    @property
+    def locked(self) -> bool:
+        return self._writer is not None or bool(self._readers)
 
 
 class ThreadSafeObject:
@@ -15,8 +85,10 @@ class ThreadSafeObject:
         self._obj = obj
         self._key = key
         self._pool = pool
-        self._lock = threading.RLock()
+        self._lock = RWLock()
         self._loaded = threading.Event()
+        self._nbytes = None
+        self.access_count = 0
 
     def __repr__(self) -> str:
         cls = type(self).__name__
@@ -27,25 +99,80 @@ class ThreadSafeObject:
         return self._key
 
     @contextmanager
-    def acquire(self, owner: str = "", msg: str = "") -> FAISS:
+    def acquire(self, owner: str = "", msg: str = "", shared: bool = False, snapshot: bool = False) -> FAISS:
+        '''
+        获取对象的使用权。shared=True 时获取共享读锁，可与其它读者（如向量检索）并发；
+        否则获取独占写锁，用于修改对象。
+        snapshot=True 用于长时间持有读锁的操作（如保存），持有期间其它读者不会因等待中的写者而排队。
+        '''
         owner = owner or f"thread {threading.get_native_id()}"
+        start = time.perf_counter()
+        shared = shared or snapshot
+        if shared:
+            self._lock.acquire_read(snapshot=snapshot)
+        else:
+            self._lock.acquire_write()
         try:
-            self._lock.acquire()
+            observe_lock_wait(type(self._pool).__name__ if self._pool is not None else type(self).__name__,
+                              shared, time.perf_counter() - start)
+            self.access_count += 1
             if self._pool is not None:
-                self._pool._cache.move_to_end(self.key)
+                try:
+                    self._pool._cache.move_to_end(self.key)
+                except KeyError:  # 已被移出缓存池
+                    pass
             if log_verbose:
                 logger.info(f"{owner} started the operation: {self.key}. {msg}")
             yield self._obj
         finally:
             if log_verbose:
                 logger.info(f"{owner} ended the operation: {self.key}. {msg}")
-            self._lock.release()
+            if shared:
+                self._lock.release_read(snapshot=snapshot)
+            else:
+                try:
+                    self._refresh_nbytes()  # 对象可能已被修改，在释放写锁前重新估算内存占用
+                finally:
+                    self._lock.release_write()
+                if self._pool is not None and not self._lock.locked:
+                    self._pool._check_count()
+
+    @property
+    def in_use(self) -> bool:
+        return self._lock.locked or not self._loaded.is_set()
+
+    def nbytes(self) -> int:
+        '''
+        对象占用的内存（字节）。估算在持有锁时进行（写操作结束或加载完成时），这里只返回缓存的结果，
+        不会在其它线程修改对象时遍历对象
+        '''
+        return self._nbytes or 0
+
+    def _refresh_nbytes(self):
+        '''
+        重新估算内存占用，需在持有锁时调用。估算失败时保留上一次的结果
+        '''
+        try:
+            self._nbytes = self.estimate_nbytes()
+        except Exception as e:
+            logger.error(f"{e.__class__.__name__}: failed to estimate memory of {self.key}: {e}",
+                         exc_info=e if log_verbose else None)
+
+    def estimate_nbytes(self) -> int:
+        return 0
 
     def start_loading(self):
         self._loaded.clear()
 
     def finish_loading(self):
         self._loaded.set()
+        self._lock.acquire_read()  # 加载时通常已持有写锁，读锁可重入
+        try:
+            self._refresh_nbytes()
+        finally:
+            self._lock.release_read()
+        if self._pool is not None:
+            self._pool._check_count()
 
     def wait_for_loading(self):
         self._loaded.wait()
@@ -60,23 +187,81 @@ class ThreadSafeObject:
 
 
 class CachePool:
-    def __init__(self, cache_num: int = -1):
+    def __init__(
+            self,
+            cache_num: int = -1,
+            max_memory: int = -1,
+            eviction: Literal["lru", "lfu"] = "lru",
+    ):
+        '''
+        cache_num: 最多缓存的对象数量，-1 不限制
+        max_memory: 缓存对象的内存总上限（MB），-1 不限制
+        eviction: 超出限制时的淘汰策略，lru 淘汰最久未使用的对象，lfu 淘汰使用次数最少的对象。
+                  正在使用（被加锁或仍在加载）的对象不会被淘汰。
+        '''
         self._cache_num = cache_num
+        self._max_memory = max_memory * 1024 * 1024 if max_memory and max_memory > 0 else -1
+        self._eviction = eviction
         self._cache = OrderedDict()
         self.atomic = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     def keys(self) -> List[str]:
         return list(self._cache.keys())
 
+    def memory_usage(self) -> int:
+        return sum(getattr(x, "nbytes", lambda: 0)() for x in list(self._cache.values()))
+
+    def _over_limit(self) -> bool:
+        if isinstance(self._cache_num, int) and 0 < self._cache_num < len(self._cache):
+            return True
+        return 0 < self._max_memory < self.memory_usage()
+
+    def _eviction_candidates(self) -> List:
+        # 最近使用的对象始终保留，避免单个超出上限的对象加载后立即被淘汰
+        keys = [k for k, v in list(self._cache.items())[:-1] if not getattr(v, "in_use", False)]
+        if self._eviction == "lfu":  # 使用次数相同时，先淘汰较久未使用的
+            keys.sort(key=lambda k: getattr(self._cache[k], "access_count", 0))
+        return keys
+
+    def _on_evict(self, key: Union[str, Tuple], obj: Any):
+        '''
+        对象被淘汰后调用，子类可在此释放对象持有的后台线程、显存等资源
+        '''
+        pass
+
     def _check_count(self):
-        if isinstance(self._cache_num, int) and self._cache_num > 0:
-            while len(self._cache) > self._cache_num:
-                self._cache.popitem(last=False)
+        with self.atomic:
+            if not self._over_limit():
+                return
+            for key in self._eviction_candidates():
+                obj = self._cache.pop(key, None)
+                self.evictions += 1
+                logger.info(f"{type(self).__name__} evicted {key} from cache")
+                self._on_evict(key, obj)
+                if not self._over_limit():
+                    break
 
     def get(self, key: str) -> ThreadSafeObject:
         if cache := self._cache.get(key):
+            self.hits += 1
             cache.wait_for_loading()
             return cache
+        self.misses += 1
+
+    def stats(self) -> Dict:
+        '''
+        返回缓存池的大小、内存占用及命中/未命中/淘汰计数
+        '''
+        return {
+            "size": len(self._cache),
+            "memory": self.memory_usage(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
 
     def set(self, key: str, obj: ThreadSafeObject) -> ThreadSafeObject:
         self._cache[key] = obj
@@ -89,13 +274,12 @@ class CachePool:
         else:
             return self._cache.pop(key, None)
 
-    def acquire(self, key: Union[str, Tuple], owner: str = "", msg: str = ""):
+    def acquire(self, key: Union[str, Tuple], owner: str = "", msg: str = "", shared: bool = False):
         cache = self.get(key)
         if cache is None:
             raise RuntimeError(f"The requested resource {key} does not exist")
         elif isinstance(cache, ThreadSafeObject):
-            self._cache.move_to_end(key)
-            return cache.acquire(owner=owner, msg=msg)
+            return cache.acquire(owner=owner, msg=msg, shared=shared)
         else:
             return cache
 
@@ -123,7 +307,7 @@ class EmbeddingsPool(CachePool):
         model = model or EMBEDDING_MODEL
         device = embedding_device()
         key = (model, device)
-        if not self.get(key):
+        if not (item := self.get(key)):
             item = ThreadSafeObject(key, pool=self)
             self.set(key, item)
             with item.acquire(msg="初始化"):
@@ -167,7 +351,120 @@ class EmbeddingsPool(CachePool):
                 item.finish_loading()
         else:
             self.atomic.release()
-        return self.get(key).obj
+        return item.obj
 
 
 embeddings_pool = EmbeddingsPool(cache_num=1)
+
+
+class QueryEmbeddingsBatcher:
+    '''
+    查询向量微批处理器。
+    收集同一 (embed_model, device) 下并发的 embed_query 请求，在达到 max_batch_size 或等待超过 max_wait_ms 后，
+    合并为一次 embed_documents 调用，再将结果按顺序分发给各个调用者。
+    '''
+    def __init__(
+            self,
+            key: Tuple[str, str],
+            max_batch_size: int = QUERY_EMBED_BATCH_SIZE,
+            max_wait_ms: float = QUERY_EMBED_BATCH_WAIT_MS,
+            max_queue_size: int = QUERY_EMBED_QUEUE_SIZE,
+    ):
+        self.key = key
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0, max_wait_ms) / 1000
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._stats_lock = threading.Lock()
+        self._batch_sizes: Dict[int, int] = {}  # 批大小直方图：{batch_size: count}
+        self._rejected = 0  # 队列已满、由调用方直接计算的次数
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=f"query-embeddings-batcher-{key[0]}")
+        self._thread.start()
+
+    def __repr__(self) -> str:
+        cls = type(self).__name__
+        return f"<{cls}: key: {self.key}, queue: {self._queue.qsize()}>"
+
+    def submit(self, text: str) -> Optional[Future]:
+        '''
+        提交一条查询文本，返回 Future，其结果为未归一化的向量 List[float]。
+        不会阻塞（可能在事件循环中调用），队列已满时返回 None，由调用方直接计算向量。
+        '''
+        future = Future()
+        try:
+            self._queue.put_nowait((text, future))
+        except queue.Full:
+            with self._stats_lock:
+                self._rejected += 1
+            return None
+        return future
+
+    def _collect(self) -> List[Tuple[str, Future]]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        from server.embeddings_api import embed_texts
+
+        embed_model, _ = self.key
+        while True:
+            batch = self._collect()
+            texts = [text for text, _ in batch]
+            try:
+                resp = embed_texts(texts=texts, embed_model=embed_model, to_query=True)
+                if resp.data is None:
+                    raise RuntimeError(resp.msg)
+                for (_, future), embedding in zip(batch, resp.data):
+                    future.set_result(embedding)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            with self._stats_lock:
+                self._batch_sizes[len(batch)] = self._batch_sizes.get(len(batch), 0) + 1
+            if log_verbose:
+                logger.info(f"{self.key} embedded a batch of {len(batch)} queries")
+
+    def stats(self) -> Dict:
+        '''
+        返回批大小直方图及排队情况
+        '''
+        with self._stats_lock:
+            batch_sizes = dict(sorted(self._batch_sizes.items()))
+            rejected = self._rejected
+        return {
+            "embed_model": self.key[0],
+            "device": self.key[1],
+            "queue_size": self._queue.qsize(),
+            "batches": sum(batch_sizes.values()),
+            "queries": sum(k * v for k, v in batch_sizes.items()),
+            "batch_sizes": batch_sizes,
+            "rejected": rejected,
+        }
+
+
+class QueryEmbeddingsBatcherPool(CachePool):
+    def load_batcher(self, model: str = None, device: str = None) -> QueryEmbeddingsBatcher:
+        model = model or EMBEDDING_MODEL
+        device = embedding_device(device)
+        key = (model, device)
+        with self.atomic:
+            if (batcher := self._cache.get(key)) is None:
+                batcher = self.set(key, QueryEmbeddingsBatcher(key))
+        return batcher
+
+    def stats(self) -> List[Dict]:
+        return [batcher.stats() for batcher in list(self._cache.values())]
+
+
+query_embeddings_batcher_pool = QueryEmbeddingsBatcherPool()
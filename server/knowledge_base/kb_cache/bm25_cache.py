@@ -0,0 +1,231 @@
+import math
+import os
+import pickle
+import re
+import shutil
+import threading
+import unicodedata
+from collections import Counter
+from typing import List, Dict, Tuple, Optional, Callable
+
+from configs import BM25_SAVE_DEBOUNCE, logger, log_verbose
+from server.knowledge_base.kb_cache.base import CachePool, ThreadSafeObject
+from server.knowledge_base.utils import get_kb_path
+
+
+_CJK_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿]+")
+_WORD_RE = re.compile(r"[a-z0-9]+(?:[-_.][a-z0-9]+)*")
+_SUB_WORD_RE = re.compile(r"[a-z0-9]+")
+
+try:
+    import jieba
+    jieba.setLogLevel(60)
+except ImportError:
+    jieba = None
+
+
+def _tokenize_cjk(text: str) -> List[str]:
+    if jieba is not None:
+        return [w for w in jieba.lcut_for_search(text) if w.strip()]
+    # 未安装 jieba 时使用单字 + 二元组，既能匹配单字查询，也能兼顾词序
+    tokens = list(text)
+    tokens += [text[i:i + 2] for i in range(len(text) - 1)]
+    return tokens
+
+
+def tokenize(text: str) -> List[str]:
+    '''
+    中英文混合分词：
+        中文片段使用 jieba 搜索引擎模式分词（未安装时使用单字与二元组）；
+        英文与数字按词切分，保留 "abc-123"、"v1.2.3" 这类型号/错误码的完整形式，同时加入其组成部分。
+    '''
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for segment in _CJK_RE.split(text):
+        for word in _WORD_RE.findall(segment):
+            tokens.append(word)
+            if len(parts := _SUB_WORD_RE.findall(word)) > 1:
+                tokens += parts
+    for segment in _CJK_RE.findall(text):
+        tokens += _tokenize_cjk(segment)
+    return tokens
+
+
+class BM25Index:
+    '''
+    单个知识库的 BM25 倒排索引，文档 id 与向量库中的文本块 id 一致。
+    postings: {term: {doc_id: 词频}}
+    doc_terms: {doc_id: 文档包含的词}，用于删除时定位倒排表
+    doc_len: {doc_id: 文档长度(词数)}
+    '''
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.doc_terms: Dict[str, List[str]] = {}
+        self.doc_len: Dict[str, int] = {}
+        self.total_len = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_len)
+
+    def add(self, ids: List[str], texts: List[str]):
+        for id, text in zip(ids, texts):
+            if id in self.doc_len:
+                self.delete([id])
+            tf = Counter(tokenize(text))
+            for term, n in tf.items():
+                self.postings.setdefault(term, {})[id] = n
+            self.doc_terms[id] = list(tf)
+            self.doc_len[id] = sum(tf.values())
+            self.total_len += self.doc_len[id]
+
+    def delete(self, ids: List[str]):
+        for id in ids:
+            if id not in self.doc_len:
+                continue
+            for term in self.doc_terms.pop(id):
+                posting = self.postings.get(term)
+                if posting is not None:
+                    posting.pop(id, None)
+                    if not posting:
+                        del self.postings[term]
+            self.total_len -= self.doc_len.pop(id)
+
+    def clear(self):
+        self.postings.clear()
+        self.doc_terms.clear()
+        self.doc_len.clear()
+        self.total_len = 0
+
+    def search(self, query: str, top_k: int) -> List[Tuple[str, float]]:
+        '''
+        返回 [(doc_id, BM25 分数)]，分数越大越相关
+        '''
+        n = len(self.doc_len)
+        if n == 0 or top_k <= 0:
+            return []
+        avgdl = self.total_len / n or 1
+        scores: Dict[str, float] = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for id, tf in posting.items():
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[id] / avgdl)
+                scores[id] = scores.get(id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:top_k]
+
+
+def get_bm25_path(kb_name: str) -> str:
+    return os.path.join(get_kb_path(kb_name), "bm25_index")
+
+
+class ThreadSafeBM25(ThreadSafeObject):
+    '''
+    修改索引后延迟 BM25_SAVE_DEBOUNCE 秒保存，期间的多次修改合并为一次写盘
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = get_bm25_path(self.key)
+        self._timer: Optional[threading.Timer] = None
+        self._timer_lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        cls = type(self).__name__
+        return f"<{cls}: key: {self.key}, docs: {len(self._obj or [])}>"
+
+    @property
+    def index_file(self) -> str:
+        return os.path.join(self.path, "index.pkl")
+
+    def estimate_nbytes(self) -> int:
+        # 粗略估算：每条倒排记录约 100 字节
+        return sum(len(x) for x in self._obj.postings.values()) * 100 if self._obj else 0
+
+    def save(self):
+        with self._timer_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        with self.acquire(shared=True, msg="保存") as index:
+            os.makedirs(self.path, exist_ok=True)
+            tmp_file = self.index_file + ".tmp"
+            with open(tmp_file, "wb") as fp:
+                pickle.dump(index, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.index_file)
+        if log_verbose:
+            logger.info(f"saved bm25 index of {self.key}")
+
+    def schedule_save(self):
+        with self._timer_lock:
+            if self._timer is None:
+                self._timer = threading.Timer(BM25_SAVE_DEBOUNCE, self._save_quietly)
+                self._timer.start()
+
+    def _save_quietly(self):
+        try:
+            self.save()
+        except Exception as e:
+            logger.error(f"failed to save bm25 index of {self.key}: {e}", exc_info=e if log_verbose else None)
+
+    def cancel_save(self):
+        with self._timer_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+
+class KBBM25Pool(CachePool):
+    def load_index(
+            self,
+            kb_name: str,
+            docs_count: Callable[[], int] = None,
+            loader: Callable[[], Tuple[List[str], List[str]]] = None,
+    ) -> ThreadSafeBM25:
+        '''
+        加载知识库的 BM25 索引，仅在首次加载时从磁盘读取。
+        索引文件不存在，或索引中的文档数与 docs_count()（数据库中的文本块数）不一致时，
+        调用 loader() 获取 (ids, texts) 重建索引。
+        '''
+        self.atomic.acquire()
+        if not (item := self.get(kb_name)):
+            item = ThreadSafeBM25(kb_name, pool=self)
+            self.set(kb_name, item)
+            with item.acquire(msg="初始化"):
+                self.atomic.release()
+                index = None
+                if os.path.isfile(item.index_file):
+                    try:
+                        with open(item.index_file, "rb") as fp:
+                            index = pickle.load(fp)
+                    except Exception as e:
+                        logger.error(f"failed to load bm25 index of {kb_name}, rebuilding: {e}")
+                rebuild = index is None or (docs_count is not None and len(index) != docs_count())
+                if rebuild:
+                    index = BM25Index()
+                    if loader is not None:
+                        try:
+                            ids, texts = loader()
+                            index.add(ids, texts)
+                        except Exception as e:
+                            logger.error(f"failed to rebuild bm25 index of {kb_name}: {e}",
+                                         exc_info=e if log_verbose else None)
+                    logger.info(f"rebuilt bm25 index of {kb_name} with {len(index)} docs")
+                item.obj = index
+                item.finish_loading()
+            if rebuild:
+                item.schedule_save()
+        else:
+            self.atomic.release()
+        return item
+
+    def drop_index(self, kb_name: str):
+        with self.atomic:
+            if item := self.pop(kb_name):
+                item.cancel_save()
+        shutil.rmtree(get_bm25_path(kb_name), ignore_errors=True)
+
+
+kb_bm25_pool = KBBM25Pool()
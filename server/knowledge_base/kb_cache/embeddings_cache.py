@@ -0,0 +1,249 @@
+import atexit
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+from configs import (EMBEDDING_CACHE_MAX_SIZE, EMBEDDING_CACHE_PATH,
+                     logger, log_verbose)
+from server.knowledge_base.kb_cache.base import CachePool
+
+
+KEY_SIZE = 16  # blake2b 摘要长度（字节）
+FORMAT_VERSION = 2
+FLUSH_INTERVAL = 5  # 写入后延迟落盘的时间（秒），多次写入合并为一次 msync
+
+
+def normalize_text(text: str) -> str:
+    return unicodedata.normalize("NFC", text).strip()
+
+
+def make_cache_key(embed_model: str, text: str, to_query: bool = False) -> bytes:
+    '''
+    以 (embed_model, 归一化后的文本, to_query) 计算内容哈希，作为向量缓存的键
+    '''
+    h = hashlib.blake2b(digest_size=KEY_SIZE)
+    h.update(embed_model.encode("utf-8"))
+    h.update(b"\0query\0" if to_query else b"\0doc\0")
+    h.update(normalize_text(text).encode("utf-8"))
+    return h.digest()
+
+
+def _checksum(key: bytes, vector: np.ndarray) -> int:
+    h = hashlib.blake2b(key, digest_size=8)
+    h.update(np.ascontiguousarray(vector, dtype=np.float32).tobytes())
+    return int.from_bytes(h.digest(), "little")
+
+
+class EmbeddingsCache:
+    '''
+    基于内存映射文件的向量缓存，每个 Embedding 模型一个目录：
+        meta.json:   {"dim": int, "capacity": int, "version": int}
+        keys.bin:    (capacity, KEY_SIZE) uint8，全零表示空槽位
+        ticks.bin:   (capacity,) int64，最近访问序号，用于重启后恢复 LRU 顺序
+        vectors.bin: (capacity, dim) float32
+        sums.bin:    (capacity,) uint64，键与向量的校验和
+    向量维度在第一次写入时确定，容量由 max_size(MB) 换算得到，写满后淘汰最久未访问的条目。
+    多个进程（如 API 服务与 init_database.py）可能同时写入同一缓存，读取时校验槽位中的键与校验和，
+    被其它进程覆盖或只写了一半的槽位视为未命中。写入不立即落盘，由后台定时 flush 合并。
+    '''
+    def __init__(self, embed_model: str, path: str = None, max_size: int = EMBEDDING_CACHE_MAX_SIZE):
+        self.embed_model = embed_model
+        self.path = path or os.path.join(EMBEDDING_CACHE_PATH, re.sub(r"[^\w.-]", "_", embed_model))
+        self.max_size = max_size
+        self.dim = None
+        self.capacity = 0
+        self._keys = None
+        self._ticks = None
+        self._vectors = None
+        self._sums = None
+        self._index = OrderedDict()  # {key: slot}，按访问先后排列，最早的在前
+        self._free = []
+        self._tick = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self._flush_timer = None
+        if os.path.isfile(self._meta_file):
+            try:
+                with open(self._meta_file) as fp:
+                    meta = json.load(fp)
+                self._open(meta["dim"])
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: failed to load embeddings cache from {self.path}: {e}",
+                             exc_info=e if log_verbose else None)
+                self._reset()
+
+    def __repr__(self) -> str:
+        cls = type(self).__name__
+        return f"<{cls}: embed_model: {self.embed_model}, size: {len(self)}/{self.capacity}>"
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @property
+    def _meta_file(self) -> str:
+        return os.path.join(self.path, "meta.json")
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _reset(self):
+        self.dim = None
+        self.capacity = 0
+        self._keys = self._ticks = self._vectors = self._sums = None
+        self._index.clear()
+        self._free = []
+        self._tick = 0
+        for name in ["meta.json", "keys.bin", "ticks.bin", "vectors.bin", "sums.bin"]:
+            if os.path.isfile(self._file(name)):
+                os.remove(self._file(name))
+
+    def _open(self, dim: int):
+        '''
+        打开（或创建）内存映射文件。若已有文件的维度或容量与当前配置不符，则丢弃重建。
+        '''
+        capacity = max(1, self.max_size * 1024 * 1024 // (dim * 4 + KEY_SIZE + 16))
+        meta = {"dim": dim, "capacity": capacity, "version": FORMAT_VERSION}
+        exists = os.path.isfile(self._meta_file)
+        if exists:
+            with open(self._meta_file) as fp:
+                if json.load(fp) != meta:
+                    logger.info(f"embeddings cache {self.path} does not match current settings, rebuilding.")
+                    self._reset()
+                    exists = False
+
+        os.makedirs(self.path, exist_ok=True)
+        mode = "r+" if exists else "w+"
+        self._keys = np.memmap(self._file("keys.bin"), dtype=np.uint8, mode=mode, shape=(capacity, KEY_SIZE))
+        self._ticks = np.memmap(self._file("ticks.bin"), dtype=np.int64, mode=mode, shape=(capacity,))
+        self._vectors = np.memmap(self._file("vectors.bin"), dtype=np.float32, mode=mode, shape=(capacity, dim))
+        self._sums = np.memmap(self._file("sums.bin"), dtype=np.uint64, mode=mode, shape=(capacity,))
+        if not exists:
+            with open(self._meta_file, "w") as fp:
+                json.dump(meta, fp)
+        self.dim = dim
+        self.capacity = capacity
+
+        used = np.flatnonzero(self._keys.any(axis=1))
+        order = used[np.argsort(self._ticks[used], kind="stable")]
+        self._index = OrderedDict((self._keys[i].tobytes(), int(i)) for i in order)
+        self._free = sorted(set(range(capacity)) - set(used.tolist()), reverse=True)
+        self._tick = int(self._ticks[used].max()) if len(used) else 0
+        logger.info(f"embeddings cache for {self.embed_model} loaded with {len(self._index)} entries.")
+
+    def _touch(self, slot: int):
+        self._tick += 1
+        self._ticks[slot] = self._tick
+
+    def get_many(self, keys: List[bytes]) -> List[Optional[List[float]]]:
+        '''
+        批量查询，未命中的位置返回 None
+        '''
+        result = []
+        with self._lock:
+            for key in keys:
+                slot = self._index.get(key)
+                if slot is None:
+                    self.misses += 1
+                    result.append(None)
+                    continue
+                vector = np.array(self._vectors[slot])
+                if self._keys[slot].tobytes() != key or int(self._sums[slot]) != _checksum(key, vector):
+                    # 槽位已被其它进程改写，或写入不完整
+                    del self._index[key]
+                    self.misses += 1
+                    result.append(None)
+                    continue
+                self.hits += 1
+                self._index.move_to_end(key)
+                self._touch(slot)
+                result.append(vector.tolist())
+        return result
+
+    def set_many(self, keys: List[bytes], embeddings: List[List[float]]):
+        if not keys:
+            return
+        with self._lock:
+            dim = len(embeddings[0])
+            if self.dim is None:
+                self._open(dim)
+            elif self.dim != dim:  # 同名模型的向量维度发生了变化，丢弃旧缓存
+                self._reset()
+                self._open(dim)
+
+            slots = []
+            for key in keys:
+                if (slot := self._index.get(key)) is not None:
+                    self._index.move_to_end(key)
+                elif self._free:
+                    slot = self._free.pop()
+                else:
+                    _, slot = self._index.popitem(last=False)
+                self._index[key] = slot
+                slots.append(slot)
+            slots = np.array(slots)
+            vectors = np.asarray(embeddings, dtype=np.float32)
+            self._vectors[slots] = vectors
+            self._keys[slots] = np.frombuffer(b"".join(keys), dtype=np.uint8).reshape(-1, KEY_SIZE)
+            self._sums[slots] = np.array([_checksum(key, vector) for key, vector in zip(keys, vectors)],
+                                         dtype=np.uint64)
+            for slot in slots:
+                self._touch(int(slot))
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(FLUSH_INTERVAL, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self):
+        '''
+        将内存映射文件的修改落盘。进程退出前由 atexit 调用一次
+        '''
+        with self._lock:
+            self._flush_timer = None
+            arrays = [x for x in [self._vectors, self._keys, self._sums, self._ticks] if x is not None]
+        # msync 不需要持有锁，期间的查询与写入不受影响
+        for array in arrays:
+            array.flush()
+
+    def clear(self):
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._keys = self._ticks = self._vectors = self._sums = None
+            self._reset()
+
+
+class EmbeddingsCachePool(CachePool):
+    def load_cache(self, embed_model: str) -> EmbeddingsCache:
+        with self.atomic:
+            if (cache := self._cache.get(embed_model)) is None:
+                cache = self.set(embed_model, EmbeddingsCache(embed_model))
+        return cache
+
+    def flush(self):
+        for cache in list(self._cache.values()):
+            try:
+                cache.flush()
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: failed to flush embeddings cache {cache.path}: {e}",
+                             exc_info=e if log_verbose else None)
+
+    def stats(self) -> List[dict]:
+        return [{"embed_model": c.embed_model, "size": len(c), "capacity": c.capacity,
+                 "hits": c.hits, "misses": c.misses}
+                for c in list(self._cache.values())]
+
+
+embeddings_cache_pool = EmbeddingsCachePool()
+atexit.register(embeddings_cache_pool.flush)
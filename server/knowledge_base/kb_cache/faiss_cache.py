@@ -1,12 +1,24 @@
-from configs import CACHED_VS_NUM, CACHED_MEMO_VS_NUM
+from configs import (CACHED_VS_NUM, CACHED_MEMO_VS_NUM,
+                     CACHED_VS_MEMORY, CACHED_MEMO_VS_MEMORY, CACHED_VS_EVICTION,
+                     FAISS_ASYNC_SAVE, FAISS_SAVE_DEBOUNCE, FAISS_SAVE_MAX_OPS, FAISS_INDEX_TYPE,
+                     FAISS_HNSW_TOMBSTONE_RATIO)
 from server.knowledge_base.kb_cache.base import *
 from server.knowledge_base.kb_service.base import EmbeddingsFunAdapter
+from server.metrics import registry, pool_metrics
+from server.knowledge_base.kb_cache.faiss_index import (new_index, index_type_of, train_threshold,
+                                                        train_index, reconstruct_labels, get_index_params)
 from server.utils import load_local_embeddings
 from server.knowledge_base.utils import get_vs_path
 from langchain.vectorstores.faiss import FAISS
 from langchain.docstore.in_memory import InMemoryDocstore
 from langchain.schema import Document
 import os
+import pickle
+import itertools
+import struct
+import uuid
+import numpy as np
+from typing import Dict, List, Optional, Set, Tuple
 from langchain.schema import Document
 
 
@@ -23,6 +35,29 @@ InMemoryDocstore.search = _new_ds_search
 
 
 class ThreadSafeFaiss(ThreadSafeObject):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._save_lock = threading.Lock()
+        self.vs_path = None  # 设置后启用预写日志(WAL)与后台持久化
+        self._wal_lock = threading.Lock()
+        self._dirty = threading.Condition()
+        self._pending_ops = 0
+        self._last_op_time = 0.0
+        self._persist_thread = None
+        self._persist_stopped = False  # 向量库目录即将被删除，不再写入快照与预写日志
+        self._source_index: Optional[Dict[str, Set[str]]] = None  # {归一化的 source: {doc id}}
+        self._source_index_size = 0
+        self.index_type = FAISS_INDEX_TYPE  # 目标索引类型，向量数满足训练条件后自动重建为该类型
+        self.index_params = {}
+        self._rebuild_lock = threading.Lock()
+        self._rebuilding = False
+        self._rebuild_log: Optional[List[Tuple]] = None  # 重建索引期间的增删，替换索引时重放到新索引上
+        # 索引标签（检索返回的编号）相关的状态，均在第一次使用时由 index_to_docstore_id 生成，替换索引后重置
+        self._labels: Optional[Dict[str, int]] = None  # {doc id: 标签}
+        self._next_label: Optional[int] = None  # IVF 索引下一个可用的标签
+        self._tombstones: Optional[Set[int]] = None  # HNSW 索引中已删除、仅做了标记的标签
+        self._selector = None  # 排除 _tombstones 的 IDSelector，检索时使用
+
     def __repr__(self) -> str:
         cls = type(self).__name__
         return f"<{cls}: key: {self.key}, obj: {self._obj}, docs_count: {self.docs_count()}>"
@@ -30,20 +65,451 @@ class ThreadSafeFaiss(ThreadSafeObject):
     def docs_count(self) -> int:
         return len(self._obj.docstore._dict)
 
+    def estimate_nbytes(self) -> int:
+        '''
+        估算向量库的内存占用：索引编码大小 + docstore 中的文本与元数据
+        '''
+        if self._obj is None:
+            return 0
+        index = self._obj.index
+        try:
+            code_size = index.sa_code_size()
+        except Exception:
+            code_size = index.d * 4
+        # 文档数量较多时按抽样的平均大小估算，避免每次写入后遍历整个 docstore
+        docs = self._obj.docstore._dict
+        sample = list(itertools.islice(docs.values(), 1000))
+        docs_size = sum(len(doc.page_content.encode("utf-8")) + len(str(doc.metadata)) + 200  # 200: 对象本身的开销
+                        for doc in sample)
+        if sample:
+            docs_size = docs_size * len(docs) // len(sample)
+        return index.ntotal * code_size + docs_size
+
+    @staticmethod
+    def normalize_source(source: Optional[str]) -> str:
+        return (source or "").replace("\\", "/").lower()
+
+    def _build_source_index(self):
+        self._source_index = {}
+        self._source_index_size = 0
+        for id, doc in self._obj.docstore._dict.items():
+            self._index_source(id, doc.metadata.get("source"))
+
+    def _index_source(self, id: str, source: Optional[str]):
+        ids = self._source_index.setdefault(self.normalize_source(source), set())
+        if id not in ids:
+            ids.add(id)
+            self._source_index_size += 1
+
+    def index_sources(self, ids: List[str], metadatas: List[Dict]):
+        '''
+        新增文档后更新 source -> ids 索引，需在持有写锁时调用
+        '''
+        if self._source_index is None:
+            return
+        for id, metadata in zip(ids, metadatas):
+            self._index_source(id, (metadata or {}).get("source"))
+
+    def unindex_ids(self, ids: List[str], docs: List[Document]):
+        '''
+        删除文档后更新 source -> ids 索引，docs 为被删除的文档，需在持有写锁时调用
+        '''
+        if self._source_index is None:
+            return
+        for id, doc in zip(ids, docs):
+            if doc is None:
+                continue
+            key = self.normalize_source(doc.metadata.get("source"))
+            if (source_ids := self._source_index.get(key)) and id in source_ids:
+                source_ids.remove(id)
+                self._source_index_size -= 1
+                if not source_ids:
+                    del self._source_index[key]
+
+    def ids_by_source(self, source: str) -> List[str]:
+        '''
+        返回指定文件的所有文档 id，需在持有写锁时调用。
+        索引在第一次使用时建立；若有绕过索引直接修改 docstore 的情况（数量不一致），则重建索引。
+        '''
+        if self._source_index is None or self._source_index_size != len(self._obj.docstore._dict):
+            self._build_source_index()
+        return list(self._source_index.get(self.normalize_source(source), []))
+
+    def add_embeddings(self, texts: List[str], embeddings: List[List[float]],
+                       metadatas: List[Dict], ids: List[str] = None) -> List[str]:
+        '''
+        添加向量并同步 source 索引，需在持有写锁时调用
+        '''
+        import faiss
+
+        vs = self._obj
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        if len(ids) != len(set(ids)):
+            raise ValueError("Duplicate ids found in the ids list.")
+        vectors = np.array(embeddings, dtype=np.float32)
+        if vs._normalize_L2:
+            faiss.normalize_L2(vectors)
+        vs.docstore.add({id: Document(page_content=text, metadata=metadata or {})
+                         for id, text, metadata in zip(ids, texts, metadatas)})
+        self._index_add(ids, vectors)
+        self.index_sources(ids, metadatas)
+        if self._rebuild_log is not None:
+            self._rebuild_log.append(("add", ids, vectors))
+        return ids
+
+    def delete(self, ids: List[str]):
+        '''
+        删除向量并同步 source 索引，需在持有写锁时调用
+        '''
+        labels = self._get_labels()
+        if missing := [id for id in ids if id not in labels]:
+            raise ValueError(f"Some specified ids do not exist in the current store. Ids not found: {missing}")
+        docs = [self._obj.docstore._dict.get(id) for id in ids]
+        self._index_remove(ids)
+        self._obj.docstore.delete(ids)
+        self.unindex_ids(ids, docs)
+        if self._rebuild_log is not None:
+            self._rebuild_log.append(("delete", ids, None))
+
+    def _get_labels(self) -> Dict[str, int]:
+        # 与 source 索引相同，数量不一致说明有绕过 ThreadSafeFaiss 的修改，重新生成
+        if self._labels is None or len(self._labels) != len(self._obj.index_to_docstore_id):
+            self._labels = {id: label for label, id in self._obj.index_to_docstore_id.items()}
+        return self._labels
+
+    def _get_tombstones(self) -> Set[int]:
+        if self._tombstones is None:
+            index = self._obj.index
+            if index_type_of(index) == "hnsw" and index.ntotal > len(self._obj.index_to_docstore_id):
+                self._tombstones = set(range(index.ntotal)).difference(self._obj.index_to_docstore_id)
+            else:
+                self._tombstones = set()
+        return self._tombstones
+
+    def _reset_labels(self):
+        self._labels = None
+        self._next_label = None
+        self._tombstones = None
+        self._selector = None
+
+    def _index_add(self, ids: List[str], vectors: np.ndarray):
+        '''
+        将向量加入索引并记录标签，不修改 docstore。
+        flat 与 HNSW 按加入顺序编号；IVF 删除向量后编号不再连续，使用递增的标签通过 add_with_ids 加入
+        '''
+        vs = self._obj
+        index = vs.index
+        if index_type_of(index).startswith("ivf"):
+            if self._next_label is None:
+                self._next_label = max(vs.index_to_docstore_id, default=-1) + 1
+            start = self._next_label
+            index.add_with_ids(vectors, np.arange(start, start + len(ids), dtype=np.int64))
+            self._next_label += len(ids)
+        else:
+            start = index.ntotal
+            index.add(vectors)
+        new_labels = dict(zip(range(start, start + len(ids)), ids))
+        vs.index_to_docstore_id.update(new_labels)
+        if self._labels is not None:
+            self._labels.update((id, label) for label, id in new_labels.items())
+
+    def _index_remove(self, ids: List[str]):
+        '''
+        从索引中删除向量，不修改 docstore。
+        IVF 的 remove_ids 不改变其余向量的标签，只需删除对应的映射；HNSW 不支持删除，仅将标签标记为已删除，
+        检索时排除，已删除的比例超过 FAISS_HNSW_TOMBSTONE_RATIO 后由 maybe_rebuild 在后台重建；
+        flat 索引删除后其余向量按位置重新编号，与 FAISS.delete 相同
+        '''
+        vs = self._obj
+        index = vs.index
+        labels = self._get_labels()
+        removed = [labels.pop(id) for id in ids]
+        for label in removed:
+            del vs.index_to_docstore_id[label]
+        if not vs.index_to_docstore_id:  # 已全部删除，直接清空索引（保留训练结果）
+            index.reset()
+            self._reset_labels()
+            return
+
+        index_type = index_type_of(index)
+        if index_type.startswith("ivf"):
+            index.remove_ids(np.array(removed, dtype=np.int64))
+        elif index_type == "hnsw":
+            self._get_tombstones().update(removed)
+            self._selector = None
+        else:
+            index.remove_ids(np.array(removed, dtype=np.int64))
+            vs.index_to_docstore_id = dict(enumerate(id for _, id in sorted(vs.index_to_docstore_id.items())))
+            self._labels = None
+
+    def id_selector(self):
+        '''
+        返回排除 HNSW 索引中已删除向量的 IDSelector，没有已删除的向量时返回 None，需在持有读锁时调用
+        '''
+        import faiss
+
+        if self._obj.index.ntotal == len(self._obj.index_to_docstore_id):
+            return None
+        if self._selector is None:
+            removed = np.array(sorted(self._get_tombstones()), dtype=np.int64)
+            batch = faiss.IDSelectorBatch(len(removed), faiss.swig_ptr(removed))
+            selector = faiss.IDSelectorNot(batch)
+            selector.batch = batch  # IDSelectorNot 不持有 batch 的引用
+            self._selector = selector
+        return self._selector
+
+    def set_index_config(self, index_type: str, index_params: Dict = None):
+        self.index_type = index_type
+        self.index_params = get_index_params(index_type, index_params)
+
+    def needs_rebuild(self) -> bool:
+        '''
+        向量数满足目标类型的训练条件，或 HNSW 索引中已删除的向量超过 FAISS_HNSW_TOMBSTONE_RATIO 时需要重建
+        '''
+        index = self._obj.index
+        count = len(self._obj.index_to_docstore_id)
+        if index_type_of(index) != self.index_type and count >= train_threshold(self.index_type, self.index_params):
+            return True
+        return index.ntotal - count > FAISS_HNSW_TOMBSTONE_RATIO * index.ntotal
+
+    def rebuild_index(self, force: bool = False) -> bool:
+        '''
+        将索引重建为目标类型，返回是否重建。
+        向量提取、训练和添加都在锁外进行，只在最后替换索引时获取写锁；
+        期间的增删记录在 _rebuild_log 中，替换时只将这些修改重放到新索引上。
+        force=True 时即使类型相同也重建（如修改了 nlist 等参数），但向量数不足以训练时仍不重建。
+        向量数不足以训练目标类型、但 HNSW 索引中已删除的向量过多时，按当前类型重建以清理已删除的向量。
+        '''
+        with self._rebuild_lock:
+            with self.acquire(shared=True, msg="extract vectors") as vs:
+                if not (force or self.needs_rebuild()):
+                    return False
+                index_type, index_params = self.index_type, self.index_params
+                if len(vs.index_to_docstore_id) < train_threshold(index_type, index_params):
+                    if vs.index.ntotal == len(vs.index_to_docstore_id):
+                        return False
+                    index_type, index_params = index_type_of(vs.index), {}
+                labels = np.array(sorted(vs.index_to_docstore_id), dtype=np.int64)
+                ids = [vs.index_to_docstore_id[label] for label in labels]
+                vectors = reconstruct_labels(vs.index, labels)
+                dim = vs.index.d
+                # 持有读锁时没有写入，此后的增删都会被记录
+                self._rebuild_log = []
+
+            try:
+                index = new_index(index_type, dim, index_params)
+                train_index(index, vectors, index_params)
+                index.add(vectors)
+                index_to_docstore_id = dict(enumerate(ids))
+                labels = {id: label for label, id in index_to_docstore_id.items()}
+
+                with self.acquire(msg="swap index") as vs:
+                    log, self._rebuild_log = self._rebuild_log, None
+                    vs.index = index
+                    vs.index_to_docstore_id = index_to_docstore_id
+                    self._reset_labels()
+                    self._labels = labels
+                    for op, op_ids, op_vectors in log:
+                        if op == "add":
+                            self._index_add(op_ids, op_vectors)
+                        else:
+                            self._index_remove(op_ids)
+            finally:
+                self._rebuild_log = None
+            logger.info(f"rebuilt index of vector library {self.key} as {index_type} "
+                        f"with {index.ntotal} vectors")
+
+        if self.vs_path is not None:
+            if FAISS_ASYNC_SAVE:
+                self.schedule_save()
+            else:
+                self.save(self.vs_path)
+        return True
+
+    def maybe_rebuild(self):
+        '''
+        向量数达到训练条件时，在后台线程中将索引重建为目标类型
+        '''
+        with self._dirty:
+            if self._rebuilding or not self.needs_rebuild():
+                return
+            self._rebuilding = True
+
+        def rebuild():
+            try:
+                self.rebuild_index()
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: failed to rebuild index of vector library {self.key}: {e}",
+                             exc_info=e if log_verbose else None)
+            finally:
+                self._rebuilding = False
+
+        threading.Thread(target=rebuild, daemon=True, name=f"faiss-rebuild-{self.key}").start()
+
     def save(self, path: str, create_path: bool = True):
-        with self.acquire():
+        '''
+        在共享读锁（快照模式）下将索引与 docstore 序列化到内存，随后释放锁再写入磁盘。
+        序列化期间即使有写入在等待，新的向量检索也不必排队。文件先写入临时文件再原子替换，避免中断时损坏已有向量库。
+        快照写入后，截断预写日志中已包含在快照内的部分。
+        '''
+        import faiss
+
+        with self._save_lock:
+            if self._persist_stopped:
+                return
+            with self.acquire(snapshot=True, msg="snapshot") as vs:
+                index_bytes = faiss.serialize_index(vs.index)
+                docstore_bytes = pickle.dumps((vs.docstore, vs.index_to_docstore_id))
+                wal_pos = self._wal_size()
+                with self._dirty:
+                    self._pending_ops = 0
+
             if not os.path.isdir(path) and create_path:
                 os.makedirs(path)
-            ret = self._obj.save_local(path)
+            for name, data in [("index.faiss", index_bytes.tobytes()), ("index.pkl", docstore_bytes)]:
+                tmp_file = os.path.join(path, f".{name}.tmp")
+                with open(tmp_file, "wb") as fp:
+                    fp.write(data)
+                os.replace(tmp_file, os.path.join(path, name))
+            if self.vs_path is not None and os.path.abspath(path) == os.path.abspath(self.vs_path):
+                self._truncate_wal(wal_pos)
             logger.info(f"The vector library {self.key} has been saved to disk")
-        return ret
+
+    @property
+    def wal_file(self) -> str:
+        return os.path.join(self.vs_path, "index.wal")
+
+    def _wal_size(self) -> int:
+        if self.vs_path is not None and os.path.isfile(self.wal_file):
+            return os.path.getsize(self.wal_file)
+        return 0
+
+    def _truncate_wal(self, pos: int):
+        '''
+        丢弃预写日志中 pos 之前（已写入快照）的记录，保留快照之后追加的记录
+        '''
+        with self._wal_lock:
+            if not os.path.isfile(self.wal_file):
+                return
+            with open(self.wal_file, "rb") as fp:
+                fp.seek(pos)
+                rest = fp.read()
+            if rest:
+                tmp_file = self.wal_file + ".tmp"
+                with open(tmp_file, "wb") as fp:
+                    fp.write(rest)
+                os.replace(tmp_file, self.wal_file)
+            else:
+                os.remove(self.wal_file)
+
+    def append_wal(self, op: str, **data):
+        '''
+        追加一条预写日志记录，需在持有写锁时调用以保证与修改顺序一致。
+        op 为 "add"(ids, texts, embeddings, metadatas) 或 "delete"(ids)
+        '''
+        if self.vs_path is None or self._persist_stopped:
+            return
+        record = pickle.dumps((op, data))
+        with self._wal_lock:
+            with open(self.wal_file, "ab") as fp:
+                fp.write(struct.pack("<Q", len(record)))
+                fp.write(record)
+                fp.flush()
+                os.fsync(fp.fileno())
+
+    def replay_wal(self) -> int:
+        '''
+        将预写日志中的修改重放到已加载的向量库上，返回重放的记录数。
+        重放是幂等的：已存在的 id 不会重复添加，不存在的 id 删除时被忽略。末尾不完整的记录将被忽略。
+        '''
+        if self.vs_path is None or not os.path.isfile(self.wal_file):
+            return 0
+        count = 0
+        vs = self._obj
+        with open(self.wal_file, "rb") as fp:
+            while len(header := fp.read(8)) == 8:
+                size, = struct.unpack("<Q", header)
+                record = fp.read(size)
+                if len(record) < size:
+                    break
+                op, data = pickle.loads(record)
+                if op == "add":
+                    items = [x for x in zip(data["ids"], data["texts"], data["embeddings"], data["metadatas"])
+                             if x[0] not in vs.docstore._dict]
+                    if items:
+                        ids, texts, embeddings, metadatas = map(list, zip(*items))
+                        self.add_embeddings(texts, embeddings, metadatas, ids=ids)
+                elif op == "delete":
+                    ids = [x for x in data["ids"] if x in vs.docstore._dict]
+                    if ids:
+                        self.delete(ids)
+                count += 1
+        if count:
+            logger.info(f"replayed {count} write-ahead log records for vector library {self.key}")
+        return count
+
+    def schedule_save(self, ops: int = 1):
+        '''
+        记录一次修改，由后台线程在最后一次修改后 FAISS_SAVE_DEBOUNCE 秒、
+        或累计修改达到 FAISS_SAVE_MAX_OPS 次时写入快照
+        '''
+        if self.vs_path is None or self._persist_stopped:
+            return
+        with self._dirty:
+            self._pending_ops += ops
+            self._last_op_time = time.monotonic()
+            if self._persist_thread is None:
+                self._persist_thread = threading.Thread(target=self._persist_worker, daemon=True,
+                                                        name=f"faiss-persist-{self.key}")
+                self._persist_thread.start()
+            self._dirty.notify()
+
+    def _persist_worker(self):
+        while True:
+            with self._dirty:
+                while self._pending_ops == 0 and not self._persist_stopped:
+                    self._dirty.wait()
+                while self._pending_ops < FAISS_SAVE_MAX_OPS and not self._persist_stopped:
+                    remain = self._last_op_time + FAISS_SAVE_DEBOUNCE - time.monotonic()
+                    if remain <= 0:
+                        break
+                    self._dirty.wait(remain)
+                if self._persist_stopped:
+                    self._persist_thread = None
+                    return
+            # 已被移出缓存池（清空或淘汰）的向量库不再保存，其修改已记录在预写日志中
+            if self._pool is None or self._pool._cache.get(self.key) is not self:
+                logger.info(f"vector library {self.key} is no longer cached, stop persisting.")
+                with self._dirty:
+                    self._persist_thread = None
+                return
+            try:
+                self.save(self.vs_path, create_path=False)
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: failed to save vector library {self.key}: {e}",
+                             exc_info=e if log_verbose else None)
+                time.sleep(FAISS_SAVE_DEBOUNCE)
+
+    def stop_persist(self):
+        '''
+        等待正在写入的快照完成并丢弃尚未执行的保存，此后不再写入快照与预写日志。
+        删除向量库目录前调用，避免后台线程在目录删除后又写入旧数据
+        '''
+        with self._save_lock:
+            with self.acquire(msg="stop persist"):
+                with self._dirty:
+                    self._persist_stopped = True
+                    self._pending_ops = 0
+                    self._dirty.notify()
 
     def clear(self):
         ret = []
         with self.acquire():
             ids = list(self._obj.docstore._dict.keys())
             if ids:
-                ret = self._obj.delete(ids)
+                self.delete(ids)
+                ret = True
                 assert len(self._obj.docstore._dict) == 0
             logger.info(f"The vector library {self.key} has been cleared")
         return ret
@@ -80,12 +546,15 @@ class KBFaissPool(_FaissPool):
             create: bool = True,
             embed_model: str = EMBEDDING_MODEL,
             embed_device: str = embedding_device(),
+            index_type: str = FAISS_INDEX_TYPE,
+            index_params: Dict = None,
     ) -> ThreadSafeFaiss:
         self.atomic.acquire()
         vector_name = vector_name or embed_model
         cache = self.get((kb_name, vector_name)) # 用元组比拼接字符串好一些
         if cache is None:
             item = ThreadSafeFaiss((kb_name, vector_name), pool=self)
+            item.set_index_config(index_type, index_params)
             self.set((kb_name, vector_name), item)
             with item.acquire(msg="初始化"):
                 self.atomic.release()
@@ -104,10 +573,16 @@ class KBFaissPool(_FaissPool):
                 else:
                     raise RuntimeError(f"knowledge base {kb_name} not exist.")
                 item.obj = vector_store
+                item.vs_path = vs_path
+                if replayed := item.replay_wal():
+                    item.schedule_save(replayed)
+                item._build_source_index()
                 item.finish_loading()
+            item.maybe_rebuild()
         else:
             self.atomic.release()
-        return self.get((kb_name, vector_name))
+            item = cache
+        return item
 
 
 class MemoFaissPool(_FaissPool):
@@ -131,11 +606,20 @@ class MemoFaissPool(_FaissPool):
                 item.finish_loading()
         else:
             self.atomic.release()
-        return self.get(kb_name)
+            item = cache
+        return item
 
 
-kb_faiss_pool = KBFaissPool(cache_num=CACHED_VS_NUM)
-memo_faiss_pool = MemoFaissPool(cache_num=CACHED_MEMO_VS_NUM)
+kb_faiss_pool = KBFaissPool(cache_num=CACHED_VS_NUM,
+                            max_memory=CACHED_VS_MEMORY,
+                            eviction=CACHED_VS_EVICTION)
+memo_faiss_pool = MemoFaissPool(cache_num=CACHED_MEMO_VS_NUM,
+                                max_memory=CACHED_MEMO_VS_MEMORY,
+                                eviction=CACHED_VS_EVICTION)
+# 在 /metrics 中输出各缓存池的大小、内存占用与命中情况
+registry.add_collector(lambda: pool_metrics({"kb_faiss_pool": kb_faiss_pool,
+                                             "memo_faiss_pool": memo_faiss_pool,
+                                             "embeddings_pool": embeddings_pool}))
 
 
 if __name__ == "__main__":
@@ -156,7 +640,8 @@ if __name__ == "__main__":
             if r == 1: # add docs
                 ids = vs.add_texts([f"text added by {name}"], embeddings=embeddings)
                 pprint(ids)
-            elif r == 2: # search docs
+        with kb_faiss_pool.load_vector_store(vs_name).acquire(name, shared=True) as vs:
+            if r == 2: # search docs
                 docs = vs.similarity_search_with_score(f"{name}", k=3, score_threshold=1.0)
                 pprint(docs)
         if r == 3: # delete docs
@@ -0,0 +1,150 @@
+import copy
+from typing import Dict
+
+import numpy as np
+
+from configs import FAISS_INDEX_PARAMS
+from langchain.vectorstores.faiss import FAISS
+
+
+SUPPORTED_INDEX_TYPES = ["flat", "ivf_flat", "ivf_pq", "hnsw"]
+
+
+def get_index_params(index_type: str, index_params: Dict = None) -> Dict:
+    '''
+    以配置中的默认参数为基础，合并知识库单独指定的参数
+    '''
+    return {**FAISS_INDEX_PARAMS.get(index_type, {}), **(index_params or {})}
+
+
+def new_index(index_type: str, dim: int, index_params: Dict = None):
+    '''
+    创建指定类型的空索引（尚未训练）。
+    向量均已归一化，与 FAISS.from_documents 默认创建的 IndexFlatL2 一样使用 L2 距离，保持分数含义不变。
+    '''
+    import faiss
+
+    params = get_index_params(index_type, index_params)
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dim)
+    elif index_type == "ivf_flat":
+        index = faiss.index_factory(dim, f"IVF{params['nlist']},Flat", faiss.METRIC_L2)
+        faiss.extract_index_ivf(index).nprobe = params["nprobe"]
+    elif index_type == "ivf_pq":
+        index = faiss.index_factory(dim, f"IVF{params['nlist']},PQ{params['m']}x{params['nbits']}", faiss.METRIC_L2)
+        faiss.extract_index_ivf(index).nprobe = params["nprobe"]
+    elif index_type == "hnsw":
+        # 直接构造而不是 downcast index_factory 的返回值：downcast 得到的对象不持有底层索引，临时对象释放后即失效
+        index = faiss.IndexHNSWFlat(dim, params["M"], faiss.METRIC_L2)
+        index.hnsw.efConstruction = params["efConstruction"]
+        index.hnsw.efSearch = params["efSearch"]
+    else:
+        raise ValueError(f"unsupported faiss index type: {index_type}")
+    return index
+
+
+def index_type_of(index) -> str:
+    import faiss
+
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    elif isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    elif isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+def train_threshold(index_type: str, index_params: Dict = None) -> int:
+    '''
+    训练索引所需的最少向量数，不需要训练的索引返回 0
+    '''
+    params = get_index_params(index_type, index_params)
+    if index_type.startswith("ivf"):
+        return params.get("train_size") or params["nlist"] * 39
+    return 0
+
+
+def train_index(index, vectors: np.ndarray, index_params: Dict = None):
+    '''
+    使用向量训练索引。向量较多时按 nlist * 256 抽样训练，避免训练时间随知识库线性增长
+    '''
+    if index.is_trained:
+        return
+    params = get_index_params(index_type_of(index), index_params)
+    sample_size = params.get("train_size") or params["nlist"] * 256
+    if len(vectors) > sample_size:
+        rng = np.random.default_rng(0)
+        vectors = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+    index.train(vectors)
+
+
+def reconstruct_labels(index, labels: np.ndarray) -> np.ndarray:
+    '''
+    按标签（检索返回的编号）取回向量（PQ 索引为有损重建）。
+    IVF 索引删除向量后标签不再连续，借助哈希表形式的 direct map 按标签重建
+    '''
+    import faiss
+
+    labels = np.asarray(labels, dtype=np.int64)
+    if len(labels) == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    if not index_type_of(index).startswith("ivf"):
+        return index.reconstruct_n(0, index.ntotal)[labels]
+    index = faiss.clone_index(index)  # set_direct_map_type 会修改索引，在副本上执行以免影响并发检索
+    faiss.extract_index_ivf(index).set_direct_map_type(faiss.DirectMap.Hashtable)
+    if hasattr(index, "reconstruct_batch"):
+        return index.reconstruct_batch(labels)
+    return np.vstack([index.reconstruct(int(label)) for label in labels])
+
+
+def search_parameters(index, search_params: Dict = None, sel=None):
+    '''
+    将请求中的 nprobe / efSearch 转换为 faiss 的 SearchParameters，不适用于当前索引时返回 None。
+    sel 为 faiss.IDSelector，用于在 HNSW 索引中排除已删除（仅做了标记）的向量
+    '''
+    import faiss
+
+    search_params = search_params or {}
+    index_type = index_type_of(index)
+    if index_type.startswith("ivf") and search_params.get("nprobe"):
+        params = faiss.SearchParametersIVF()
+        params.nprobe = int(search_params["nprobe"])
+        return params
+    elif index_type == "hnsw" and (search_params.get("efSearch") or sel is not None):
+        params = faiss.SearchParametersHNSW()
+        # 传入 SearchParameters 时 efSearch 不再取索引上的设置，未指定时沿用索引的默认值
+        params.efSearch = int(search_params.get("efSearch") or faiss.downcast_index(index).hnsw.efSearch)
+        if sel is not None:
+            params.sel = sel
+        return params
+    return None
+
+
+class _ParamsIndex:
+    '''
+    为 index.search 附加 SearchParameters 的代理，其余属性转发给原索引。
+    检索参数随请求传递而不修改共享索引，并发检索互不影响。
+    '''
+    def __init__(self, index, params, sel=None):
+        self._index = index
+        self._params = params
+        self._sel = sel  # SearchParameters 不持有 IDSelector 的引用，检索期间需保持其存活
+
+    def search(self, x, k):
+        return self._index.search(x, k, params=self._params)
+
+    def __getattr__(self, name):
+        return getattr(self._index, name)
+
+
+def with_search_params(vs: FAISS, search_params: Dict = None, sel=None) -> FAISS:
+    '''
+    返回使用指定检索参数的 FAISS 浅拷贝（共享 docstore 与索引）
+    '''
+    if (params := search_parameters(vs.index, search_params, sel=sel)) is None:
+        return vs
+    vs = copy.copy(vs)
+    vs.index = _ParamsIndex(vs.index, params, sel)
+    return vs
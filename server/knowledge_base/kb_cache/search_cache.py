@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+from configs import SEARCH_RESULT_CACHE_SIZE, SEARCH_RESULT_CACHE_TTL, QUERY_EMBEDDING_CACHE_SIZE
+
+
+class LRUCache:
+    '''
+    线程安全的内存 LRU 缓存，max_size <= 0 时不缓存；ttl > 0 时条目超过 ttl 秒后失效
+    '''
+    def __init__(self, max_size: int, ttl: float = 0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache: OrderedDict = OrderedDict()  # {key: (value, 写入时间)}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            if (item := self._cache.get(key)) is not None:
+                value, created = item
+                if self.ttl > 0 and time.monotonic() - created > self.ttl:
+                    del self._cache[key]
+                    value = None
+            else:
+                value = None
+            if value is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._cache[key] = (value, time.monotonic())
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def discard(self, predicate: Callable[[Hashable], bool]):
+        '''
+        移除键满足 predicate 的全部条目
+        '''
+        with self._lock:
+            for key in [k for k in self._cache if predicate(k)]:
+                del self._cache[key]
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> Dict:
+        return {"size": len(self._cache), "hits": self.hits, "misses": self.misses}
+
+
+# 检索结果缓存：{(知识库名称, 知识库内容版本, embed_model, query, top_k, score_threshold, search_mode, 其它检索参数): [(Document, score)]}
+# 版本号仅在当前进程内递增，其它进程（如 init_database.py）修改知识库后由 TTL 兜底失效
+search_result_cache = LRUCache(SEARCH_RESULT_CACHE_SIZE, ttl=SEARCH_RESULT_CACHE_TTL)
+# 查询向量缓存：{(embed_model, query): 归一化后的向量}
+query_embedding_cache = LRUCache(QUERY_EMBEDDING_CACHE_SIZE)
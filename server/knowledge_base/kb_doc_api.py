@@ -1,22 +1,27 @@
 import os
+import threading
 import urllib
 from fastapi import File, Form, Body, Query, UploadFile
 from configs import (DEFAULT_VS_TYPE, EMBEDDING_MODEL,
                      VECTOR_SEARCH_TOP_K, SCORE_THRESHOLD,
-                     CHUNK_SIZE, OVERLAP_SIZE, ZH_TITLE_ENHANCE,
+                     CHUNK_SIZE, OVERLAP_SIZE, ZH_TITLE_ENHANCE, DEFAULT_SEARCH_MODE,
                      logger, log_verbose, )
 from server.utils import BaseResponse, ListResponse, run_in_thread_pool
 from server.knowledge_base.utils import (validate_kb_name, list_files_from_folder, get_file_path,
-                                         files2docs_in_thread, KnowledgeFile)
+                                         files2docs_in_thread, KnowledgeFile,
+                                         get_file_hash, save_file_stream, commit_saved_file)
 from fastapi.responses import FileResponse
 from sse_starlette import EventSourceResponse
 from pydantic import Json
 import json
-from server.knowledge_base.kb_service.base import KBServiceFactory
-from server.db.repository.knowledge_file_repository import get_file_detail
+from server.knowledge_base.kb_service.base import KBServiceFactory, SupportedVSType
+from server.knowledge_base.kb_pipeline import IngestPipeline
+from server.knowledge_base.kb_cache.faiss_index import SUPPORTED_INDEX_TYPES
+from server.db.repository.knowledge_file_repository import get_file_detail, get_file_name_by_hash
 from langchain.docstore.document import Document
 from server.knowledge_base.model.kb_document_model import DocumentWithVSId
-from typing import List, Dict
+from server.metrics import set_endpoint, get_endpoint, span, instrument_stream
+from typing import List, Dict, Literal
 
 
 def search_docs(
@@ -30,12 +35,16 @@ def search_docs(
                                       ge=0, le=1),
         file_name: str = Body("", description="文件名称，支持 sql 通配符"),
         metadata: dict = Body({}, description="根据 metadata 进行过滤，仅支持一级键"),
+        search_params: dict = Body({}, description="FAISS 检索参数，如 {\"nprobe\": 32} 或 {\"efSearch\": 128}"),
+        search_mode: Literal["vector", "bm25", "hybrid"] = Body(DEFAULT_SEARCH_MODE,
+                                                               description="检索方式：vector 向量检索，bm25 关键词检索，"
+                                                                           "hybrid 两者融合。bm25 与 hybrid 的分数越大越相关"),
 ) -> List[DocumentWithVSId]:
     kb = KBServiceFactory.get_service_by_name(knowledge_base_name)
     data = []
     if kb is not None:
         if query:
-            docs = kb.search_docs(query, top_k, score_threshold)
+            docs = kb.search_docs(query, top_k, score_threshold, search_mode=search_mode, search_params=search_params)
             data = [DocumentWithVSId(**x[0].dict(), score=x[1], id=x[0].metadata.get("id")) for x in docs]
         elif file_name or metadata:
             data = kb.list_docs(file_name=file_name, metadata=metadata)
@@ -81,37 +90,52 @@ def _save_files_in_thread(files: List[UploadFile],
                           override: bool):
     """
     通过多线程将上传的文件保存到对应知识库目录内。
+    上传内容分块写入临时文件并计算 sha256，写完后原子地替换目标文件，不会将整个文件读入内存。
+    与知识库中已入库的文件（或本次上传的其它文件）内容完全相同的文件不再保存，data 中 duplicate_of 为相同的文件名。
     生成器返回保存结果：{"code":200, "msg": "xxx", "data": {"knowledge_base_name":"xxx", "file_name": "xxx"}}
     """
+    seen_hashes = {}  # {sha256: 文件名}，本次上传中内容相同的文件只保存第一个
+    seen_lock = threading.Lock()
 
     def save_file(file: UploadFile, knowledge_base_name: str, override: bool) -> dict:
         '''
         保存单个文件。
         '''
+        tmp_path = None
         try:
             filename = file.filename
             file_path = get_file_path(knowledge_base_name=knowledge_base_name, doc_name=filename)
             data = {"knowledge_base_name": knowledge_base_name, "file_name": filename}
 
-            file_content = file.file.read()  # 读取上传文件的内容
+            tmp_path, file_hash = save_file_stream(file.file, file_path)
+            with seen_lock:
+                duplicate_of = seen_hashes.setdefault(file_hash, filename)
+            if duplicate_of == filename:
+                duplicate_of = get_file_name_by_hash(kb_name=knowledge_base_name, file_hash=file_hash)
+            if duplicate_of and (duplicate_of != filename or not override):
+                file_status = f"The file {filename} already exists in the knowledge base as {duplicate_of}."
+                logger.warn(file_status)
+                return dict(code=404, msg=file_status, data={**data, "duplicate_of": duplicate_of})
+
             if (os.path.isfile(file_path)
                     and not override
-                    and os.path.getsize(file_path) == len(file_content)
+                    and get_file_hash(file_path) == file_hash
             ):
                 file_status = f"The file {filename} already exists."
                 logger.warn(file_status)
                 return dict(code=404, msg=file_status, data=data)
 
-            if not os.path.isdir(os.path.dirname(file_path)):
-                os.makedirs(os.path.dirname(file_path))
-            with open(file_path, "wb") as f:
-                f.write(file_content)
+            commit_saved_file(tmp_path, file_path, file_hash)
+            tmp_path = None
             return dict(code=200, msg=f"成功上传文件 {filename}", data=data)
         except Exception as e:
             msg = f"{filename} upload failed, the error message is: {e}"
             logger.error(f'{e.__class__.__name__}: {msg}',
                          exc_info=e if log_verbose else None)
             return dict(code=500, msg=msg, data=data)
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
 
     params = [{"file": file, "knowledge_base_name": knowledge_base_name, "override": override} for file in files]
     for result in run_in_thread_pool(save_file, params=params):
@@ -153,17 +177,20 @@ def upload_docs(
     if kb is None:
         return BaseResponse(code=404, msg=f"未找到知识库 {knowledge_base_name}")
 
+    set_endpoint("upload_docs")
     failed_files = {}
     file_names = list(docs.keys())
 
     # 先将上传的文件保存到磁盘
-    for result in _save_files_in_thread(files, knowledge_base_name=knowledge_base_name, override=override):
-        filename = result["data"]["file_name"]
-        if result["code"] != 200:
-            failed_files[filename] = result["msg"]
+    with span("save_files"):
+        for result in _save_files_in_thread(files, knowledge_base_name=knowledge_base_name, override=override):
+            filename = result["data"]["file_name"]
+            if result["code"] != 200:
+                failed_files[filename] = result["msg"]
 
-        if filename not in file_names:
-            file_names.append(filename)
+            # 与已有文件内容完全相同的文件不再重复入库
+            if filename not in file_names and not result["data"].get("duplicate_of"):
+                file_names.append(filename)
 
     # 对保存的文件进行向量化
     if to_vector_store:
@@ -176,10 +203,12 @@ def upload_docs(
             zh_title_enhance=zh_title_enhance,
             docs=docs,
             not_refresh_vs_cache=True,
+            incremental=False,
         )
         failed_files.update(result.data["failed_files"])
         if not not_refresh_vs_cache:
-            kb.save_vector_store()
+            with span("save_vector_store"):
+                kb.save_vector_store()
 
     return BaseResponse(code=200, msg="文件上传与向量化完成", data={"failed_files": failed_files})
 
@@ -198,6 +227,7 @@ def delete_docs(
     if kb is None:
         return BaseResponse(code=404, msg=f"未找到知识库 {knowledge_base_name}")
 
+    set_endpoint("delete_docs")
     failed_files = {}
     for file_name in file_names:
         if not kb.exist_doc(file_name):
@@ -214,7 +244,8 @@ def delete_docs(
             failed_files[file_name] = msg
 
     if not not_refresh_vs_cache:
-        kb.save_vector_store()
+        with span("save_vector_store"):
+            kb.save_vector_store()
 
     return BaseResponse(code=200, msg=f"文件删除完成", data={"failed_files": failed_files})
 
@@ -234,6 +265,41 @@ def update_info(
     return BaseResponse(code=200, msg=f"知识库介绍修改完成", data={"kb_info": kb_info})
 
 
+def update_index(
+        knowledge_base_name: str = Body(..., description="知识库名称", examples=["samples"]),
+        index_type: str = Body(..., description="索引类型", examples=SUPPORTED_INDEX_TYPES),
+        index_params: dict = Body({}, description="索引参数，未指定的使用 FAISS_INDEX_PARAMS 中的默认值",
+                                  examples=[{"nlist": 4096, "nprobe": 32}]),
+):
+    '''
+    修改 FAISS 知识库的索引类型，已有向量库将就地重建
+    '''
+    if not validate_kb_name(knowledge_base_name):
+        return BaseResponse(code=403, msg="Don't attack me")
+
+    kb = KBServiceFactory.get_service_by_name(knowledge_base_name)
+    if kb is None:
+        return BaseResponse(code=404, msg=f"未找到知识库 {knowledge_base_name}")
+    if kb.vs_type() != SupportedVSType.FAISS:
+        return BaseResponse(code=404, msg=f"知识库 {knowledge_base_name} 不是 FAISS 知识库，不支持修改索引类型")
+    if index_type not in SUPPORTED_INDEX_TYPES:
+        return BaseResponse(code=404, msg=f"不支持的索引类型 {index_type}，可选：{SUPPORTED_INDEX_TYPES}")
+
+    try:
+        rebuilt = kb.set_index_type(index_type, index_params)
+    except Exception as e:
+        msg = f"修改知识库 {knowledge_base_name} 的索引类型时出错：{e}"
+        logger.error(f'{e.__class__.__name__}: {msg}',
+                     exc_info=e if log_verbose else None)
+        return BaseResponse(code=500, msg=msg)
+
+    if rebuilt:
+        msg = f"知识库索引已重建为 {index_type}"
+    else:
+        msg = f"知识库索引类型已修改为 {index_type}，向量数达到训练要求后将自动重建"
+    return BaseResponse(code=200, msg=msg, data={"index_type": index_type, "rebuilt": rebuilt})
+
+
 def update_docs(
         knowledge_base_name: str = Body(..., description="知识库名称", examples=["samples"]),
         file_names: List[str] = Body(..., description="文件名称，支持多文件", examples=[["file_name1", "text.txt"]]),
@@ -244,6 +310,7 @@ def update_docs(
         docs: Json = Body({}, description="自定义的docs，需要转为json字符串",
                           examples=[{"test.txt": [Document(page_content="custom doc")]}]),
         not_refresh_vs_cache: bool = Body(False, description="暂不保存向量库（用于FAISS）"),
+        incremental: bool = Body(False, description="增量更新：跳过未修改的文件，仅向量化有变化的文本块"),
 ) -> BaseResponse:
     """
     更新知识库文档
@@ -255,7 +322,9 @@ def update_docs(
     if kb is None:
         return BaseResponse(code=404, msg=f"未找到知识库 {knowledge_base_name}")
 
+    set_endpoint(get_endpoint() or "update_docs")  # 由 upload_docs 调用时记入 upload_docs
     failed_files = {}
+    skipped_files = []
     kb_files = []
 
     # 生成需要加载docs的文件列表
@@ -266,7 +335,12 @@ def update_docs(
             continue
         if file_name not in docs:
             try:
-                kb_files.append(KnowledgeFile(filename=file_name, knowledge_base_name=knowledge_base_name))
+                kb_file = KnowledgeFile(filename=file_name, knowledge_base_name=knowledge_base_name)
+                # 增量模式下略过内容未变化的文件
+                if incremental and kb_file.file_exist() and not kb.is_file_modified(kb_file):
+                    skipped_files.append(file_name)
+                    continue
+                kb_files.append(kb_file)
             except Exception as e:
                 msg = f"An error occurred while loading the document {file_name}: {e}"
                 logger.error(f'{e.__class__.__name__}: {msg}',
@@ -274,37 +348,36 @@ def update_docs(
                 failed_files[file_name] = msg
 
     # 从文件生成docs，并进行向量化。
-    # 这里利用了KnowledgeFile的缓存功能，在多线程中加载Document，然后传给KnowledgeFile
-    for status, result in files2docs_in_thread(kb_files,
-                                               chunk_size=chunk_size,
-                                               chunk_overlap=chunk_overlap,
-                                               zh_title_enhance=zh_title_enhance):
-        if status:
-            kb_name, file_name, new_docs = result
-            kb_file = KnowledgeFile(filename=file_name,
-                                    knowledge_base_name=knowledge_base_name)
-            kb_file.splited_docs = new_docs
-            kb.update_doc(kb_file, not_refresh_vs_cache=True)
-        else:
-            kb_name, file_name, error = result
-            failed_files[file_name] = error
+    # 加载、切分、向量化与写入向量库在流水线中并行进行
+    pipeline = IngestPipeline(kb, kb_files,
+                              mode="incremental" if incremental else "update",
+                              chunk_size=chunk_size,
+                              chunk_overlap=chunk_overlap,
+                              zh_title_enhance=zh_title_enhance)
+    with span("ingest"):
+        for event in pipeline.run():
+            if event["code"] != 200:
+                failed_files[event["doc"]] = event["msg"]
 
     # 将自定义的docs进行向量化
-    for file_name, v in docs.items():
-        try:
-            v = [x if isinstance(x, Document) else Document(**x) for x in v]
-            kb_file = KnowledgeFile(filename=file_name, knowledge_base_name=knowledge_base_name)
-            kb.update_doc(kb_file, docs=v, not_refresh_vs_cache=True)
-        except Exception as e:
-            msg = f"An error occurred while adding custom docs for {file_name}: {e}"
-            logger.error(f'{e.__class__.__name__}: {msg}',
-                         exc_info=e if log_verbose else None)
-            failed_files[file_name] = msg
+    with span("custom_docs"):
+        for file_name, v in docs.items():
+            try:
+                v = [x if isinstance(x, Document) else Document(**x) for x in v]
+                kb_file = KnowledgeFile(filename=file_name, knowledge_base_name=knowledge_base_name)
+                kb.update_doc(kb_file, docs=v, not_refresh_vs_cache=True)
+            except Exception as e:
+                msg = f"An error occurred while adding custom docs for {file_name}: {e}"
+                logger.error(f'{e.__class__.__name__}: {msg}',
+                             exc_info=e if log_verbose else None)
+                failed_files[file_name] = msg
 
     if not not_refresh_vs_cache:
-        kb.save_vector_store()
+        with span("save_vector_store"):
+            kb.save_vector_store()
 
-    return BaseResponse(code=200, msg=f"更新文档完成", data={"failed_files": failed_files})
+    return BaseResponse(code=200, msg=f"更新文档完成", data={"failed_files": failed_files,
+                                                             "skipped_files": skipped_files})
 
 
 def download_doc(
@@ -373,34 +446,28 @@ def recreate_vector_store(
                 kb.clear_vs()
             kb.create_kb()
             files = list_files_from_folder(knowledge_base_name)
-            kb_files = [(file, knowledge_base_name) for file in files]
-            i = 0
-            for status, result in files2docs_in_thread(kb_files,
-                                                       chunk_size=chunk_size,
-                                                       chunk_overlap=chunk_overlap,
-                                                       zh_title_enhance=zh_title_enhance):
-                if status:
-                    kb_name, file_name, docs = result
-                    kb_file = KnowledgeFile(filename=file_name, knowledge_base_name=kb_name)
-                    kb_file.splited_docs = docs
-                    yield json.dumps({
-                        "code": 200,
-                        "msg": f"({i + 1} / {len(files)}): {file_name}",
-                        "total": len(files),
-                        "finished": i + 1,
-                        "doc": file_name,
-                    }, ensure_ascii=False)
-                    kb.add_doc(kb_file, not_refresh_vs_cache=True)
-                else:
-                    kb_name, file_name, error = result
-                    msg = f"An error occurred while adding the file ‘{file_name}’ to the knowledge base ‘{knowledge_base_name}’: {error}. Skipped."
+            kb_files = []
+            for file in files:
+                try:
+                    kb_files.append(KnowledgeFile(filename=file, knowledge_base_name=knowledge_base_name))
+                except Exception as e:
+                    msg = f"An error occurred while adding the file ‘{file}’ to the knowledge base ‘{knowledge_base_name}’: {e}. Skipped."
                     logger.error(msg)
                     yield json.dumps({
                         "code": 500,
                         "msg": msg,
                     })
-                i += 1
+            # 每个文件在加载、切分、向量化、写入各阶段完成时都会返回一条进度，stage 字段表示所处阶段
+            pipeline = IngestPipeline(kb, kb_files,
+                                      mode="add",
+                                      chunk_size=chunk_size,
+                                      chunk_overlap=chunk_overlap,
+                                      zh_title_enhance=zh_title_enhance)
+            with span("ingest", endpoint="recreate_vector_store"):
+                for event in pipeline.run():
+                    yield json.dumps(event, ensure_ascii=False)
             if not not_refresh_vs_cache:
-                kb.save_vector_store()
+                with span("save_vector_store", endpoint="recreate_vector_store"):
+                    kb.save_vector_store()
 
-    return EventSourceResponse(output())
+    return EventSourceResponse(instrument_stream(output(), "recreate_vector_store"))
@@ -0,0 +1,374 @@
+import queue
+import threading
+import time
+from typing import List, Dict, Generator, Literal, Optional, Tuple
+
+from configs import (CHUNK_SIZE, OVERLAP_SIZE, ZH_TITLE_ENHANCE,
+                     INGEST_LOADER_WORKERS, INGEST_SPLITTER_WORKERS,
+                     INGEST_EMBED_BATCH_SIZE, INGEST_QUEUE_SIZE, EMBEDDING_CACHE_ENABLED,
+                     PARSE_IN_PROCESS_POOL, PARSE_PROCESS_WORKERS,
+                     logger, log_verbose)
+from server.embeddings_api import embed_texts
+from server.metrics import span
+from server.knowledge_base.kb_service.base import KBService, SupportedVSType
+from server.knowledge_base.utils import KnowledgeFile
+from text_splitter import zh_title_enhance as func_zh_title_enhance
+from langchain.docstore.document import Document
+
+
+_DONE = object()  # 队列结束标记
+
+
+class _FileState:
+    '''
+    一个文件在流水线中的状态。文件按段（KnowledgeFile.iter_doc_parts）加载、切分，
+    向量化阶段按文本块跨文件组批，全部分段切分完成且文本块都已向量化后交给写入阶段
+    '''
+    def __init__(self, kb_file: KnowledgeFile):
+        self.kb_file = kb_file
+        self.parts: Dict[int, List[Document]] = {}  # {分段序号: 切分后的文本块}
+        self.part_embeddings: Dict[int, List[Optional[List[float]]]] = {}
+        self.n_parts: Optional[int] = None  # 加载完成后才知道分段数
+        self.splited_parts = 0
+        self.n_chunks = 0
+        self.split_done = False
+        self.remaining = 0  # 尚未向量化的文本块数
+        self.error = None
+
+    @property
+    def docs(self) -> List[Document]:
+        return [doc for i in sorted(self.parts) for doc in self.parts[i]]
+
+    @property
+    def embeddings(self) -> List[Optional[List[float]]]:
+        return [x for i in sorted(self.parts) for x in self.part_embeddings.get(i, [None] * len(self.parts[i]))]
+
+
+class IngestPipeline:
+    '''
+    分阶段的知识库入库流水线：
+        加载(多线程) -> 切分(多线程) -> 跨文件批量向量化 -> 写入向量库
+    各阶段之间以有界队列连接，下游处理不过来时上游阻塞（背压），
+    向量化阶段持续从多个文件中凑满固定大小的批次，不会因为单个大文件或写入向量库而空闲。
+    文件按段在加载、切分、向量化阶段之间传递，大文件的前面部分在后续页面仍在解析时即可切分与向量化，
+    写入阶段仍以文件为单位。
+
+    mode:
+        add: 添加文件（对应 kb.add_doc）
+        update: 更新文件（对应 kb.update_doc）
+        incremental: 增量更新（对应 kb.update_doc_incremental），由其自行向量化新增的文本块，跳过向量化阶段
+
+    run() 为生成器，逐个返回进度事件：
+        {"code": 200 | 500, "stage": "load" | "split" | "embed" | "write", "doc": 文件名, "msg": str,
+         "total": 文件总数, "finished": 已写入的文件数, "stages": {各阶段已完成的文件数}}
+    '''
+    stages = ["load", "split", "embed", "write"]
+
+    def __init__(
+            self,
+            kb: KBService,
+            kb_files: List[KnowledgeFile],
+            mode: Literal["add", "update", "incremental"] = "update",
+            chunk_size: int = CHUNK_SIZE,
+            chunk_overlap: int = OVERLAP_SIZE,
+            zh_title_enhance: bool = ZH_TITLE_ENHANCE,
+            loader_workers: int = INGEST_LOADER_WORKERS,
+            splitter_workers: int = INGEST_SPLITTER_WORKERS,
+            embed_batch_size: int = INGEST_EMBED_BATCH_SIZE,
+            queue_size: int = INGEST_QUEUE_SIZE,
+    ):
+        self.kb = kb
+        self.kb_files = kb_files
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.zh_title_enhance = zh_title_enhance
+        if PARSE_IN_PROCESS_POOL:
+            # 加载与切分都在进程池中完成，加载线程只负责提交任务并等待结果，数量与子进程数一致即可充分利用进程池
+            loader_workers = max(loader_workers, PARSE_PROCESS_WORKERS)
+        self.loader_workers = max(1, min(loader_workers, len(kb_files)))
+        self.splitter_workers = max(1, splitter_workers)
+        self.embed_batch_size = max(1, embed_batch_size)
+        # 增量更新只向量化新增的文本块，由 update_doc_incremental 完成；
+        # 其它向量库在 do_add_doc 中自行向量化，仅在有向量缓存可复用本阶段结果时才预先向量化
+        self.pre_embed = mode != "incremental" and (kb.vs_type() == SupportedVSType.FAISS
+                                                    or EMBEDDING_CACHE_ENABLED)
+
+        self._files = queue.Queue()
+        for kb_file in kb_files:
+            self._files.put(kb_file)
+        self._loaded = queue.Queue(maxsize=queue_size)
+        self._splited = queue.Queue(maxsize=queue_size)
+        self._embedded = queue.Queue(maxsize=queue_size)
+        self._events = queue.Queue()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._counts = {stage: 0 for stage in self.stages}
+        self._running = {}  # {stage: 仍在运行的线程数}，最后一个线程退出时通知下游结束
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        '''
+        带背压的入队，流水线被中止时返回 False
+        '''
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q: queue.Queue, timeout: float = None):
+        '''
+        出队，流水线被中止时返回 _DONE；timeout 不为 None 时超时抛出 queue.Empty
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._stop.is_set():
+            if deadline is None:
+                wait = 0.1
+            elif (wait := min(0.1, deadline - time.monotonic())) <= 0:
+                return q.get_nowait()
+            try:
+                return q.get(timeout=wait)
+            except queue.Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise
+        return _DONE
+
+    def _emit(self, stage: str, kb_file: KnowledgeFile, msg: str = "", error: bool = False):
+        with self._lock:
+            if not error:
+                self._counts[stage] += 1
+            event = {
+                "code": 500 if error else 200,
+                "stage": stage,
+                "doc": kb_file.filename,
+                "msg": msg,
+                "total": len(self.kb_files),
+                "finished": self._counts["write"],
+                "stages": dict(self._counts),
+            }
+        if error:
+            logger.error(msg)
+        self._events.put(event)
+
+    def _fail(self, stage: str, kb_file: KnowledgeFile, e: Exception):
+        msg = (f"An error occurred while adding the file ‘{kb_file.filename}’ to the knowledge base "
+               f"‘{self.kb.kb_name}’ at stage {stage}: {e}. Skipped.")
+        if log_verbose:
+            logger.error(f"{e.__class__.__name__}: {msg}", exc_info=e)
+        self._emit(stage, kb_file, msg, error=True)
+
+    def _worker_exit(self, stage: str, downstream: queue.Queue, downstream_workers: int):
+        with self._lock:
+            self._running[stage] -= 1
+            last = self._running[stage] == 0
+        if last:
+            for _ in range(downstream_workers):
+                self._put(downstream, _DONE)
+
+    def _iter_parts(self, kb_file: KnowledgeFile) -> Generator[Tuple[List[Document], bool], None, None]:
+        '''
+        返回 (文档, 是否已切分)。进程池模式下在子进程中一次完成加载与切分
+        '''
+        if PARSE_IN_PROCESS_POOL:
+            yield kb_file.file2text(zh_title_enhance=self.zh_title_enhance,
+                                    chunk_size=self.chunk_size,
+                                    chunk_overlap=self.chunk_overlap), True
+        else:
+            for part in kb_file.iter_doc_parts():
+                yield part, False
+
+    def _load_worker(self):
+        try:
+            while not self._stop.is_set():
+                try:
+                    kb_file = self._files.get_nowait()
+                except queue.Empty:
+                    break
+                state = _FileState(kb_file)
+                n = 0
+                parts = self._iter_parts(kb_file)
+                try:
+                    while True:
+                        with span("load", endpoint="ingest"):
+                            item = next(parts, None)
+                        if item is None:
+                            break
+                        if not self._put(self._loaded, (state, n, *item)):
+                            return
+                        n += 1
+                except Exception as e:
+                    state.error = str(e)
+                    self._fail("load", kb_file, e)
+                else:
+                    self._emit("load", kb_file, f"已加载 {kb_file.filename}")
+                # 结束标记：告知切分阶段该文件的分段数
+                if not self._put(self._loaded, (state, n, None, False)):
+                    return
+        finally:
+            self._worker_exit("load", self._loaded, self.splitter_workers)
+
+    def _part_splited(self, state: _FileState, n_parts: int = None) -> bool:
+        '''
+        记录一个分段切分完成（或设置文件的分段数），返回文件的全部分段是否都已切分
+        '''
+        with self._lock:
+            if n_parts is None:
+                state.splited_parts += 1
+            else:
+                state.n_parts = n_parts
+            return state.n_parts is not None and state.splited_parts == state.n_parts
+
+    def _split_worker(self):
+        try:
+            while (item := self._get(self._loaded)) is not _DONE:
+                state, i, docs, splited = item
+                kb_file = state.kb_file
+                if docs is None:
+                    done = self._part_splited(state, n_parts=i)
+                else:
+                    if state.error is None:
+                        try:
+                            with span("split", endpoint="ingest"):
+                                if not splited:
+                                    docs = kb_file.split_docs(docs,
+                                                              chunk_size=self.chunk_size,
+                                                              chunk_overlap=self.chunk_overlap)
+                                    # 标题增强在各分段内进行
+                                    if docs and self.zh_title_enhance:
+                                        docs = func_zh_title_enhance(docs)
+                                self.kb._docs_source_to_relpath(docs)
+                            with self._lock:
+                                state.n_chunks += len(docs)
+                            # 先送出分段再计数，保证文件的结束标记排在其所有分段之后
+                            if not self._put(self._splited, (state, i, docs)):
+                                break
+                        except Exception as e:
+                            state.error = str(e)
+                            self._fail("split", kb_file, e)
+                    done = self._part_splited(state)
+                if done and state.error is None:
+                    self._emit("split", kb_file, f"已切分 {kb_file.filename}，共 {state.n_chunks} 条文档")
+                    if not self._put(self._splited, (state, None, None)):
+                        break
+        finally:
+            self._worker_exit("split", self._splited, 1)
+
+    def _embed_batch(self, batch: List[tuple]) -> List[_FileState]:
+        '''
+        向量化一批 (file_state, 分段序号, 文本块序号)，返回已全部切分且所有文本块都已完成的文件
+        '''
+        texts = [state.parts[i][j].page_content for state, i, j in batch]
+        try:
+            with span("embed", endpoint="ingest"):
+                result = embed_texts(texts=texts, embed_model=self.kb.embed_model, to_query=False)
+            error = None if result.code == 200 else result.msg
+        except Exception as e:
+            error = str(e)
+        finished = []
+        for k, (state, i, j) in enumerate(batch):
+            if error:
+                state.error = state.error or error
+            else:
+                state.part_embeddings[i][j] = result.data[k]
+            state.remaining -= 1
+            if state.remaining == 0 and state.split_done:
+                finished.append(state)
+        return finished
+
+    def _embed_finished(self, state: _FileState) -> bool:
+        if state.error:
+            self._fail("embed", state.kb_file, state.error)
+            return True
+        self._emit("embed", state.kb_file, f"已向量化 {state.kb_file.filename}" if self.pre_embed else "")
+        return self._put(self._embedded, state)
+
+    def _embed_worker(self):
+        '''
+        跨文件组批：输入充足时凑满 embed_batch_size 再向量化；上游暂时没有新文件时立即处理已有的文本块，避免空等
+        '''
+        pending = []  # [(file_state, 分段序号, 文本块序号)]
+        upstream_done = False
+        try:
+            while not self._stop.is_set() and (pending or not upstream_done):
+                if not upstream_done and len(pending) < self.embed_batch_size:
+                    try:
+                        item = self._get(self._splited, timeout=0 if pending else None)
+                    except queue.Empty:
+                        item = None
+                    if item is _DONE:
+                        upstream_done = True
+                    elif item is not None:
+                        state, i, docs = item
+                        if i is None:  # 文件的全部分段都已切分
+                            state.split_done = True
+                            if state.remaining == 0 and not self._embed_finished(state):
+                                break
+                        else:
+                            state.parts[i] = docs
+                            if self.pre_embed and docs:
+                                state.part_embeddings[i] = [None] * len(docs)
+                                state.remaining += len(docs)
+                                pending.extend((state, i, j) for j in range(len(docs)))
+                        continue
+
+                batch, pending = pending[:self.embed_batch_size], pending[self.embed_batch_size:]
+                for state in self._embed_batch(batch):
+                    if not self._embed_finished(state):
+                        return
+        finally:
+            self._put(self._embedded, _DONE)
+
+    def _write_worker(self):
+        kwargs = {"not_refresh_vs_cache": True}
+        try:
+            while (state := self._get(self._embedded)) is not _DONE:
+                kb_file = state.kb_file
+                kb_file.splited_docs = docs = state.docs
+                try:
+                    with span("write", endpoint="ingest"):
+                        if self.mode == "incremental":
+                            added, removed = self.kb.update_doc_incremental(kb_file, **kwargs)
+                            msg = f"{kb_file.filename}：新增 {added} 条，删除 {removed} 条文档"
+                        else:
+                            if self.pre_embed and docs:
+                                kwargs["embeddings"] = {"texts": [x.page_content for x in docs],
+                                                        "embeddings": state.embeddings,
+                                                        "metadatas": [x.metadata for x in docs]}
+                            if self.mode == "add":
+                                self.kb.add_doc(kb_file, **kwargs)
+                            else:
+                                self.kb.update_doc(kb_file, **kwargs)
+                            kwargs.pop("embeddings", None)
+                            msg = f"{kb_file.filename}：共 {len(docs)} 条文档"
+                except Exception as e:
+                    kwargs.pop("embeddings", None)
+                    self._fail("write", kb_file, e)
+                    continue
+                with self._lock:
+                    finished = self._counts["write"] + 1
+                self._emit("write", kb_file, f"({finished} / {len(self.kb_files)}) {msg}")
+        finally:
+            self._events.put(_DONE)
+
+    def run(self) -> Generator[Dict, None, None]:
+        if not self.kb_files:
+            return
+        threads = []
+        self._running = {"load": self.loader_workers, "split": self.splitter_workers}
+        for _ in range(self.loader_workers):
+            threads.append(threading.Thread(target=self._load_worker, daemon=True))
+        for _ in range(self.splitter_workers):
+            threads.append(threading.Thread(target=self._split_worker, daemon=True))
+        threads.append(threading.Thread(target=self._embed_worker, daemon=True))
+        threads.append(threading.Thread(target=self._write_worker, daemon=True))
+        for t in threads:
+            t.start()
+
+        try:
+            while (event := self._events.get()) is not _DONE:
+                yield event
+        finally:
+            # 调用方提前退出（如客户端断开 SSE 连接）时中止所有阶段
+            self._stop.set()
@@ -1,7 +1,11 @@
 import operator
+import asyncio
 from abc import ABC, abstractmethod
 
 import os
+import json
+import threading
+import time
 from pathlib import Path
 import numpy as np
 from langchain.embeddings.base import Embeddings
@@ -14,20 +18,24 @@ from server.db.repository.knowledge_base_repository import (
 from server.db.repository.knowledge_file_repository import (
     add_file_to_db, delete_file_from_db, delete_files_from_db, file_exists_in_db,
     count_files_from_db, list_files_from_db, get_file_detail, delete_file_from_db,
-    list_docs_from_db,
+    list_docs_from_db, delete_docs_from_db, count_docs_from_db, update_file_mtime,
 )
 
 from configs import (kbs_config, VECTOR_SEARCH_TOP_K, SCORE_THRESHOLD,
-                     EMBEDDING_MODEL, KB_INFO)
+                     EMBEDDING_MODEL, KB_INFO, QUERY_EMBED_BATCH_SIZE, KB_SERVICE_IDLE_TIMEOUT,
+                     BM25_INDEX_ENABLED, DEFAULT_SEARCH_MODE, HYBRID_SEARCH_CANDIDATES, HYBRID_RRF_K,
+                     logger, log_verbose)
 from server.knowledge_base.utils import (
     get_kb_path, get_doc_path, KnowledgeFile,
     list_kbs_from_folder, list_files_from_folder,
 )
 
-from typing import List, Union, Dict, Optional, Tuple
+from typing import List, Union, Dict, Optional, Tuple, Callable
 
 from server.embeddings_api import embed_texts, aembed_texts, embed_documents
+from server.utils import list_embed_models
 from server.knowledge_base.model.kb_document_model import DocumentWithVSId
+from server.knowledge_base.kb_cache.search_cache import search_result_cache, query_embedding_cache
 
 
 def normalize(embeddings: List[List[float]]) -> np.ndarray:
@@ -69,8 +77,51 @@ class KBService(ABC):
     def save_vector_store(self):
         '''
         保存向量库:FAISS保存到磁盘，milvus保存到数据库。PGVector暂未支持
+        子类重写时应调用 super().save_vector_store() 以保存 BM25 索引
         '''
-        pass
+        from server.knowledge_base.kb_cache.bm25_cache import kb_bm25_pool
+
+        if item := kb_bm25_pool.get(self.kb_name):
+            item.save()
+
+    def load_bm25_index(self):
+        '''
+        加载知识库的 BM25 倒排索引，索引不存在或与数据库中的文本块数不一致时从向量库中的文本重建。
+        BM25_INDEX_ENABLED 为 False 时返回 None
+        '''
+        from server.knowledge_base.kb_cache.bm25_cache import kb_bm25_pool
+
+        if not BM25_INDEX_ENABLED:
+            return None
+
+        def loader() -> Tuple[List[str], List[str]]:
+            ids = [x["id"] for x in list_docs_from_db(kb_name=self.kb_name)]
+            docs = self.get_doc_by_ids(ids)
+            if len(docs) != len(ids):
+                raise RuntimeError(f"{self.vs_type()} does not support get_doc_by_ids")
+            pairs = [(id, doc.page_content) for id, doc in zip(ids, docs) if doc is not None]
+            return [x[0] for x in pairs], [x[1] for x in pairs]
+
+        return kb_bm25_pool.load_index(self.kb_name,
+                                       docs_count=lambda: count_docs_from_db(kb_name=self.kb_name),
+                                       loader=loader)
+
+    def _bm25_add(self, doc_infos: List[Dict], docs: List[Document]):
+        if doc_infos and (item := self.load_bm25_index()) is not None:
+            with item.acquire(msg="添加文档") as index:
+                index.add([x["id"] for x in doc_infos], [x.page_content for x in docs])
+            item.schedule_save()
+
+    def _bm25_delete(self, ids: List[str]):
+        if ids and (item := self.load_bm25_index()) is not None:
+            with item.acquire(msg="删除文档") as index:
+                index.delete(ids)
+            item.schedule_save()
+
+    def _bm25_drop(self):
+        from server.knowledge_base.kb_cache.bm25_cache import kb_bm25_pool
+
+        kb_bm25_pool.drop_index(self.kb_name)
 
     def create_kb(self):
         """
@@ -80,6 +131,7 @@ class KBService(ABC):
             os.makedirs(self.doc_path)
         self.do_create_kb()
         status = add_kb_to_db(self.kb_name, self.kb_info, self.vs_type(), self.embed_model)
+        kb_service_registry.invalidate(self.kb_name)
         return status
 
     def clear_vs(self):
@@ -87,7 +139,9 @@ class KBService(ABC):
         删除向量库中所有内容
         """
         self.do_clear_vs()
+        self._bm25_drop()
         status = delete_files_from_db(self.kb_name)
+        kb_versions.bump(self.kb_name)
         return status
 
     def drop_kb(self):
@@ -95,7 +149,10 @@ class KBService(ABC):
         删除知识库
         """
         self.do_drop_kb()
+        self._bm25_drop()
         status = delete_kb_from_db(self.kb_name)
+        kb_service_registry.invalidate(self.kb_name)
+        kb_versions.bump(self.kb_name)
         return status
 
     def _docs_to_embeddings(self, docs: List[Document]) -> Dict:
@@ -104,6 +161,19 @@ class KBService(ABC):
         '''
         return embed_documents(docs=docs, embed_model=self.embed_model, to_query=False)
 
+    def _docs_source_to_relpath(self, docs: List[Document]):
+        '''
+        将 metadata["source"] 改为相对路径
+        '''
+        for doc in docs:
+            try:
+                source = doc.metadata.get("source", "")
+                if os.path.isabs(source):
+                    rel_path = Path(source).relative_to(self.doc_path)
+                    doc.metadata["source"] = str(rel_path.as_posix().strip("/"))
+            except Exception as e:
+                print(f"cannot convert absolute path ({source}) to relative path. error is : {e}")
+
     def add_doc(self, kb_file: KnowledgeFile, docs: List[Document] = [], **kwargs):
         """
         向知识库添加文件
@@ -118,21 +188,15 @@ class KBService(ABC):
             custom_docs = False
 
         if docs:
-            # 将 metadata["source"] 改为相对路径
-            for doc in docs:
-                try:
-                    source = doc.metadata.get("source", "")
-                    if os.path.isabs(source):
-                        rel_path = Path(source).relative_to(self.doc_path)
-                        doc.metadata["source"] = str(rel_path.as_posix().strip("/"))
-                except Exception as e:
-                    print(f"cannot convert absolute path ({source}) to relative path. error is : {e}")
+            self._docs_source_to_relpath(docs)
             self.delete_doc(kb_file)
             doc_infos = self.do_add_doc(docs, **kwargs)
+            self._bm25_add(doc_infos, docs)
             status = add_file_to_db(kb_file,
                                     custom_docs=custom_docs,
                                     docs_count=len(docs),
                                     doc_infos=doc_infos)
+            kb_versions.bump(self.kb_name)
         else:
             status = False
         return status
@@ -141,8 +205,12 @@ class KBService(ABC):
         """
         从知识库删除文件
         """
+        if BM25_INDEX_ENABLED:
+            self._bm25_delete([x["id"] for x in list_docs_from_db(kb_name=self.kb_name,
+                                                                  file_name=kb_file.filename)])
         self.do_delete_doc(kb_file, **kwargs)
         status = delete_file_from_db(kb_file)
+        kb_versions.bump(self.kb_name)
         if delete_content and os.path.exists(kb_file.filepath):
             os.remove(kb_file.filepath)
         return status
@@ -153,6 +221,7 @@ class KBService(ABC):
         """
         self.kb_info = kb_info
         status = add_kb_to_db(self.kb_name, self.kb_info, self.vs_type(), self.embed_model)
+        kb_service_registry.invalidate(self.kb_name)
         return status
 
     def update_doc(self, kb_file: KnowledgeFile, docs: List[Document] = [], **kwargs):
@@ -164,6 +233,79 @@ class KBService(ABC):
             self.delete_doc(kb_file, **kwargs)
             return self.add_doc(kb_file, docs=docs, **kwargs)
 
+    def is_file_modified(self, kb_file: KnowledgeFile) -> bool:
+        '''
+        对比数据库中记录的文件修改时间、大小与内容哈希，判断磁盘上的文件是否发生了变化。
+        修改时间与大小均一致时直接视为未变化；否则在大小一致时再比较内容哈希，
+        哈希一致时更新数据库中的修改时间，下次检查不必再计算哈希。
+        '''
+        file_detail = get_file_detail(kb_name=self.kb_name, filename=kb_file.filename)
+        if not file_detail or file_detail.get("custom_docs"):
+            return True
+        size = kb_file.get_size()
+        if file_detail["file_size"] != size:
+            return True
+        mtime = kb_file.get_mtime()
+        if file_detail["file_mtime"] == mtime:
+            return False
+        if not file_detail.get("file_hash") or file_detail["file_hash"] != kb_file.get_hash():
+            return True
+        update_file_mtime(kb_name=self.kb_name, filename=kb_file.filename, file_mtime=mtime)
+        return False
+
+    def update_doc_incremental(self, kb_file: KnowledgeFile, **kwargs) -> Optional[Tuple[int, int]]:
+        '''
+        增量更新文件：将重新切分后的文本块与数据库中已有的文本块对比，
+        仅向量化新增的文本块，删除已不存在的文本块，内容未变化的文本块保留原有向量。
+        返回 (新增数量, 删除数量)
+        '''
+        if not os.path.exists(kb_file.filepath):
+            return None
+
+        old_infos = list_docs_from_db(kb_name=self.kb_name, file_name=kb_file.filename)
+        if not old_infos or not self.exist_doc(kb_file.filename):
+            docs = kb_file.file2text()
+            self.add_doc(kb_file, **kwargs)
+            return len(docs), 0
+
+        docs = kb_file.file2text()
+        self._docs_source_to_relpath(docs)
+
+        def chunk_key(page_content: str, metadata: Dict) -> Tuple[str, str]:
+            metadata = {k: v for k, v in (metadata or {}).items() if k not in ["id", "vector"]}
+            return page_content, json.dumps(metadata, sort_keys=True, default=str)
+
+        old_chunks: Dict[Tuple[str, str], List[str]] = {}
+        removed_ids = []
+        for info, doc in zip(old_infos, self.get_doc_by_ids([x["id"] for x in old_infos])):
+            if doc is None:
+                removed_ids.append(info["id"])
+            else:
+                old_chunks.setdefault(chunk_key(doc.page_content, info["metadata"]), []).append(info["id"])
+
+        kept_infos = []
+        added_docs = []
+        for doc in docs:
+            if ids := old_chunks.get(chunk_key(doc.page_content, doc.metadata)):
+                kept_infos.append({"id": ids.pop(), "metadata": doc.metadata})
+            else:
+                added_docs.append(doc)
+        removed_ids += [id for ids in old_chunks.values() for id in ids]
+
+        if removed_ids:
+            self.del_doc_by_ids(removed_ids, **kwargs)
+            self._bm25_delete(removed_ids)
+        added_infos = self.do_add_doc(added_docs, **kwargs) if added_docs else []
+        self._bm25_add(added_infos, added_docs)
+        delete_docs_from_db(kb_name=self.kb_name, file_name=kb_file.filename)
+        add_file_to_db(kb_file,
+                       custom_docs=False,
+                       docs_count=len(docs),
+                       doc_infos=kept_infos + added_infos)
+        if added_docs or removed_ids:
+            kb_versions.bump(self.kb_name)
+        return len(added_docs), len(removed_ids)
+
     def exist_doc(self, file_name: str):
         return file_exists_in_db(KnowledgeFile(knowledge_base_name=self.kb_name,
                                                filename=file_name))
@@ -178,14 +320,62 @@ class KBService(ABC):
                     query: str,
                     top_k: int = VECTOR_SEARCH_TOP_K,
                     score_threshold: float = SCORE_THRESHOLD,
+                    search_mode: str = DEFAULT_SEARCH_MODE,
+                    **kwargs,
                     ) ->List[Document]:
-        docs = self.do_search(query, top_k, score_threshold)
+        '''
+        search_mode:
+            vector: 向量检索，分数为向量距离，越小越相关
+            bm25: 关键词检索，分数为 BM25 分数，越大越相关
+            hybrid: 两路检索按倒数排名融合(RRF)，分数为融合分数，越大越相关；score_threshold 仅用于过滤向量检索结果
+        结果按知识库内容版本缓存，知识库内容变化前相同的检索直接返回缓存的结果
+        '''
+        key = (self.kb_name.lower(), kb_versions.get(self.kb_name), self.embed_model,
+               query, top_k, score_threshold, search_mode, json.dumps(kwargs, sort_keys=True, default=str))
+        if (docs := search_result_cache.get(key)) is None:
+            docs = self._search_docs(query, top_k, score_threshold, search_mode, **kwargs)
+            search_result_cache.set(key, docs)
+        # 返回副本，调用方（如 reranker）修改 metadata 时不影响缓存
+        return [(Document(page_content=doc.page_content, metadata=dict(doc.metadata)), score)
+                for doc, score in docs]
+
+    def _search_docs(self,
+                     query: str,
+                     top_k: int,
+                     score_threshold: float,
+                     search_mode: str,
+                     **kwargs,
+                     ) -> List[Tuple[Document, float]]:
+        if search_mode == "bm25":
+            return self.bm25_search(query, top_k)
+        elif search_mode == "hybrid":
+            k = top_k * HYBRID_SEARCH_CANDIDATES
+            return reciprocal_rank_fusion([self.do_search(query, k, score_threshold, **kwargs),
+                                           self.bm25_search(query, k)],
+                                          top_k=top_k)
+        docs = self.do_search(query, top_k, score_threshold, **kwargs)
         return docs
 
+    def bm25_search(self, query: str, top_k: int) -> List[Tuple[Document, float]]:
+        '''
+        使用 BM25 倒排索引检索，返回的 Document.metadata 中包含文本块 id
+        '''
+        if (item := self.load_bm25_index()) is None:
+            return []
+        with item.acquire(shared=True) as index:
+            hits = index.search(query, top_k)
+        if not hits:
+            return []
+        result = []
+        for (id, score), doc in zip(hits, self.get_doc_by_ids([id for id, _ in hits])):
+            if doc is not None:
+                result.append((Document(page_content=doc.page_content, metadata={**doc.metadata, "id": id}), score))
+        return result
+
     def get_doc_by_ids(self, ids: List[str]) -> List[Document]:
         return []
 
-    def del_doc_by_ids(self, ids: List[str]) -> bool:
+    def del_doc_by_ids(self, ids: List[str], **kwargs) -> bool:
         raise NotImplementedError
 
     def update_doc_by_ids(self, docs: Dict[str, Document]) -> bool:
@@ -194,14 +384,17 @@ class KBService(ABC):
         如果对应 doc_id 的值为 None，或其 page_content 为空，则删除该文档
         '''
         self.del_doc_by_ids(list(docs.keys()))
-        docs = []
+        self._bm25_delete(list(docs.keys()))
+        new_docs = []
         ids = []
         for k, v in docs.items():
             if not v or not v.page_content.strip():
                 continue
             ids.append(k)
-            docs.append(v)
-        self.do_add_doc(docs=docs, ids=ids)
+            new_docs.append(v)
+        doc_infos = self.do_add_doc(docs=new_docs, ids=ids)
+        self._bm25_add(doc_infos, new_docs)
+        kb_versions.bump(self.kb_name)
         return True
 
     def list_docs(self, file_name: str = None, metadata: Dict = {}) -> List[DocumentWithVSId]:
@@ -261,6 +454,7 @@ class KBService(ABC):
                   query: str,
                   top_k: int,
                   score_threshold: float,
+                  **kwargs,
                   ) -> List[Tuple[Document, float]]:
         """
         搜索知识库子类实自己逻辑
@@ -293,6 +487,97 @@ class KBService(ABC):
         pass
 
 
+class KBServiceRegistry:
+    '''
+    已创建的知识库服务实例注册表，键为 (kb_name, vs_type, embed_model)，并按 kb_name 索引。
+    get_service_by_name 命中时直接返回已有实例，无需查询数据库或重新创建向量库客户端。
+    create_kb / drop_kb / update_info 时对应实例失效，超过 idle_timeout 秒未使用的实例将被移除。
+    '''
+    def __init__(self, idle_timeout: float = KB_SERVICE_IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._services: Dict[str, Tuple[Tuple[str, str, str], "KBService", float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, kb_name: str) -> Optional["KBService"]:
+        if self.idle_timeout <= 0:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            if (entry := self._services.get(kb_name)) is None:
+                return None
+            key, service, last_used = entry
+            if now - last_used > self.idle_timeout:
+                del self._services[kb_name]
+                return None
+            self._services[kb_name] = (key, service, now)
+            return service
+
+    def set(self, kb_name: str, vs_type: str, embed_model: str, service: "KBService"):
+        if self.idle_timeout <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for name, (_, _, last_used) in list(self._services.items()):
+                if now - last_used > self.idle_timeout:
+                    del self._services[name]
+            self._services[kb_name] = ((kb_name, vs_type, embed_model), service, now)
+
+    def invalidate(self, kb_name: str):
+        '''
+        移除知识库的所有实例（数据库中知识库名称不区分大小写）
+        '''
+        with self._lock:
+            for name in [x for x in self._services if x.lower() == kb_name.lower()]:
+                del self._services[name]
+
+    def clear(self):
+        with self._lock:
+            self._services.clear()
+
+    def keys(self) -> List[Tuple[str, str, str]]:
+        with self._lock:
+            return [key for key, _, _ in self._services.values()]
+
+
+kb_service_registry = KBServiceRegistry()
+
+
+class KBVersions:
+    '''
+    知识库内容版本号，知识库内容每次变化时递增，作为依赖知识库内容的缓存（如答案缓存）的键。
+    版本号仅在当前进程内有效；可通过 add_listener 注册内容变化时的回调，回调参数为知识库名称（小写）
+    '''
+    def __init__(self):
+        self._versions: Dict[str, int] = {}
+        self._listeners: List[Callable[[str], None]] = []
+        self._lock = threading.Lock()
+
+    def get(self, kb_name: str) -> int:
+        with self._lock:
+            return self._versions.get(kb_name.lower(), 0)
+
+    def bump(self, kb_name: str) -> int:
+        kb_name = kb_name.lower()
+        with self._lock:
+            version = self._versions[kb_name] = self._versions.get(kb_name, 0) + 1
+            listeners = list(self._listeners)
+        for func in listeners:
+            try:
+                func(kb_name)
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: kb version listener failed: {e}",
+                             exc_info=e if log_verbose else None)
+        return version
+
+    def add_listener(self, func: Callable[[str], None]):
+        with self._lock:
+            self._listeners.append(func)
+
+
+kb_versions = KBVersions()
+kb_versions.add_listener(lambda kb_name: search_result_cache.discard(lambda key: key[0] == kb_name))
+
+
 class KBServiceFactory:
 
     @staticmethod
@@ -330,10 +615,15 @@ class KBServiceFactory:
 
     @staticmethod
     def get_service_by_name(kb_name: str) -> KBService:
+        if (service := kb_service_registry.get(kb_name)) is not None:
+            return service
         _, vs_type, embed_model = load_kb_from_db(kb_name)
         if _ is None:  # kb not in db, just return None
             return None
-        return KBServiceFactory.get_service(kb_name, vs_type, embed_model)
+        service = KBServiceFactory.get_service(kb_name, vs_type, embed_model)
+        if service is not None:
+            kb_service_registry.set(kb_name, vs_type, embed_model, service)
+        return service
 
     @staticmethod
     def get_default():
@@ -351,6 +641,8 @@ def get_kb_details() -> List[Dict]:
             "vs_type": "",
             "kb_info": "",
             "embed_model": "",
+            "index_type": "",
+            "index_params": {},
             "file_count": 0,
             "create_time": None,
             "in_folder": True,
@@ -424,23 +716,45 @@ class EmbeddingsFunAdapter(Embeddings):
         embeddings = embed_texts(texts=texts, embed_model=self.embed_model, to_query=False).data
         return normalize(embeddings).tolist()
 
+    def _get_query_batcher(self):
+        '''
+        本地Embeddings模型且开启微批处理时，返回对应 (embed_model, device) 的查询微批处理器
+        '''
+        if QUERY_EMBED_BATCH_SIZE > 1 and self.embed_model in list_embed_models():
+            from server.knowledge_base.kb_cache.base import query_embeddings_batcher_pool
+            return query_embeddings_batcher_pool.load_batcher(model=self.embed_model)
+
     def embed_query(self, text: str) -> List[float]:
-        embeddings = embed_texts(texts=[text], embed_model=self.embed_model, to_query=True).data
-        query_embed = embeddings[0]
+        if (query_embed := query_embedding_cache.get((self.embed_model, text))) is not None:
+            return query_embed
+        if (batcher := self._get_query_batcher()) and (future := batcher.submit(text)) is not None:
+            query_embed = future.result()
+        else:
+            embeddings = embed_texts(texts=[text], embed_model=self.embed_model, to_query=True).data
+            query_embed = embeddings[0]
         query_embed_2d = np.reshape(query_embed, (1, -1))  # 将一维数组转换为二维数组
         normalized_query_embed = normalize(query_embed_2d)
-        return normalized_query_embed[0].tolist()  # 将结果转换为一维数组并返回
+        query_embed = normalized_query_embed[0].tolist()  # 将结果转换为一维数组并返回
+        query_embedding_cache.set((self.embed_model, text), query_embed)
+        return query_embed
 
     async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
         embeddings = (await aembed_texts(texts=texts, embed_model=self.embed_model, to_query=False)).data
         return normalize(embeddings).tolist()
 
     async def aembed_query(self, text: str) -> List[float]:
-        embeddings = (await aembed_texts(texts=[text], embed_model=self.embed_model, to_query=True)).data
-        query_embed = embeddings[0]
+        if (query_embed := query_embedding_cache.get((self.embed_model, text))) is not None:
+            return query_embed
+        if (batcher := self._get_query_batcher()) and (future := batcher.submit(text)) is not None:
+            query_embed = await asyncio.wrap_future(future)
+        else:
+            embeddings = (await aembed_texts(texts=[text], embed_model=self.embed_model, to_query=True)).data
+            query_embed = embeddings[0]
         query_embed_2d = np.reshape(query_embed, (1, -1))  # 将一维数组转换为二维数组
         normalized_query_embed = normalize(query_embed_2d)
-        return normalized_query_embed[0].tolist()  # 将结果转换为一维数组并返回
+        query_embed = normalized_query_embed[0].tolist()  # 将结果转换为一维数组并返回
+        query_embedding_cache.set((self.embed_model, text), query_embed)
+        return query_embed
 
 
 def score_threshold_process(score_threshold, k, docs):
@@ -454,3 +768,23 @@ def score_threshold_process(score_threshold, k, docs):
             if cmp(similarity, score_threshold)
         ]
     return docs[:k]
+
+
+def reciprocal_rank_fusion(results: List[List[Tuple[Document, float]]],
+                           top_k: int,
+                           k: int = HYBRID_RRF_K,
+                           ) -> List[Tuple[Document, float]]:
+    '''
+    倒数排名融合：文档的融合分数为其在各路结果中 1 / (k + 排名) 之和，与各路分数的量纲无关。
+    以 (文本内容, 来源文件) 识别同一文本块
+    '''
+    scores: Dict[Tuple, float] = {}
+    docs: Dict[Tuple, Document] = {}
+    for result in results:
+        for rank, (doc, _) in enumerate(result, start=1):
+            key = (doc.page_content, doc.metadata.get("source"))
+            scores[key] = scores.get(key, 0.0) + 1 / (k + rank)
+            if key not in docs or "id" in doc.metadata:
+                docs[key] = doc
+    ranked = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:top_k]
+    return [(docs[key], score) for key, score in ranked]
@@ -73,7 +73,7 @@ class ChromaKBService(KBService):
             if not str(e) == f"Collection {self.kb_name} does not exist.":
                 raise e
 
-    def do_search(self, query: str, top_k: int, score_threshold: float = SCORE_THRESHOLD) -> List[
+    def do_search(self, query: str, top_k: int, score_threshold: float = SCORE_THRESHOLD, **kwargs) -> List[
         Tuple[Document, float]]:
         embed_func = EmbeddingsFunAdapter(self.embed_model)
         embeddings = embed_func.embed_query(query)
@@ -93,7 +93,7 @@ class ChromaKBService(KBService):
         get_result: GetResult = self.collection.get(ids=ids)
         return _get_result_to_documents(get_result)
 
-    def del_doc_by_ids(self, ids: List[str]) -> bool:
+    def del_doc_by_ids(self, ids: List[str], **kwargs) -> bool:
         self.collection.delete(ids=ids)
         return True
 
@@ -149,7 +149,7 @@ class ESKBService(KBService):
 
 
 
-    def do_search(self, query:str, top_k: int, score_threshold: float):
+    def do_search(self, query:str, top_k: int, score_threshold: float, **kwargs):
         # 文本相似性检索
         docs = self.db_init.similarity_search_with_score(query=query,
                                          k=top_k)
@@ -169,7 +169,7 @@ class ESKBService(KBService):
                 logger.error(f"Error retrieving document from Elasticsearch! {e}")
         return results
 
-    def del_doc_by_ids(self, ids: List[str]) -> bool:
+    def del_doc_by_ids(self, ids: List[str], **kwargs) -> bool:
         for doc_id in ids:
             try:
                 self.es_client_python.delete(index=self.index_name,
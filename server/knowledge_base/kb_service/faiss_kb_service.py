@@ -1,11 +1,15 @@
 import os
 import shutil
 
-from configs import SCORE_THRESHOLD
-from server.knowledge_base.kb_service.base import KBService, SupportedVSType, EmbeddingsFunAdapter
+from configs import SCORE_THRESHOLD, FAISS_ASYNC_SAVE, FAISS_INDEX_TYPE
+from server.db.repository.knowledge_base_repository import get_kb_detail, update_kb_index_in_db
+from server.knowledge_base.kb_service.base import (KBService, SupportedVSType, EmbeddingsFunAdapter,
+                                                   kb_service_registry)
 from server.knowledge_base.kb_cache.faiss_cache import kb_faiss_pool, ThreadSafeFaiss
+from server.knowledge_base.kb_cache.faiss_index import SUPPORTED_INDEX_TYPES, with_search_params
 from server.knowledge_base.utils import KnowledgeFile, get_kb_path, get_vs_path
 from server.utils import torch_gc
+from server.metrics import span
 from langchain.docstore.document import Document
 from typing import List, Dict, Optional, Tuple
 
@@ -14,6 +18,8 @@ class FaissKBService(KBService):
     vs_path: str
     kb_path: str
     vector_name: str = None
+    index_type: str = None
+    index_params: Dict = None
  
     def vs_type(self) -> str:
         return SupportedVSType.FAISS
@@ -27,23 +33,61 @@ class FaissKBService(KBService):
     def load_vector_store(self) -> ThreadSafeFaiss:
         return kb_faiss_pool.load_vector_store(kb_name=self.kb_name,
                                                vector_name=self.vector_name,
-                                               embed_model=self.embed_model)
+                                               embed_model=self.embed_model,
+                                               index_type=self.index_type,
+                                               index_params=self.index_params)
 
     def save_vector_store(self):
         self.load_vector_store().save(self.vs_path)
+        super().save_vector_store()
+
+    def _persist(self, vector_store: ThreadSafeFaiss, **kwargs):
+        '''
+        修改向量库后保存。FAISS_ASYNC_SAVE 开启时交由后台线程合并保存，否则立即保存。
+        '''
+        if kwargs.get("not_refresh_vs_cache"):
+            return
+        if FAISS_ASYNC_SAVE:
+            vector_store.schedule_save()
+        else:
+            vector_store.save(self.vs_path)
 
     def get_doc_by_ids(self, ids: List[str]) -> List[Document]:
-        with self.load_vector_store().acquire() as vs:
+        with self.load_vector_store().acquire(shared=True) as vs:
             return [vs.docstore._dict.get(id) for id in ids]
 
-    def del_doc_by_ids(self, ids: List[str]) -> bool:
-        with self.load_vector_store().acquire() as vs:
-            vs.delete(ids)
+    def del_doc_by_ids(self, ids: List[str], **kwargs) -> bool:
+        vector_store = self.load_vector_store()
+        with vector_store.acquire():
+            vector_store.delete(ids)
+            if FAISS_ASYNC_SAVE and not kwargs.get("not_refresh_vs_cache"):
+                vector_store.append_wal("delete", ids=ids)
+        self._persist(vector_store, **kwargs)
+        vector_store.maybe_rebuild()
+        return True
 
     def do_init(self):
         self.vector_name = self.vector_name or self.embed_model
         self.kb_path = self.get_kb_path()
         self.vs_path = self.get_vs_path()
+        kb_detail = get_kb_detail(self.kb_name)
+        self.index_type = kb_detail.get("index_type") or FAISS_INDEX_TYPE
+        self.index_params = kb_detail.get("index_params") or {}
+
+    def set_index_type(self, index_type: str, index_params: Dict = None) -> bool:
+        '''
+        修改知识库的索引类型并保存到数据库，已有向量库将就地重建。
+        ivf_* 索引在向量数不足以训练时暂不重建，返回 False，待向量数达到要求后自动重建。
+        '''
+        if index_type not in SUPPORTED_INDEX_TYPES:
+            raise ValueError(f"unsupported faiss index type: {index_type}")
+        self.index_type = index_type
+        self.index_params = index_params or {}
+        update_kb_index_in_db(self.kb_name, self.index_type, self.index_params)
+        kb_service_registry.invalidate(self.kb_name)
+        vector_store = self.load_vector_store()
+        vector_store.set_index_config(self.index_type, self.index_params)
+        return vector_store.rebuild_index(force=True)
 
     def do_create_kb(self):
         if not os.path.exists(self.vs_path):
@@ -61,25 +105,40 @@ class FaissKBService(KBService):
                   query: str,
                   top_k: int,
                   score_threshold: float = SCORE_THRESHOLD,
+                  search_params: Dict = None,
+                  **kwargs,
                   ) -> List[Tuple[Document, float]]:
+        '''
+        search_params: 检索参数，如 {"nprobe": 32}(ivf_*) 或 {"efSearch": 128}(hnsw)，不指定时使用索引的默认值
+        '''
         embed_func = EmbeddingsFunAdapter(self.embed_model)
-        embeddings = embed_func.embed_query(query)
-        with self.load_vector_store().acquire() as vs:
-            docs = vs.similarity_search_with_score_by_vector(embeddings, k=top_k, score_threshold=score_threshold)
+        with span("embed_query"):
+            embeddings = embed_func.embed_query(query)
+        vector_store = self.load_vector_store()
+        with vector_store.acquire(shared=True) as vs:
+            with span("vector_search"):
+                vs = with_search_params(vs, search_params, sel=vector_store.id_selector())
+                docs = vs.similarity_search_with_score_by_vector(embeddings, k=top_k, score_threshold=score_threshold)
         return docs
 
     def do_add_doc(self,
                    docs: List[Document],
                    **kwargs,
                    ) -> List[Dict]:
-        data = self._docs_to_embeddings(docs) # 将向量化单独出来可以减少向量库的锁定时间
-
-        with self.load_vector_store().acquire() as vs:
-            ids = vs.add_embeddings(text_embeddings=zip(data["texts"], data["embeddings"]),
-                                    metadatas=data["metadatas"],
-                                    ids=kwargs.get("ids"))
-            if not kwargs.get("not_refresh_vs_cache"):
-                vs.save_local(self.vs_path)
+        data = kwargs.get("embeddings")  # 由入库流水线预先批量向量化的结果
+        if data is None or len(data["texts"]) != len(docs):
+            data = self._docs_to_embeddings(docs) # 将向量化单独出来可以减少向量库的锁定时间
+
+        vector_store = self.load_vector_store()
+        with vector_store.acquire():
+            ids = vector_store.add_embeddings(texts=data["texts"],
+                                              embeddings=data["embeddings"],
+                                              metadatas=data["metadatas"],
+                                              ids=kwargs.get("ids"))
+            if FAISS_ASYNC_SAVE and not kwargs.get("not_refresh_vs_cache"):
+                vector_store.append_wal("add", ids=ids, **data)
+        self._persist(vector_store, **kwargs)
+        vector_store.maybe_rebuild()
         doc_infos = [{"id": id, "metadata": doc.metadata} for id, doc in zip(ids, docs)]
         torch_gc()
         return doc_infos
@@ -87,17 +146,23 @@ class FaissKBService(KBService):
     def do_delete_doc(self,
                       kb_file: KnowledgeFile,
                       **kwargs):
-        with self.load_vector_store().acquire() as vs:
-            ids = [k for k, v in vs.docstore._dict.items() if v.metadata.get("source").lower() == kb_file.filename.lower()]
+        vector_store = self.load_vector_store()
+        with vector_store.acquire():
+            ids = vector_store.ids_by_source(kb_file.filename)
             if len(ids) > 0:
-                vs.delete(ids)
-            if not kwargs.get("not_refresh_vs_cache"):
-                vs.save_local(self.vs_path)
+                vector_store.delete(ids)
+                if FAISS_ASYNC_SAVE and not kwargs.get("not_refresh_vs_cache"):
+                    vector_store.append_wal("delete", ids=ids)
+        if len(ids) > 0:
+            self._persist(vector_store, **kwargs)
+            vector_store.maybe_rebuild()
         return ids
 
     def do_clear_vs(self):
         with kb_faiss_pool.atomic:
-            kb_faiss_pool.pop((self.kb_name, self.vector_name))
+            vector_store = kb_faiss_pool.pop((self.kb_name, self.vector_name))
+        if vector_store is not None:
+            vector_store.stop_persist()
         try:
             shutil.rmtree(self.vs_path)
         except Exception:
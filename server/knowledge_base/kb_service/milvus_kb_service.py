@@ -30,7 +30,7 @@ class MilvusKBService(KBService):
                 result.append(Document(page_content=text, metadata=data))
         return result
 
-    def del_doc_by_ids(self, ids: List[str]) -> bool:
+    def del_doc_by_ids(self, ids: List[str], **kwargs) -> bool:
         self.milvus.col.delete(expr=f'pk in {ids}')
 
     @staticmethod
@@ -64,7 +64,7 @@ class MilvusKBService(KBService):
             self.milvus.col.release()
             self.milvus.col.drop()
 
-    def do_search(self, query: str, top_k: int, score_threshold: float):
+    def do_search(self, query: str, top_k: int, score_threshold: float, **kwargs):
         self._load_milvus()
         embed_func = EmbeddingsFunAdapter(self.embed_model)
         embeddings = embed_func.embed_query(query)
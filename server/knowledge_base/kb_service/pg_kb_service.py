@@ -32,7 +32,7 @@ class PGKBService(KBService):
             results = [Document(page_content=row[0], metadata=row[1]) for row in
                        session.execute(stmt, {'ids': ids}).fetchall()]
             return results
-    def del_doc_by_ids(self, ids: List[str]) -> bool:
+    def del_doc_by_ids(self, ids: List[str], **kwargs) -> bool:
         return super().del_doc_by_ids(ids)
 
     def do_init(self):
@@ -58,7 +58,7 @@ class PGKBService(KBService):
             session.commit()
             shutil.rmtree(self.kb_path)
 
-    def do_search(self, query: str, top_k: int, score_threshold: float):
+    def do_search(self, query: str, top_k: int, score_threshold: float, **kwargs):
         embed_func = EmbeddingsFunAdapter(self.embed_model)
         embeddings = embed_func.embed_query(query)
         docs = self.pg_vector.similarity_search_with_score_by_vector(embeddings, top_k)
@@ -26,7 +26,7 @@ class ZillizKBService(KBService):
                 result.append(Document(page_content=text, metadata=data))
         return result
 
-    def del_doc_by_ids(self, ids: List[str]) -> bool:
+    def del_doc_by_ids(self, ids: List[str], **kwargs) -> bool:
         self.zilliz.col.delete(expr=f'pk in {ids}')
 
     @staticmethod
@@ -57,7 +57,7 @@ class ZillizKBService(KBService):
             self.zilliz.col.release()
             self.zilliz.col.drop()
 
-    def do_search(self, query: str, top_k: int, score_threshold: float):
+    def do_search(self, query: str, top_k: int, score_threshold: float, **kwargs):
         self._load_zilliz()
         embed_func = EmbeddingsFunAdapter(self.embed_model)
         embeddings = embed_func.embed_query(query)
@@ -46,9 +46,15 @@ class KBSummaryService(ABC):
                                                create=True)
 
     def add_kb_summary(self, summary_combine_docs: List[Document]):
-        with self.load_vector_store().acquire() as vs:
-            ids = vs.add_documents(documents=summary_combine_docs)
-            vs.save_local(self.vs_path)
+        vector_store = self.load_vector_store()
+        texts = [doc.page_content for doc in summary_combine_docs]
+        with vector_store.acquire(shared=True) as vs:
+            embed_func = vs.embedding_function
+        embeddings = embed_func.embed_documents(texts)  # 在锁外向量化
+        with vector_store.acquire():
+            # 经由 ThreadSafeFaiss 添加，保持 IVF / HNSW 索引的标签映射一致
+            ids = vector_store.add_embeddings(texts, embeddings, [doc.metadata for doc in summary_combine_docs])
+        vector_store.save(self.vs_path)
 
         summary_infos = [{"summary_context": doc.page_content,
                           "summary_id": id,
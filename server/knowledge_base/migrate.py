@@ -9,12 +9,14 @@ from server.knowledge_base.utils import (
     KnowledgeFile
 )
 from server.knowledge_base.kb_service.base import KBServiceFactory
+from server.knowledge_base.kb_pipeline import IngestPipeline
 from server.db.models.conversation_model import ConversationModel
 from server.db.models.message_model import MessageModel
 from server.db.repository.knowledge_file_repository import add_file_to_db # ensure Models are imported
 from server.db.repository.knowledge_metadata_repository import add_summary_to_db
 
 from server.db.base import Base, engine
+from sqlalchemy import inspect, text
 from server.db.session import session_scope
 import os
 from dateutil.parser import parse
@@ -23,6 +25,24 @@ from typing import Literal, List
 
 def create_tables():
     Base.metadata.create_all(bind=engine)
+    add_missing_columns()
+
+
+def add_missing_columns():
+    """
+    为已存在的数据表补充新版本模型中增加的字段，避免升级后需要重建 info.db
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existed = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existed:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    logger.info(f"added column {table.name}.{column.name}")
 
 
 def reset_tables():
@@ -84,7 +104,7 @@ def file_to_kbfile(kb_name: str, files: List[str]) -> List[KnowledgeFile]:
 
 def folder2db(
         kb_names: List[str],
-        mode: Literal["recreate_vs", "update_in_db", "increment"],
+        mode: Literal["recreate_vs", "update_in_db", "update_modified", "increment"],
         vs_type: Literal["faiss", "milvus", "pg", "chromadb"] = DEFAULT_VS_TYPE,
         embed_model: str = EMBEDDING_MODEL,
         chunk_size: int = CHUNK_SIZE,
@@ -97,22 +117,22 @@ def folder2db(
         recreate_vs: recreate all vector store and fill info to database using existed files in local folder
         fill_info_only(disabled): do not create vector store, fill info to db using existed files only
         update_in_db: update vector store and database info using local files that existed in database only
+        update_modified: like update_in_db, but skip files unchanged since last vectorization (by mtime, size and hash),
+                         and only embed/delete the chunks that changed in modified files
         increment: create vector store and database info for local files that not existed in database only
     """
 
-    def files2vs(kb_name: str, kb_files: List[KnowledgeFile]):
-        for success, result in files2docs_in_thread(kb_files,
-                                                    chunk_size=chunk_size,
-                                                    chunk_overlap=chunk_overlap,
-                                                    zh_title_enhance=zh_title_enhance):
-            if success:
-                _, filename, docs = result
-                print(f"正在将 {kb_name}/{filename} 添加到向量库，共包含{len(docs)}条文档")
-                kb_file = KnowledgeFile(filename=filename, knowledge_base_name=kb_name)
-                kb_file.splited_docs = docs
-                kb.add_doc(kb_file=kb_file, not_refresh_vs_cache=True)
-            else:
-                print(result)
+    def files2vs(kb_name: str, kb_files: List[KnowledgeFile], incremental: bool = False):
+        pipeline = IngestPipeline(kb, kb_files,
+                                  mode="incremental" if incremental else "add",
+                                  chunk_size=chunk_size,
+                                  chunk_overlap=chunk_overlap,
+                                  zh_title_enhance=zh_title_enhance)
+        for event in pipeline.run():
+            if event["code"] != 200:
+                print(event["msg"])
+            elif event["stage"] == "write":
+                print(f"已写入知识库 {kb_name} {event['msg']}")
 
     kb_names = kb_names or list_kbs_from_folder()
     for kb_name in kb_names:
@@ -141,6 +161,14 @@ def folder2db(
             kb_files = file_to_kbfile(kb_name, files)
             files2vs(kb_name, kb_files)
             kb.save_vector_store()
+        # 以数据库中文件列表为基准，仅对磁盘上有变化的文件进行增量向量化
+        elif mode == "update_modified":
+            files = kb.list_files()
+            kb_files = [f for f in file_to_kbfile(kb_name, files)
+                        if f.file_exist() and kb.is_file_modified(f)]
+            print(f"{kb_name}: {len(kb_files)} / {len(files)} 个文件有变化")
+            files2vs(kb_name, kb_files, incremental=True)
+            kb.save_vector_store()
         # 对比本地目录与数据库中的文件列表，进行增量向量化
         elif mode == "increment":
             db_files = kb.list_files()
@@ -9,16 +9,29 @@ from configs import (
     text_splitter_dict,
     LLM_MODELS,
     TEXT_SPLITTER_NAME,
+    PARSE_IN_PROCESS_POOL,
+    PARSE_PROCESS_WORKERS,
+    PARSE_FILE_TIMEOUT,
+    INGEST_PART_CHARS,
 )
 import importlib
+import hashlib
+import tempfile
+import threading
+import time
+from functools import lru_cache
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from text_splitter import zh_title_enhance as func_zh_title_enhance
 import langchain.document_loaders
 from langchain.docstore.document import Document
 from langchain.text_splitter import TextSplitter
 from pathlib import Path
 from server.utils import run_in_thread_pool, get_model_worker_config
+from server.metrics import observe_stage
 import json
-from typing import List, Union,Dict, Tuple, Generator
+from typing import List, Union,Dict, Tuple, Generator, Callable, Iterator, BinaryIO
 import chardet
 
 
@@ -45,6 +58,72 @@ def get_file_path(knowledge_base_name: str, doc_name: str):
     return os.path.join(get_doc_path(knowledge_base_name), doc_name)
 
 
+_file_hashes: Dict[Tuple[str, int, int], str] = {}  # {(文件路径, 修改时间, 大小): sha256}
+_file_hashes_lock = threading.Lock()
+_FILE_HASHES_MAX_SIZE = 10000
+
+
+def _remember_file_hash(file_path: str, file_hash: str):
+    st = os.stat(file_path)
+    with _file_hashes_lock:
+        if len(_file_hashes) >= _FILE_HASHES_MAX_SIZE:
+            _file_hashes.clear()
+        _file_hashes[(os.path.abspath(file_path), st.st_mtime_ns, st.st_size)] = file_hash
+
+
+def get_file_hash(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    '''
+    分块读取文件，计算内容的 sha256。修改时间与大小未变化的文件直接返回上次的结果
+    '''
+    st = os.stat(file_path)
+    key = (os.path.abspath(file_path), st.st_mtime_ns, st.st_size)
+    if (file_hash := _file_hashes.get(key)) is not None:
+        return file_hash
+    h = hashlib.sha256()
+    with open(file_path, "rb") as fp:
+        while chunk := fp.read(chunk_size):
+            h.update(chunk)
+    file_hash = h.hexdigest()
+    _remember_file_hash(file_path, file_hash)
+    return file_hash
+
+
+# mkstemp 创建的文件权限为 0600，需按 umask 恢复为 open() 创建文件时的默认权限。
+# umask 只能通过设置来读取，在导入时读取一次，避免运行时与其它线程竞争
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def save_file_stream(fp: BinaryIO, file_path: str, chunk_size: int = 1024 * 1024) -> Tuple[str, str]:
+    '''
+    将文件流分块写入目标文件所在目录中的临时文件，同时计算内容的 sha256，返回 (临时文件路径, sha256)。
+    由调用方决定用 commit_saved_file 原子地替换目标文件，或删除临时文件
+    '''
+    dir = os.path.dirname(file_path)
+    if not os.path.isdir(dir):
+        os.makedirs(dir, exist_ok=True)
+    h = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=dir, prefix=".upload-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            os.chmod(tmp_path, 0o666 & ~_UMASK)
+            while chunk := fp.read(chunk_size):
+                h.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, h.hexdigest()
+
+
+def commit_saved_file(tmp_path: str, file_path: str, file_hash: str):
+    '''
+    将 save_file_stream 写入的临时文件原子地移动到目标路径，读取方不会看到写了一半的文件
+    '''
+    os.replace(tmp_path, file_path)
+    _remember_file_hash(file_path, file_hash)
+
+
 def list_kbs_from_folder():
     return [f for f in os.listdir(KB_ROOT_PATH)
             if os.path.isdir(os.path.join(KB_ROOT_PATH, f))]
@@ -230,15 +309,7 @@ def make_text_splitter(
                     text_splitter_dict[splitter_name]["tokenizer_name_or_path"] = \
                         config.get("model_path")
 
-                if text_splitter_dict[splitter_name]["tokenizer_name_or_path"] == "gpt2":
-                    from transformers import GPT2TokenizerFast
-                    from langchain.text_splitter import CharacterTextSplitter
-                    tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
-                else:  ## 字符长度加载
-                    from transformers import AutoTokenizer
-                    tokenizer = AutoTokenizer.from_pretrained(
-                        text_splitter_dict[splitter_name]["tokenizer_name_or_path"],
-                        trust_remote_code=True)
+                tokenizer = _load_hf_tokenizer(text_splitter_dict[splitter_name]["tokenizer_name_or_path"])
                 text_splitter = TextSplitter.from_huggingface_tokenizer(
                     tokenizer=tokenizer,
                     chunk_size=chunk_size,
@@ -265,6 +336,78 @@ def make_text_splitter(
     # If you use SpacyTextSplitter you can use GPU to do split likes Issue #1287
     # text_splitter._tokenizer.max_length = 37016792
     # text_splitter._tokenizer.prefer_gpu()
+
+    # 按 token 计算长度时，递归切分会对相同的文本片段反复计算长度，缓存计算结果
+    if (text_splitter_dict.get(splitter_name, {}).get("source") in ["tiktoken", "huggingface"]
+            and callable(getattr(text_splitter, "_length_function", None))):
+        text_splitter._length_function = _memoize_length(text_splitter._length_function, chunk_size * 4)
+    return text_splitter
+
+
+def _memoize_length(length_function: Callable[[str], int], max_chars: int) -> Callable[[str], int]:
+    '''
+    缓存文本片段的长度。只缓存不超过 max_chars 的片段，避免缓存中持有整篇文档
+    '''
+    cached = lru_cache(maxsize=65536)(length_function)
+
+    def length(text: str) -> int:
+        return cached(text) if len(text) <= max_chars else length_function(text)
+    return length
+
+
+@lru_cache()
+def _load_hf_tokenizer(tokenizer_name_or_path: str):
+    '''
+    加载 huggingface tokenizer，每个模型只加载一次
+    '''
+    if tokenizer_name_or_path == "gpt2":
+        from transformers import GPT2TokenizerFast
+        return GPT2TokenizerFast.from_pretrained("gpt2")
+    else:  ## 字符长度加载
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(tokenizer_name_or_path, trust_remote_code=True)
+
+
+_text_splitters: Dict[Tuple, TextSplitter] = {}
+_text_splitters_lock = threading.Lock()
+
+
+def _splitter_tokenizer(splitter_name: str, llm_model: str) -> str:
+    '''
+    分词器计算长度使用的 tokenizer，作为分词器缓存键的一部分
+    '''
+    config = text_splitter_dict.get(splitter_name, {})
+    source = config.get("source", "")
+    tokenizer = config.get("tokenizer_name_or_path", "")
+    if source == "huggingface" and tokenizer == "":
+        tokenizer = get_model_worker_config(llm_model).get("model_path")
+    return f"{source}:{tokenizer}"
+
+
+def get_text_splitter(
+        splitter_name: str = TEXT_SPLITTER_NAME,
+        chunk_size: int = CHUNK_SIZE,
+        chunk_overlap: int = OVERLAP_SIZE,
+        llm_model: str = LLM_MODELS[0],
+) -> TextSplitter:
+    """
+    获取缓存的分词器。相同 (splitter_name, chunk_size, chunk_overlap, tokenizer) 的分词器只创建一次，由各线程共享
+    """
+    splitter_name = splitter_name or "SpacyTextSplitter"
+    key = (splitter_name, chunk_size, chunk_overlap, _splitter_tokenizer(splitter_name, llm_model))
+    if (text_splitter := _text_splitters.get(key)) is None:
+        with _text_splitters_lock:
+            if (text_splitter := _text_splitters.get(key)) is None:
+                start = time.perf_counter()
+                text_splitter = make_text_splitter(splitter_name=splitter_name,
+                                                   chunk_size=chunk_size,
+                                                   chunk_overlap=chunk_overlap,
+                                                   llm_model=llm_model)
+                elapsed = time.perf_counter() - start
+                observe_stage("ingest", "make_text_splitter", elapsed)
+                logger.info(f"text splitter {splitter_name}(chunk_size={chunk_size}, chunk_overlap={chunk_overlap}) "
+                            f"created in {elapsed:.2f}s")
+                _text_splitters[key] = text_splitter
     return text_splitter
 
 
@@ -290,36 +433,68 @@ class KnowledgeFile:
         self.document_loader_name = get_LoaderClass(self.ext)
         self.text_splitter_name = TEXT_SPLITTER_NAME
 
+    def iter_docs(self) -> Iterator[Document]:
+        '''
+        逐个返回加载的 Document。实现了 lazy_load 的加载器（如逐页解析的 RapidOCRPDFLoader）边解析边返回
+        '''
+        logger.info(f"{self.document_loader_name} used for {self.filepath}")
+        loader = get_loader(loader_name=self.document_loader_name,
+                            file_path=self.filepath,
+                            loader_kwargs=self.loader_kwargs)
+        try:
+            docs = loader.lazy_load()
+        except NotImplementedError:
+            docs = loader.load()
+        yield from docs
+
+    def iter_doc_parts(self, part_chars: int = INGEST_PART_CHARS) -> Iterator[List[Document]]:
+        '''
+        将加载的 Document 按顺序分组返回，每组累计不少于 part_chars 个字符（最后一组除外），
+        使切分、向量化可以在文件的后续部分仍在解析时开始。MarkdownHeaderTextSplitter 只处理第一个 Document，整个文件作为一组
+        '''
+        if self.text_splitter_name == "MarkdownHeaderTextSplitter":
+            yield self.file2docs()
+            return
+        part = []
+        size = 0
+        for doc in self.iter_docs():
+            part.append(doc)
+            size += len(doc.page_content)
+            if size >= part_chars:
+                yield part
+                part = []
+                size = 0
+        if part:
+            yield part
+
     def file2docs(self, refresh: bool = False):
         if self.docs is None or refresh:
-            logger.info(f"{self.document_loader_name} used for {self.filepath}")
-            loader = get_loader(loader_name=self.document_loader_name,
-                                file_path=self.filepath,
-                                loader_kwargs=self.loader_kwargs)
-            self.docs = loader.load()
+            self.docs = list(self.iter_docs())
         return self.docs
 
-    def docs2texts(
+    def split_docs(
             self,
-            docs: List[Document] = None,
-            zh_title_enhance: bool = ZH_TITLE_ENHANCE,
-            refresh: bool = False,
+            docs: List[Document],
             chunk_size: int = CHUNK_SIZE,
             chunk_overlap: int = OVERLAP_SIZE,
             text_splitter: TextSplitter = None,
-    ):
-        docs = docs or self.file2docs(refresh=refresh)
+    ) -> List[Document]:
+        '''
+        切分一组 Document，不修改 self.splited_docs
+        '''
         if not docs:
             return []
         if self.ext not in [".csv"]:
             if text_splitter is None:
-                text_splitter = make_text_splitter(splitter_name=self.text_splitter_name, chunk_size=chunk_size,
-                                                   chunk_overlap=chunk_overlap)
+                text_splitter = get_text_splitter(splitter_name=self.text_splitter_name, chunk_size=chunk_size,
+                                                  chunk_overlap=chunk_overlap)
             if self.text_splitter_name == "MarkdownHeaderTextSplitter":
                 docs = text_splitter.split_text(docs[0].page_content)
             else:
                 docs = text_splitter.split_documents(docs)
+        return docs
 
+    def _set_splited_docs(self, docs: List[Document], zh_title_enhance: bool = ZH_TITLE_ENHANCE):
         if not docs:
             return []
 
@@ -329,6 +504,19 @@ class KnowledgeFile:
         self.splited_docs = docs
         return self.splited_docs
 
+    def docs2texts(
+            self,
+            docs: List[Document] = None,
+            zh_title_enhance: bool = ZH_TITLE_ENHANCE,
+            refresh: bool = False,
+            chunk_size: int = CHUNK_SIZE,
+            chunk_overlap: int = OVERLAP_SIZE,
+            text_splitter: TextSplitter = None,
+    ):
+        docs = docs or self.file2docs(refresh=refresh)
+        docs = self.split_docs(docs, chunk_size=chunk_size, chunk_overlap=chunk_overlap, text_splitter=text_splitter)
+        return self._set_splited_docs(docs, zh_title_enhance=zh_title_enhance)
+
     def file2text(
             self,
             zh_title_enhance: bool = ZH_TITLE_ENHANCE,
@@ -336,15 +524,28 @@ class KnowledgeFile:
             chunk_size: int = CHUNK_SIZE,
             chunk_overlap: int = OVERLAP_SIZE,
             text_splitter: TextSplitter = None,
+            use_process_pool: bool = None,
     ):
-        if self.splited_docs is None or refresh:
-            docs = self.file2docs()
-            self.splited_docs = self.docs2texts(docs=docs,
-                                                zh_title_enhance=zh_title_enhance,
-                                                refresh=refresh,
-                                                chunk_size=chunk_size,
-                                                chunk_overlap=chunk_overlap,
-                                                text_splitter=text_splitter)
+        '''
+        加载并切分文件。use_process_pool 为 None 时由 PARSE_IN_PROCESS_POOL 决定是否在进程池中解析。
+        未加载过的文件边加载边切分，不保留完整的原始 Document
+        '''
+        if use_process_pool is None:
+            use_process_pool = PARSE_IN_PROCESS_POOL
+        if (self.splited_docs is None or refresh) and use_process_pool and text_splitter is None:
+            self.splited_docs = parse_file_in_process(self,
+                                                      zh_title_enhance=zh_title_enhance,
+                                                      chunk_size=chunk_size,
+                                                      chunk_overlap=chunk_overlap)
+        elif self.splited_docs is None or refresh:
+            parts = [self.docs] if self.docs is not None and not refresh else self.iter_doc_parts()
+            docs = []
+            for part in parts:
+                docs += self.split_docs(part,
+                                        chunk_size=chunk_size,
+                                        chunk_overlap=chunk_overlap,
+                                        text_splitter=text_splitter)
+            self.splited_docs = self._set_splited_docs(docs, zh_title_enhance=zh_title_enhance)
         return self.splited_docs
 
     def file_exist(self):
@@ -356,6 +557,134 @@ class KnowledgeFile:
     def get_size(self):
         return os.path.getsize(self.filepath)
 
+    def get_hash(self):
+        return get_file_hash(self.filepath)
+
+
+_parse_pool: ProcessPoolExecutor = None
+_parse_pool_lock = threading.Lock()
+def _init_parse_worker():
+    '''
+    解析子进程的初始化函数：预先加载 OCR 与默认分词器，避免每个文件重复加载模型
+    '''
+    from document_loaders.ocr import init_process_ocr
+    try:
+        init_process_ocr()
+    except Exception as e:
+        logger.warning(f"{e.__class__.__name__}: failed to load OCR in parse worker: {e}")
+    try:
+        get_text_splitter(TEXT_SPLITTER_NAME, CHUNK_SIZE, OVERLAP_SIZE)
+    except Exception as e:
+        logger.warning(f"{e.__class__.__name__}: failed to load text splitter in parse worker: {e}")
+
+
+def _parse_file_worker(
+        filename: str,
+        kb_name: str,
+        filepath: str,
+        loader_kwargs: Dict,
+        zh_title_enhance: bool,
+        chunk_size: int,
+        chunk_overlap: int,
+        timeout: int,
+) -> List[Tuple[str, Dict]]:
+    '''
+    在子进程中解析文件，只将 (page_content, metadata) 列表返回给父进程。
+    支持 SIGALRM 的系统上由子进程自行超时退出当前文件，进程本身可继续处理后续文件
+    '''
+    import signal
+
+    def on_timeout(signum, frame):
+        raise TimeoutError(f"parsing {filename} timed out after {timeout} seconds")
+
+    use_alarm = timeout and hasattr(signal, "SIGALRM")
+    if use_alarm:
+        signal.signal(signal.SIGALRM, on_timeout)
+        signal.alarm(int(timeout))
+    try:
+        kb_file = KnowledgeFile(filename=filename, knowledge_base_name=kb_name, loader_kwargs=loader_kwargs)
+        kb_file.filepath = filepath
+        text_splitter = None
+        if kb_file.text_splitter_name != "MarkdownHeaderTextSplitter":
+            text_splitter = get_text_splitter(kb_file.text_splitter_name, chunk_size, chunk_overlap)
+        docs = kb_file.file2text(zh_title_enhance=zh_title_enhance,
+                                 chunk_size=chunk_size,
+                                 chunk_overlap=chunk_overlap,
+                                 text_splitter=text_splitter,
+                                 use_process_pool=False)
+        return [(doc.page_content, doc.metadata) for doc in docs]
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+
+
+def get_parse_process_pool() -> ProcessPoolExecutor:
+    '''
+    获取文档解析进程池，首次使用时创建。使用 spawn 启动子进程，避免 fork 已初始化 CUDA 的父进程
+    '''
+    global _parse_pool
+    if multiprocessing.current_process().daemon:
+        raise RuntimeError("PARSE_IN_PROCESS_POOL requires a non-daemonic process: daemonic processes "
+                           "are not allowed to have children. Start the API server with startup.py "
+                           "(which runs it non-daemonic when the pool is enabled) or set PARSE_IN_PROCESS_POOL = False")
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(max_workers=PARSE_PROCESS_WORKERS,
+                                              mp_context=multiprocessing.get_context("spawn"),
+                                              initializer=_init_parse_worker)
+        return _parse_pool
+
+
+def _reset_parse_process_pool(pool: ProcessPoolExecutor, terminate: bool = False):
+    '''
+    丢弃进程池，之后的任务使用新建的进程池。terminate=True 时先结束所有子进程（如卡住的解析任务）
+    '''
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is pool:
+            _parse_pool = None
+    if terminate:
+        for process in list((getattr(pool, "_processes", None) or {}).values()):
+            process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_file_in_process(
+        kb_file: KnowledgeFile,
+        zh_title_enhance: bool = ZH_TITLE_ENHANCE,
+        chunk_size: int = CHUNK_SIZE,
+        chunk_overlap: int = OVERLAP_SIZE,
+        timeout: int = PARSE_FILE_TIMEOUT,
+) -> List[Document]:
+    '''
+    在进程池中加载并切分文件，阻塞直到完成，可在多个线程中同时调用。
+    超时或子进程崩溃时抛出异常，并结束子进程、重建进程池。
+    '''
+    pool = get_parse_process_pool()
+    future = pool.submit(_parse_file_worker,
+                         filename=kb_file.filename,
+                         kb_name=kb_file.kb_name,
+                         filepath=kb_file.filepath,
+                         loader_kwargs=kb_file.loader_kwargs,
+                         zh_title_enhance=zh_title_enhance,
+                         chunk_size=chunk_size,
+                         chunk_overlap=chunk_overlap,
+                         timeout=timeout)
+    try:
+        # 子进程自身会在 timeout 后放弃该文件，这里多等待一会作为兜底（排队时间不计入子进程超时）
+        result = future.result(timeout=timeout * 2 if timeout else None)
+    except BrokenProcessPool:
+        _reset_parse_process_pool(pool)
+        raise
+    except FutureTimeoutError:
+        # 子进程未能自行超时退出（如卡在不响应信号的 C 扩展中），结束子进程并重建进程池，
+        # 同一进程池中其它正在解析的文件会因此失败
+        logger.error(f"parsing {kb_file.filename} timed out in the parse process pool, restarting the pool")
+        future.cancel()
+        _reset_parse_process_pool(pool, terminate=True)
+        raise
+    return [Document(page_content=text, metadata=metadata) for text, metadata in result]
+
 
 def files2docs_in_thread(
         files: List[Union[KnowledgeFile, Tuple[str, str], Dict]],
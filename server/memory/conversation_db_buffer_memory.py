@@ -4,8 +4,7 @@ from typing import Any, List, Dict
 from langchain.memory.chat_memory import BaseChatMemory
 from langchain.schema import get_buffer_string, BaseMessage, HumanMessage, AIMessage
 from langchain.schema.language_model import BaseLanguageModel
-from server.db.repository.message_repository import filter_message
-from server.db.models.message_model import MessageModel
+from server.db.repository.message_repository import get_recent_messages, update_message_token_counts
 
 
 class ConversationBufferDBMemory(BaseChatMemory):
@@ -20,28 +19,35 @@ class ConversationBufferDBMemory(BaseChatMemory):
     @property
     def buffer(self) -> List[BaseMessage]:
         """String buffer of memory."""
-        # fetch limited messages desc, and return reversed
-
-        messages = filter_message(conversation_id=self.conversation_id, limit=self.message_limit)
-        # 返回的记录按时间倒序，转为正序
-        messages = list(reversed(messages))
+        # 按时间正序返回最近的 message_limit 条记录，连续多轮对话时使用缓存，不再查询数据库
+        messages = get_recent_messages(conversation_id=self.conversation_id, limit=self.message_limit)
+        # 每条消息的 token 数只计算一次并保存到数据库，不同模型的 tokenizer 不同，按模型分别记录
+        model_key = getattr(self.llm, "model_name", None) or self.llm.__class__.__name__
         chat_messages: List[BaseMessage] = []
+        tokens: List[int] = []
         for message in messages:
+            counts = message["token_counts"].get(model_key)
+            if counts is None:
+                counts = [self.llm.get_num_tokens(f"{self.human_prefix}: {message['query']}"),
+                          self.llm.get_num_tokens(f"{self.ai_prefix}: {message['response']}")]
+                message["token_counts"] = {**message["token_counts"], model_key: counts}
+                update_message_token_counts(message["id"], {model_key: counts})
             chat_messages.append(HumanMessage(content=message["query"]))
             chat_messages.append(AIMessage(content=message["response"]))
+            tokens.extend(counts)
 
         if not chat_messages:
             return []
 
         # prune the chat message if it exceeds the max token limit
-        curr_buffer_length = self.llm.get_num_tokens(get_buffer_string(chat_messages))
-        if curr_buffer_length > self.max_token_limit:
-            pruned_memory = []
-            while curr_buffer_length > self.max_token_limit and chat_messages:
-                pruned_memory.append(chat_messages.pop(0))
-                curr_buffer_length = self.llm.get_num_tokens(get_buffer_string(chat_messages))
+        # 各消息之间以换行符连接，按每个换行符 1 个 token 累计
+        curr_buffer_length = sum(tokens) + len(tokens) - 1
+        start = 0
+        while curr_buffer_length > self.max_token_limit and start < len(chat_messages):
+            curr_buffer_length -= tokens[start] + 1
+            start += 1
 
-        return chat_messages
+        return chat_messages[start:]
 
     @property
     def memory_variables(self) -> List[str]:
@@ -0,0 +1,219 @@
+'''
+请求各阶段耗时的统计，以 Prometheus 文本格式从 /metrics 接口输出。
+
+用法：
+    with span("search"):                  # 记录到当前请求的接口（set_endpoint 设置）下
+        ...
+    observe_stage("chat", "prompt", 0.01)  # 直接记录一次耗时
+    EventSourceResponse(instrument_stream(iterator(), "chat"))  # 记录首包时间、SSE 发送耗时与总耗时
+'''
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import AsyncIterable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from configs import logger, log_verbose
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_endpoint = contextvars.ContextVar("chatchat_endpoint", default="")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    items = []
+    for k, v in labels.items():
+        v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        items.append(f'{k}="{v}"')
+    return "{" + ",".join(items) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str],
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple, List] = {}  # {标签值: [各桶计数..., 总和, 总数]}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(x, "")) for x in self.labelnames)
+        with self._lock:
+            if (data := self._values.get(key)) is None:
+                data = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = {k: list(v) for k, v in self._values.items()}
+        for key, data in sorted(values.items()):
+            labels = dict(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, data):
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': repr(float(bound))})} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {data[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {data[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {data[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    '''
+    histograms 为请求过程中记录的耗时；collectors 在输出时调用，返回当前的状态值，
+    形式为 [(name, type, documentation, [(labels, value)])]，type 为 gauge 或 counter
+    '''
+    def __init__(self):
+        self._histograms: Dict[str, Histogram] = {}
+        self._collectors: List[Callable[[], List[Tuple[str, str, str, List[Tuple[Dict, float]]]]]] = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str],
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram(name, documentation, labelnames, buckets)
+            return self._histograms[name]
+
+    def add_collector(self, func: Callable):
+        with self._lock:
+            self._collectors.append(func)
+
+    def render(self) -> str:
+        lines = []
+        for histogram in list(self._histograms.values()):
+            lines += histogram.collect()
+        for collector in list(self._collectors):
+            try:
+                metrics = collector()
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: metrics collector failed: {e}",
+                             exc_info=e if log_verbose else None)
+                continue
+            for name, type, documentation, samples in metrics:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+stage_seconds = registry.histogram("chatchat_stage_seconds",
+                                   "Time spent in each stage of a request.",
+                                   ["endpoint", "stage"])
+lock_wait_seconds = registry.histogram("chatchat_cache_lock_wait_seconds",
+                                       "Time spent waiting for the lock of a cached object.",
+                                       ["pool", "mode"],
+                                       buckets=(0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+
+
+def set_endpoint(endpoint: str):
+    '''
+    设置当前请求的接口名称，之后在同一上下文（包括 run_in_threadpool 中）记录的阶段耗时都归属于该接口
+    '''
+    _endpoint.set(endpoint)
+
+
+def get_endpoint() -> str:
+    return _endpoint.get()
+
+
+def observe_stage(endpoint: Optional[str], stage: str, seconds: float):
+    endpoint = endpoint or _endpoint.get() or "unknown"
+    stage_seconds.observe(seconds, endpoint=endpoint, stage=stage)
+    if log_verbose:
+        logger.info(f"{endpoint} {stage}: {seconds * 1000:.1f}ms")
+
+
+@contextmanager
+def span(stage: str, endpoint: str = None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(endpoint, stage, time.perf_counter() - start)
+
+
+def observe_lock_wait(pool: str, shared: bool, seconds: float):
+    '''
+    记录缓存对象的锁等待时间。处于某个请求中时，同时记入该请求的 lock_wait 阶段
+    '''
+    lock_wait_seconds.observe(seconds, pool=pool, mode="read" if shared else "write")
+    if endpoint := _endpoint.get():
+        stage_seconds.observe(seconds, endpoint=endpoint, stage="lock_wait")
+
+
+async def instrument_stream(stream: Union[AsyncIterable, Iterable], endpoint: str) -> AsyncIterable:
+    '''
+    包装 SSE 生成器（同步生成器在线程池中迭代），记录：
+        first_chunk: 开始处理到生成第一个数据块的时间
+        sse_send: 等待客户端接收数据的累计时间
+        total: 整个请求的时间
+    '''
+    from starlette.concurrency import iterate_in_threadpool
+
+    if not hasattr(stream, "__aiter__"):
+        stream = iterate_in_threadpool(stream)
+    set_endpoint(endpoint)
+    start = time.perf_counter()
+    first = True
+    send = 0.0
+    try:
+        async for item in stream:
+            if first:
+                observe_stage(endpoint, "first_chunk", time.perf_counter() - start)
+                first = False
+            t = time.perf_counter()
+            yield item
+            send += time.perf_counter() - t
+    finally:
+        observe_stage(endpoint, "sse_send", send)
+        observe_stage(endpoint, "total", time.perf_counter() - start)
+
+
+async def trace_tokens(tokens: AsyncIterable, endpoint: str = None) -> AsyncIterable:
+    '''
+    包装 LLM 的 token 流，记录 llm_first_token（开始调用到第一个 token）与 llm_generate（完整生成）的时间
+    '''
+    start = time.perf_counter()
+    first = True
+    try:
+        async for token in tokens:
+            if first:
+                observe_stage(endpoint, "llm_first_token", time.perf_counter() - start)
+                first = False
+            yield token
+    finally:
+        observe_stage(endpoint, "llm_generate", time.perf_counter() - start)
+
+
+def pool_metrics(pools: Dict[str, object]) -> List[Tuple[str, str, str, List[Tuple[Dict, float]]]]:
+    '''
+    将 CachePool.stats() 转换为 collector 的输出格式，pools 为 {名称: 缓存池}
+    '''
+    stats = {name: pool.stats() for name, pool in pools.items()}
+
+    def samples(field: str) -> List[Tuple[Dict, float]]:
+        return [({"pool": name}, s.get(field, 0)) for name, s in stats.items()]
+
+    hit_rates = []
+    for name, s in stats.items():
+        total = s.get("hits", 0) + s.get("misses", 0)
+        hit_rates.append(({"pool": name}, s.get("hits", 0) / total if total else 0))
+    return [
+        ("chatchat_cache_pool_size", "gauge", "Number of objects in the cache pool.", samples("size")),
+        ("chatchat_cache_pool_memory_bytes", "gauge", "Estimated memory used by the cache pool.", samples("memory")),
+        ("chatchat_cache_pool_hits_total", "counter", "Cache pool hits.", samples("hits")),
+        ("chatchat_cache_pool_misses_total", "counter", "Cache pool misses.", samples("misses")),
+        ("chatchat_cache_pool_evictions_total", "counter", "Cache pool evictions.", samples("evictions")),
+        ("chatchat_cache_pool_hit_ratio", "gauge", "Cache pool hit ratio.", hit_rates),
+    ]
@@ -2,9 +2,21 @@ import os
 import sys
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
-from typing import Any, List, Optional
+import asyncio
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, List, Optional, Dict, Tuple
 from sentence_transformers import CrossEncoder
 from typing import Optional, Sequence
+from configs import (RERANKER_MODEL, RERANKER_MAX_LENGTH, RERANKER_BATCH_SIZE,
+                     RERANKER_BATCH_WAIT_MS, RERANKER_SCORE_CACHE_SIZE, MODEL_PATH,
+                     logger, log_verbose)
+from server.knowledge_base.kb_cache.base import CachePool, ThreadSafeObject
+from server.utils import embedding_device
 from langchain_core.documents import Document
 from langchain.callbacks.manager import Callbacks
 from langchain.retrievers.document_compressors.base import BaseDocumentCompressor
@@ -46,7 +58,10 @@ class LangchainReranker(BaseDocumentCompressor):
         # self.activation_fct=activation_fct
         # self.apply_softmax=apply_softmax
 
-        self._model = CrossEncoder(model_name=model_name_or_path, max_length=1024, device=device)
+        # 从进程级的模型池获取已加载的模型，避免每次请求重新加载权重
+        self._model = reranker_pool.load_reranker(model_name_or_path=model_name_or_path,
+                                                  device=device,
+                                                  max_length=max_length)
         super().__init__(
             top_n=top_n,
             model_name_or_path=model_name_or_path,
@@ -76,29 +91,247 @@ class LangchainReranker(BaseDocumentCompressor):
         Returns:
             A sequence of compressed documents.
         """
-        if len(documents) == 0:  # to avoid empty api call
-            return []
-        doc_list = list(documents)
-        _docs = [d.page_content for d in doc_list]
-        sentence_pairs = [[query, _doc] for _doc in _docs]
-        results = self._model.predict(sentences=sentence_pairs,
-                                      batch_size=self.batch_size,
-                                      #  show_progress_bar=self.show_progress_bar,
-                                      num_workers=self.num_workers,
-                                      #  activation_fct=self.activation_fct,
-                                      #  apply_softmax=self.apply_softmax,
-                                      convert_to_tensor=True
-                                      )
-        top_k = self.top_n if self.top_n < len(results) else len(results)
-
-        values, indices = results.topk(top_k)
+        return self._model.rerank(query=query, documents=documents, top_n=self.top_n)
+
+    async def acompress_documents(
+            self,
+            documents: Sequence[Document],
+            query: str,
+            callbacks: Optional[Callbacks] = None,
+    ) -> Sequence[Document]:
+        return await self._model.arerank(query=query, documents=documents, top_n=self.top_n)
+
+
+def _doc_key(doc: Document) -> Tuple[str, str]:
+    '''
+    文档在分数缓存中的键：(文档 id, 内容摘要)，内容被修改后不会命中旧分数
+    '''
+    doc_id = getattr(doc, "id", None) or doc.metadata.get("id") or ""
+    digest = hashlib.blake2b(doc.page_content.encode("utf-8"), digest_size=8).hexdigest()
+    return doc_id, digest
+
+
+_STOP = object()  # 批处理线程的退出标记
+
+
+class RerankerBatcher:
+    '''
+    常驻的交叉编码器及其批处理线程。
+    并发请求提交的 (query, doc) 句对在达到 max_batch_size 或等待超过 max_wait_ms 后合并为一次前向计算，
+    计算在后台线程中进行，不阻塞事件循环；分数按 (query, doc_id) 缓存。
+    key 为 (模型, 设备, max_length)。被模型池淘汰后调用 stop() 结束批处理线程。
+    '''
+    def __init__(
+            self,
+            key: Tuple[str, str, int],
+            max_batch_size: int = RERANKER_BATCH_SIZE,
+            max_wait_ms: float = RERANKER_BATCH_WAIT_MS,
+            cache_size: int = RERANKER_SCORE_CACHE_SIZE,
+    ):
+        model_name_or_path, device, max_length = key
+        self.key = key
+        self.model = CrossEncoder(model_name=model_name_or_path, max_length=max_length, device=device)
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0, max_wait_ms) / 1000
+        self.cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()  # {(query, doc_id, digest): score}
+        self._cache_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._stopped = False
+        self._stop_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f"reranker-batcher-{key[0]}")
+        self._thread.start()
+
+    def __repr__(self) -> str:
+        cls = type(self).__name__
+        return f"<{cls}: key: {self.key}, queue: {self._queue.qsize()}, cache: {len(self._cache)}>"
+
+    def _collect(self) -> Tuple[List[Tuple[Tuple, str, str, Future]], bool]:
+        '''
+        取出一个批次，返回 (批次, 是否收到退出标记)。退出标记之前入队的句对仍会被计算
+        '''
+        batch = []
+        item = self._queue.get()
+        deadline = time.monotonic() + self.max_wait
+        while item is not _STOP:
+            batch.append(item)
+            if len(batch) >= self.max_batch_size:
+                return batch, False
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                return batch, False
+        return batch, True
+
+    def _run(self):
+        while True:
+            batch, stopped = self._collect()
+            if batch:
+                self._score(batch)
+            if stopped:
+                break
+        logger.info(f"{self.key} batcher stopped")
+
+    def _score(self, batch: List[Tuple[Tuple, str, str, Future]]):
+        # 合并同一批次内重复的句对（如多个用户同时提出相同的问题）
+        pairs: Dict[Tuple, Tuple[str, str]] = {}
+        futures: Dict[Tuple, List[Future]] = {}
+        for key, query, text, future in batch:
+            pairs.setdefault(key, (query, text))
+            futures.setdefault(key, []).append(future)
+        try:
+            scores = self.model.predict(sentences=list(pairs.values()),
+                                        batch_size=len(pairs),
+                                        convert_to_numpy=True)
+            for key, score in zip(pairs, scores):
+                score = float(score)
+                self._cache_set(key, score)
+                for future in futures[key]:
+                    future.set_result(score)
+        except Exception as e:
+            for fs in futures.values():
+                for future in fs:
+                    if not future.done():
+                        future.set_exception(e)
+        if log_verbose:
+            logger.info(f"{self.key} scored a batch of {len(pairs)} pairs")
+
+    def stop(self):
+        '''
+        结束批处理线程。已入队的句对仍会完成计算；之后仍持有该对象的请求在调用线程中直接计算。
+        线程退出且不再被引用后，模型占用的显存随之释放。
+        '''
+        with self._stop_lock:
+            if not self._stopped:
+                self._stopped = True
+                self._queue.put(_STOP)
+
+    def _cache_get(self, key: Tuple) -> Optional[float]:
+        with self._cache_lock:
+            if (score := self._cache.get(key)) is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return score
+
+    def _cache_set(self, key: Tuple, score: float):
+        if self.cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[key] = score
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def submit(self, query: str, documents: Sequence[Document]) -> List[Future]:
+        '''
+        提交一个查询及其候选文档，返回与文档一一对应的 Future，结果为相关性分数
+        '''
+        futures = []
+        pending = []
+        for doc in documents:
+            key = (query, *_doc_key(doc))
+            future = Future()
+            if (score := self._cache_get(key)) is not None:
+                future.set_result(score)
+            else:
+                pending.append((key, query, doc.page_content, future))
+            futures.append(future)
+        with self._stop_lock:
+            if not self._stopped:
+                for item in pending:
+                    self._queue.put(item)
+                pending = []
+        if pending:
+            self._score(pending)
+        return futures
+
+    @staticmethod
+    def _top_n(documents: Sequence[Document], scores: List[float], top_n: int) -> List[Document]:
+        ranked = sorted(zip(documents, scores), key=lambda x: x[1], reverse=True)[:top_n]
         final_results = []
-        for value, index in zip(values, indices):
-            doc = doc_list[index]
-            doc.metadata["relevance_score"] = value
+        for doc, score in ranked:
+            doc.metadata["relevance_score"] = score
             final_results.append(doc)
         return final_results
 
+    def rerank(self, query: str, documents: Sequence[Document], top_n: int = 3) -> List[Document]:
+        if len(documents) == 0:  # to avoid empty api call
+            return []
+        scores = [f.result() for f in self.submit(query, documents)]
+        return self._top_n(documents, scores, top_n)
+
+    async def arerank(self, query: str, documents: Sequence[Document], top_n: int = 3) -> List[Document]:
+        if len(documents) == 0:
+            return []
+        futures = self.submit(query, documents)
+        scores = await asyncio.gather(*[asyncio.wrap_future(f) for f in futures])
+        return self._top_n(documents, list(scores), top_n)
+
+    def stats(self) -> Dict:
+        return {
+            "model": self.key[0],
+            "device": self.key[1],
+            "max_length": self.key[2],
+            "queue_size": self._queue.qsize(),
+            "cache_size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class RerankerPool(CachePool):
+    def load_reranker(
+            self,
+            model_name_or_path: str = None,
+            device: str = None,
+            max_length: int = RERANKER_MAX_LENGTH,
+    ) -> RerankerBatcher:
+        '''
+        获取常驻的重排模型，每个 (模型, 设备, max_length) 只加载一次
+        '''
+        model_name_or_path = model_name_or_path or MODEL_PATH["reranker"].get(RERANKER_MODEL, "BAAI/bge-reranker-large")
+        device = embedding_device(device)
+        key = (model_name_or_path, device, max_length)
+        self.atomic.acquire()
+        if not (item := self.get(key)):
+            item = ThreadSafeObject(key, pool=self)
+            self.set(key, item)
+            with item.acquire(msg="初始化"):
+                self.atomic.release()
+                try:
+                    item.obj = RerankerBatcher(key)
+                except Exception:
+                    self.pop(key)
+                    raise
+                item.finish_loading()
+        else:
+            self.atomic.release()
+        return item.obj
+
+    def _on_evict(self, key: Tuple, item: ThreadSafeObject):
+        if item is not None and item.obj is not None:
+            item.obj.stop()
+
+    def pop(self, key: Tuple = None) -> ThreadSafeObject:
+        popped = super().pop(key)
+        if popped is not None:
+            self._on_evict(*(popped if key is None else (key, popped)))
+        return popped
+
+    def stats(self) -> List[Dict]:
+        return [item.obj.stats() for item in list(self._cache.values()) if item.obj is not None]
+
+
+reranker_pool = RerankerPool(cache_num=1)
+
 
 if __name__ == "__main__":
     from configs import (LLM_MODELS,
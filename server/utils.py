@@ -6,8 +6,13 @@ from pathlib import Path
 import asyncio
 from configs import (LLM_MODELS, LLM_DEVICE, EMBEDDING_DEVICE,
                      MODEL_PATH, MODEL_ROOT_PATH, ONLINE_LLM_MODEL, logger, log_verbose,
-                     FSCHAT_MODEL_WORKERS, HTTPX_DEFAULT_TIMEOUT)
+                     FSCHAT_MODEL_WORKERS, HTTPX_DEFAULT_TIMEOUT,
+                     HTTPX_MAX_CONNECTIONS, HTTPX_MAX_KEEPALIVE_CONNECTIONS, HTTPX_KEEPALIVE_EXPIRY, HTTPX_HTTP2)
 import os
+import importlib.util
+import threading
+import weakref
+from functools import lru_cache
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from langchain.chat_models import ChatOpenAI
 from langchain.llms import OpenAI
@@ -31,9 +36,10 @@ from server.minx_chat_openai import MinxChatOpenAI
 
 
 async def wrap_done(fn: Awaitable, event: asyncio.Event):
-    """Wrap an awaitable with a event to signal when it's done or an exception is raised."""
+    """Wrap an awaitable with a event to signal when it's done or an exception is raised.
+    Returns the result of the awaitable, or None if an exception is raised."""
     try:
-        await fn
+        return await fn
     except Exception as e:
         logging.exception(e)
         msg = f"Caught exception: {e}"
@@ -44,6 +50,46 @@ async def wrap_done(fn: Awaitable, event: asyncio.Event):
         event.set()
 
 
+def _use_shared_http_clients(
+        model: Union[ChatOpenAI, OpenAI],
+        proxy: Union[str, Dict] = None,
+        resource: Literal["chat.completions", "completions"] = "chat.completions",
+):
+    '''
+    langchain 的 OpenAI 模型默认每次创建时新建 httpx client，改为使用共享连接池，流式输出同样复用已建立的连接。
+    自定义了 http_client 或 openai 版本不支持时保持原样
+    '''
+    if getattr(model, "http_client", None) is not None:
+        return
+    try:
+        import openai
+        if not hasattr(openai, "AsyncOpenAI"):
+            return
+        timeout = model.request_timeout
+        if not isinstance(timeout, (int, float)):
+            timeout = HTTPX_DEFAULT_TIMEOUT
+        params = dict(api_key=model.openai_api_key,
+                      organization=model.openai_organization,
+                      base_url=model.openai_api_base,
+                      timeout=timeout,
+                      max_retries=model.max_retries,
+                      default_headers=getattr(model, "default_headers", None),
+                      default_query=getattr(model, "default_query", None))
+
+        def get_resource(client):
+            for name in resource.split("."):
+                client = getattr(client, name)
+            return client
+
+        model.client = get_resource(openai.OpenAI(
+            **params, http_client=get_httpx_client(proxies=proxy, timeout=timeout)))
+        model.async_client = get_resource(openai.AsyncOpenAI(
+            **params, http_client=get_httpx_client(use_async=True, proxies=proxy, timeout=timeout)))
+    except Exception as e:
+        logger.error(f"{e.__class__.__name__}: failed to use shared http clients for {model.model_name}: {e}",
+                     exc_info=e if log_verbose else None)
+
+
 def get_ChatOpenAI(
         model_name: str,
         temperature: float,
@@ -69,6 +115,7 @@ def get_ChatOpenAI(
         openai_proxy=config.get("openai_proxy"),
         **kwargs
     )
+    _use_shared_http_clients(model, proxy=config.get("openai_proxy"), resource="chat.completions")
     return model
 
 
@@ -98,6 +145,7 @@ def get_OpenAI(
         echo=echo,
         **kwargs
     )
+    _use_shared_http_clients(model, proxy=config.get("openai_proxy"), resource="completions")
     return model
 
 
@@ -553,15 +601,52 @@ def run_in_thread_pool(
             yield obj.result()
 
 
-def get_httpx_client(
-        use_async: bool = False,
-        proxies: Union[str, Dict] = None,
-        timeout: float = HTTPX_DEFAULT_TIMEOUT,
-        **kwargs,
-) -> Union[httpx.Client, httpx.AsyncClient]:
+class _SharedClient(httpx.Client):
     '''
-    helper to get httpx client with default proxies that bypass local addesses.
+    进程内共享的 httpx.Client。with 语句与 close() 不会关闭连接池，以便后续请求复用连接
     '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def force_close(self):
+        super().close()
+
+
+class _SharedAsyncClient(httpx.AsyncClient):
+    '''
+    在同一事件循环内共享的 httpx.AsyncClient，async with 语句与 aclose() 不会关闭连接池
+    '''
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def aclose(self):
+        pass
+
+    async def force_close(self):
+        await super().aclose()
+
+
+_HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+# {(use_async, 事件循环id, 参数): (事件循环弱引用 | None, client)}
+_httpx_clients: Dict[Tuple, Tuple[Optional[Callable], Union[httpx.Client, httpx.AsyncClient]]] = {}
+_httpx_clients_lock = threading.Lock()
+
+
+@lru_cache()
+def _get_default_proxies(env: Tuple[str, str, str, str]) -> Dict:
+    '''
+    根据 (http_proxy, https_proxy, all_proxy, no_proxy) 环境变量生成默认代理设置，环境变量不变时直接使用缓存结果
+    '''
+    http_proxy, https_proxy, all_proxy, no_proxy = env
     default_proxies = {
         # do not use proxy for locahost
         "all://127.0.0.1": None,
@@ -579,20 +664,31 @@ def get_httpx_client(
     # get proxies from system envionrent
     # proxy not str empty string, None, False, 0, [] or {}
     default_proxies.update({
-        "http://": (os.environ.get("http_proxy")
-                    if os.environ.get("http_proxy") and len(os.environ.get("http_proxy").strip())
-                    else None),
-        "https://": (os.environ.get("https_proxy")
-                     if os.environ.get("https_proxy") and len(os.environ.get("https_proxy").strip())
-                     else None),
-        "all://": (os.environ.get("all_proxy")
-                   if os.environ.get("all_proxy") and len(os.environ.get("all_proxy").strip())
-                   else None),
+        "http://": http_proxy if http_proxy.strip() else None,
+        "https://": https_proxy if https_proxy.strip() else None,
+        "all://": all_proxy if all_proxy.strip() else None,
     })
-    for host in os.environ.get("no_proxy", "").split(","):
+    for host in no_proxy.split(","):
         if host := host.strip():
             # default_proxies.update({host: None}) # Origin code
             default_proxies.update({'all://' + host: None})  # PR 1838 fix, if not add 'all://', httpx will raise error
+    return default_proxies
+
+
+def get_httpx_client(
+        use_async: bool = False,
+        proxies: Union[str, Dict] = None,
+        timeout: float = HTTPX_DEFAULT_TIMEOUT,
+        shared: bool = True,
+        **kwargs,
+) -> Union[httpx.Client, httpx.AsyncClient]:
+    '''
+    helper to get httpx client with default proxies that bypass local addesses.
+    shared=True 时，参数相同的调用返回同一个带连接池的 client（异步 client 按事件循环区分），
+    调用方仍可使用 with 语句，退出时不会关闭连接；shared=False 时返回新建的 client，由调用方负责关闭。
+    '''
+    env = tuple(os.environ.get(x) or "" for x in ["http_proxy", "https_proxy", "all_proxy", "no_proxy"])
+    default_proxies = dict(_get_default_proxies(env))
 
     # merge default proxies with user provided proxies
     if isinstance(proxies, str):
@@ -603,14 +699,63 @@ def get_httpx_client(
 
     # construct Client
     kwargs.update(timeout=timeout, proxies=default_proxies)
+    kwargs.setdefault("limits", httpx.Limits(max_connections=HTTPX_MAX_CONNECTIONS,
+                                             max_keepalive_connections=HTTPX_MAX_KEEPALIVE_CONNECTIONS,
+                                             keepalive_expiry=HTTPX_KEEPALIVE_EXPIRY))
+    if HTTPX_HTTP2 and _HTTP2_AVAILABLE:
+        kwargs.setdefault("http2", True)
 
     if log_verbose:
         logger.info(f'{get_httpx_client.__class__.__name__}:kwargs: {kwargs}')
 
+    loop = None
     if use_async:
-        return httpx.AsyncClient(**kwargs)
-    else:
-        return httpx.Client(**kwargs)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 不在事件循环中时无法确定连接所属的循环，不共享
+            shared = False
+
+    if not shared:
+        if use_async:
+            return httpx.AsyncClient(**kwargs)
+        else:
+            return httpx.Client(**kwargs)
+
+    key = (use_async, id(loop), repr(sorted(kwargs.items(), key=lambda x: x[0])))
+    with _httpx_clients_lock:
+        if (item := _httpx_clients.get(key)) is not None:
+            loop_ref, client = item
+            if loop_ref is None or loop_ref() is loop:
+                return client
+        # 清理已关闭的事件循环上的 client
+        for k, (loop_ref, _) in list(_httpx_clients.items()):
+            if loop_ref is not None and (loop_ref() is None or loop_ref().is_closed()):
+                _httpx_clients.pop(k)
+        if use_async:
+            client = _SharedAsyncClient(**kwargs)
+            _httpx_clients[key] = (weakref.ref(loop), client)
+        else:
+            client = _SharedClient(**kwargs)
+            _httpx_clients[key] = (None, client)
+        return client
+
+
+async def close_httpx_clients():
+    '''
+    关闭共享的同步 client 及当前事件循环上的异步 client，在服务退出时调用
+    '''
+    loop = asyncio.get_running_loop()
+    with _httpx_clients_lock:
+        items = list(_httpx_clients.items())
+        for k, (loop_ref, _) in items:
+            if loop_ref is None or loop_ref() is loop:
+                _httpx_clients.pop(k)
+    for _, (loop_ref, client) in items:
+        if loop_ref is None:
+            client.force_close()
+        elif loop_ref() is loop:
+            await client.force_close()
 
 
 def get_server_configs() -> Dict:
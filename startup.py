@@ -34,6 +34,7 @@ from configs import (
     API_SERVER,
     WEBUI_SERVER,
     HTTPX_DEFAULT_TIMEOUT,
+    PARSE_IN_PROCESS_POOL,
 )
 from server.utils import (fschat_controller_address, fschat_model_worker_address,
                           fschat_openai_api_address, get_httpx_client, get_model_worker_config,
@@ -777,7 +778,8 @@ async def start_main_server():
             target=run_api_server,
             name=f"API Server",
             kwargs=dict(started_event=api_started, run_mode=run_mode),
-            daemon=True,
+            # 守护进程不能创建子进程，启用文档解析进程池时 API 服务不能是守护进程（退出时由下方 finally 统一结束）
+            daemon=not PARSE_IN_PROCESS_POOL,
         )
         processes["api"] = process
 
@@ -4,8 +4,10 @@ root_path = Path(__file__).parent.parent.parent
 sys.path.append(str(root_path))
 
 from webui_pages.utils import ApiRequest
+from server.utils import api_address
 
 import pytest
+import requests
 from pprint import pprint
 from typing import List
 
@@ -45,3 +47,16 @@ def test_get_prompt_template(type):
     print(template)
     assert isinstance(template, str)
     assert len(template) > 0
+
+
+def test_metrics():
+    # 先触发一次带阶段统计的请求，确保至少有一个阶段耗时直方图
+    r = requests.post(api_address() + "/knowledge_base/delete_docs",
+                      json={"knowledge_base_name": "samples", "file_names": []})
+    assert r.status_code == 200
+
+    r = requests.get(api_address() + "/metrics")
+    print(r.text[:1000])
+    assert r.status_code == 200
+    assert "# TYPE chatchat_stage_seconds histogram" in r.text
+    assert 'chatchat_stage_seconds_count{endpoint="delete_docs",stage="save_vector_store"}' in r.text
@@ -0,0 +1,57 @@
+import random
+import sys
+from pathlib import Path
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import pytest
+from text_splitter import ChineseRecursiveTextSplitter
+from text_splitter.chinese_recursive_text_splitter import SAMPLE_TEXT
+
+
+_PIECES = list("中国对外贸易形势报告") + ["。", "！", "？", ". ", "! ", "; ", "；", "，", ", ",
+                                         "\n", "\n\n", "\n\n\n", " ", "abc", "   "]
+
+
+def random_texts(n: int, seed: int = 0):
+    rng = random.Random(seed)
+    for _ in range(n):
+        yield "".join(rng.choice(_PIECES) for _ in range(rng.randint(0, 400))), rng
+
+
+def assert_same(splitter: ChineseRecursiveTextSplitter, text: str):
+    assert splitter.split_text(text) == splitter._split_text(text, splitter._separators)
+
+
+@pytest.mark.parametrize("chunk_size,chunk_overlap", [(50, 0), (250, 50), (1000, 200)])
+def test_sample(chunk_size, chunk_overlap):
+    assert_same(ChineseRecursiveTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap), SAMPLE_TEXT * 3)
+
+
+@pytest.mark.parametrize("length_function", [len, lambda x: len(x.encode("utf-8"))])
+def test_random_texts(length_function):
+    for text, rng in random_texts(1000):
+        chunk_size = rng.randint(1, 80)
+        splitter = ChineseRecursiveTextSplitter(chunk_size=chunk_size,
+                                                chunk_overlap=rng.randint(0, chunk_size),
+                                                length_function=length_function)
+        assert_same(splitter, text)
+
+
+@pytest.mark.parametrize("separators,is_separator_regex", [(["\n\n", "\n", "。", ""], False),
+                                                           ([". ", "，|,\\s", ""], True)])
+def test_custom_separators(separators, is_separator_regex):
+    for text, rng in random_texts(500, seed=1):
+        chunk_size = rng.randint(1, 60)
+        splitter = ChineseRecursiveTextSplitter(separators=separators,
+                                                is_separator_regex=is_separator_regex,
+                                                chunk_size=chunk_size,
+                                                chunk_overlap=rng.randint(0, chunk_size))
+        assert_same(splitter, text)
+
+
+def test_split_texts():
+    splitter = ChineseRecursiveTextSplitter(chunk_size=100, chunk_overlap=20)
+    texts = [SAMPLE_TEXT, "", SAMPLE_TEXT[:300]]
+    assert splitter.split_texts(texts) == [splitter.split_text(x) for x in texts]
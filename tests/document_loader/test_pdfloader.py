@@ -19,3 +19,10 @@ def test_rapidocrpdfloader():
     assert isinstance(docs, list) and len(docs) > 0 and isinstance(docs[0].page_content, str)
 
 
+def test_rapidocrpdfloader_lazy_load():
+    pdf_path = test_files["ocr_test.pdf"]
+    from document_loaders import RapidOCRPDFLoader
+
+    loader = RapidOCRPDFLoader(pdf_path)
+    pages = [doc.metadata["page"] for doc in loader.lazy_load()]
+    assert len(pages) > 0 and pages == sorted(pages) and pages[0] >= 1
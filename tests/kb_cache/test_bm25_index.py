@@ -0,0 +1,28 @@
+import sys
+from pathlib import Path
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+from server.knowledge_base.kb_cache.bm25_cache import BM25Index, tokenize
+
+
+def test_tokenize():
+    tokens = tokenize("错误码 E-1024 出现在知识库")
+    assert "e-1024" in tokens and "1024" in tokens
+    assert "知识" in tokens or "知识库" in tokens
+
+
+def test_search_and_delete():
+    index = BM25Index()
+    index.add(["a", "b", "c"], ["错误码 E-1024 导致启动失败", "如何启动 api 服务", "知识库问答使用向量检索"])
+    assert index.search("E-1024", 3)[0][0] == "a"
+    assert index.search("启动服务", 3)[0][0] == "b"
+
+    index.delete(["a"])
+    assert len(index) == 2
+    assert index.search("E-1024", 3) == []
+
+    index.add(["b"], ["错误码 E-1024"])  # 相同 id 覆盖旧内容
+    assert len(index) == 2
+    assert [id for id, _ in index.search("E-1024", 3)] == ["b"]
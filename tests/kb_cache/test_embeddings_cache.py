@@ -0,0 +1,48 @@
+import sys
+from pathlib import Path
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+from server.knowledge_base.kb_cache.embeddings_cache import EmbeddingsCache, make_cache_key
+
+
+def test_cache_key():
+    assert make_cache_key("m", " hello ") == make_cache_key("m", "hello")
+    assert make_cache_key("m", "hello") != make_cache_key("m", "hello", to_query=True)
+    assert make_cache_key("m", "hello") != make_cache_key("n", "hello")
+
+
+def test_get_set_and_reload(tmp_path):
+    cache = EmbeddingsCache("test-model", path=str(tmp_path), max_size=1)
+    keys = [make_cache_key("test-model", t) for t in ["a", "b"]]
+    assert cache.get_many(keys) == [None, None]
+
+    cache.set_many(keys, [[1.0, 0.0], [0.0, 1.0]])
+    assert cache.get_many(keys) == [[1.0, 0.0], [0.0, 1.0]]
+
+    reloaded = EmbeddingsCache("test-model", path=str(tmp_path), max_size=1)
+    assert len(reloaded) == 2
+    assert reloaded.get_many(keys[1:]) == [[0.0, 1.0]]
+
+
+def test_lru_eviction(tmp_path):
+    cache = EmbeddingsCache("test-model", path=str(tmp_path), max_size=1)
+    cache.max_size = 0  # 容量退化为 1，便于验证淘汰
+    keys = [make_cache_key("test-model", t) for t in ["a", "b"]]
+    cache.set_many(keys[:1], [[1.0, 2.0]])
+    cache.set_many(keys[1:], [[3.0, 4.0]])
+    assert cache.capacity == 1
+    assert cache.get_many(keys) == [None, [3.0, 4.0]]
+
+
+def test_overwritten_slot_is_miss(tmp_path):
+    cache = EmbeddingsCache("test-model", path=str(tmp_path), max_size=1)
+    keys = [make_cache_key("test-model", t) for t in ["a", "b"]]
+    cache.set_many(keys, [[1.0, 0.0], [0.0, 1.0]])
+
+    # 模拟另一个进程写入了一半：只改写了向量，校验和未更新
+    other = EmbeddingsCache("test-model", path=str(tmp_path), max_size=1)
+    other._vectors[other._index[keys[0]]] = [5.0, 5.0]
+    assert cache.get_many(keys) == [None, [0.0, 1.0]]
+    assert len(cache) == 1
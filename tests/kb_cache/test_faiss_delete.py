@@ -0,0 +1,119 @@
+import sys
+import threading
+from pathlib import Path
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import numpy as np
+import pytest
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.vectorstores.faiss import FAISS
+
+from benchmarks.fakes import FakeEmbeddings
+import server.knowledge_base.kb_cache.faiss_cache as faiss_cache
+from server.knowledge_base.kb_cache.faiss_cache import ThreadSafeFaiss
+from server.knowledge_base.kb_cache.faiss_index import new_index, train_index, reconstruct_labels, with_search_params
+
+
+DIM = 32
+PARAMS = {"nlist": 4, "nprobe": 4, "m": 4, "nbits": 4, "M": 16, "efConstruction": 40, "efSearch": 64}
+
+
+def make_vs(index_type: str) -> ThreadSafeFaiss:
+    embeddings = FakeEmbeddings(DIM)
+    index = new_index(index_type, DIM, PARAMS)
+    vectors = np.random.default_rng(0).standard_normal((500, DIM)).astype(np.float32)
+    train_index(index, vectors, PARAMS)
+    vs = FAISS(embeddings, index, InMemoryDocstore(), {})
+    item = ThreadSafeFaiss("test_faiss", obj=vs)
+    item.set_index_config(index_type, PARAMS)
+    return item
+
+
+def add(item: ThreadSafeFaiss, texts):
+    embeddings = item._obj.embedding_function.embed_documents(texts)
+    return item.add_embeddings(texts, embeddings, [{"source": t} for t in texts])
+
+
+def search(item: ThreadSafeFaiss, text: str, k: int = 1):
+    with item.acquire(shared=True) as vs:
+        vs = with_search_params(vs, sel=item.id_selector())
+        return vs.similarity_search_by_vector(vs.embedding_function.embed_query(text), k=k)
+
+
+def check(item: ThreadSafeFaiss, texts, exact: bool = True):
+    with item.acquire(shared=True) as vs:
+        assert len(vs.docstore._dict) == len(vs.index_to_docstore_id) == len(texts)
+        assert set(vs.index_to_docstore_id.values()) == set(vs.docstore._dict)
+    for text in texts:
+        docs = search(item, text, k=3)
+        assert docs and all(doc.page_content in texts for doc in docs)
+        if exact:
+            assert docs[0].page_content == text
+
+
+@pytest.mark.parametrize("index_type", ["ivf_flat", "ivf_pq", "hnsw"])
+def test_add_delete_add_search(index_type):
+    item = make_vs(index_type)
+    with item.acquire():
+        ids = add(item, [f"doc {i}" for i in range(50)])
+        item.delete(ids[10:30])
+        add(item, [f"new doc {i}" for i in range(20)])
+        item.delete(ids[40:45])
+
+    texts = ([f"doc {i}" for i in range(10)] + [f"doc {i}" for i in range(30, 40)]
+             + [f"doc {i}" for i in range(45, 50)] + [f"new doc {i}" for i in range(20)])
+    check(item, texts, exact=index_type != "ivf_pq")
+
+
+def test_ivf_delete_keeps_codes():
+    # 删除不应重新编码其余向量，否则 PQ 索引每次删除都会损失精度
+    item = make_vs("ivf_pq")
+    with item.acquire() as vs:
+        ids = add(item, [f"doc {i}" for i in range(50)])
+        labels = np.array(sorted(vs.index_to_docstore_id)[30:], dtype=np.int64)
+        before = reconstruct_labels(vs.index, labels)
+        item.delete(ids[:30])
+        assert sorted(vs.index_to_docstore_id) == labels.tolist()
+        assert np.array_equal(reconstruct_labels(vs.index, labels), before)
+
+
+def test_hnsw_tombstones_and_rebuild():
+    item = make_vs("hnsw")
+    with item.acquire() as vs:
+        ids = add(item, [f"doc {i}" for i in range(50)])
+        item.delete(ids[:20])
+        assert vs.index.ntotal == 50  # 只做了标记
+    assert item.needs_rebuild()
+    check(item, [f"doc {i}" for i in range(20, 50)])
+
+    assert item.rebuild_index()
+    with item.acquire(shared=True) as vs:
+        assert vs.index.ntotal == 30
+        assert item.id_selector() is None
+    check(item, [f"doc {i}" for i in range(20, 50)])
+
+
+def test_rebuild_replays_concurrent_changes(monkeypatch):
+    item = make_vs("hnsw")
+    with item.acquire():
+        ids = add(item, [f"doc {i}" for i in range(50)])
+        item.delete(ids[:20])
+
+    origin_new_index = faiss_cache.new_index
+
+    def write_while_rebuilding(*args, **kwargs):
+        # 在锁外构建新索引期间，由另一个线程写入
+        def writer():
+            with item.acquire():
+                add(item, ["added during rebuild"])
+                item.delete(ids[20:25])
+        t = threading.Thread(target=writer)
+        t.start()
+        t.join()
+        return origin_new_index(*args, **kwargs)
+
+    monkeypatch.setattr(faiss_cache, "new_index", write_while_rebuilding)
+    assert item.rebuild_index()
+    check(item, [f"doc {i}" for i in range(25, 50)] + ["added during rebuild"])
@@ -0,0 +1,69 @@
+import sys
+import threading
+import time
+from pathlib import Path
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import faiss
+from langchain.docstore.in_memory import InMemoryDocstore
+from langchain.vectorstores.faiss import FAISS
+
+from benchmarks.fakes import FakeEmbeddings
+from server.knowledge_base.kb_cache.faiss_cache import ThreadSafeFaiss
+
+
+DIM = 32
+
+
+def test_search_during_slow_save_with_pending_writer(tmp_path, monkeypatch):
+    embeddings = FakeEmbeddings(DIM)
+    item = ThreadSafeFaiss("test_save", obj=FAISS(embeddings, faiss.IndexFlatL2(DIM), InMemoryDocstore(), {}))
+    texts = [f"doc {i}" for i in range(20)]
+    with item.acquire():
+        item.add_embeddings(texts, embeddings.embed_documents(texts), [{} for _ in texts])
+
+    saving = threading.Event()
+    finish_save = threading.Event()
+    serialize_index = faiss.serialize_index
+
+    def slow_serialize_index(index):
+        saving.set()
+        finish_save.wait(timeout=10)
+        return serialize_index(index)
+
+    monkeypatch.setattr(faiss, "serialize_index", slow_serialize_index)
+    saver = threading.Thread(target=item.save, args=(str(tmp_path),))
+    saver.start()
+    assert saving.wait(timeout=5)
+
+    def write():
+        with item.acquire():
+            item.add_embeddings(["new doc"], embeddings.embed_documents(["new doc"]), [{}])
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    while not item._lock._writers_waiting:
+        time.sleep(0.01)
+
+    result = []
+
+    def search():
+        with item.acquire(shared=True) as vs:
+            result.extend(vs.similarity_search_by_vector(embeddings.embed_query("doc 3"), k=1))
+
+    searcher = threading.Thread(target=search)
+    searcher.start()
+    searcher.join(timeout=2)
+    try:
+        assert not searcher.is_alive(), "search blocked behind the save and the pending writer"
+        assert result[0].page_content == "doc 3"
+    finally:
+        finish_save.set()
+        saver.join()
+        writer.join()
+        searcher.join()
+    assert (tmp_path / "index.faiss").is_file()
+    with item.acquire(shared=True) as vs:
+        assert len(vs.docstore._dict) == 21
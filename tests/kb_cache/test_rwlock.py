@@ -0,0 +1,90 @@
+import sys
+import threading
+import time
+from pathlib import Path
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+from server.knowledge_base.kb_cache.base import RWLock
+
+
+def test_concurrent_readers():
+    lock = RWLock()
+    inside = []
+    barrier = threading.Barrier(3, timeout=5)
+
+    def reader():
+        lock.acquire_read()
+        inside.append(1)
+        barrier.wait()  # 三个读者必须能同时持有读锁
+        lock.release_read()
+
+    threads = [threading.Thread(target=reader) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(inside) == 3 and not lock.locked
+
+
+def test_writer_excludes_readers():
+    lock = RWLock()
+    events = []
+    lock.acquire_write()
+
+    def reader():
+        lock.acquire_read()
+        events.append("read")
+        lock.release_read()
+
+    t = threading.Thread(target=reader)
+    t.start()
+    time.sleep(0.1)
+    events.append("write done")
+    lock.release_write()
+    t.join()
+    assert events == ["write done", "read"]
+
+
+def test_reentrant():
+    lock = RWLock()
+    lock.acquire_write()
+    lock.acquire_write()
+    lock.acquire_read()
+    lock.release_read()
+    lock.release_write()
+    lock.release_write()
+    lock.acquire_read()
+    lock.acquire_read()
+    lock.release_read()
+    lock.release_read()
+    assert not lock.locked
+
+
+def test_readers_pass_waiting_writer_during_snapshot():
+    lock = RWLock()
+    lock.acquire_read(snapshot=True)
+    writer_done = threading.Event()
+
+    def writer():
+        lock.acquire_write()
+        writer_done.set()
+        lock.release_write()
+
+    t = threading.Thread(target=writer, daemon=True)
+    t.start()
+    while not lock._writers_waiting:
+        time.sleep(0.01)
+
+    # 有快照读者时，新的读者不必等待写者
+    reader = threading.Thread(target=lambda: (lock.acquire_read(), lock.release_read()), daemon=True)
+    reader.start()
+    reader.join(timeout=2)
+    try:
+        assert not reader.is_alive()
+        assert not writer_done.is_set()
+    finally:
+        lock.release_read(snapshot=True)
+    t.join(timeout=2)
+    assert writer_done.is_set() and not lock.locked
@@ -0,0 +1,30 @@
+import sys
+from pathlib import Path
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+import server.knowledge_base.kb_cache.search_cache as search_cache
+from server.knowledge_base.kb_cache.search_cache import LRUCache
+
+
+def test_ttl_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(search_cache.time, "monotonic", lambda: now[0])
+    cache = LRUCache(10, ttl=60)
+    cache.set("samples", ["doc"])
+    now[0] += 30
+    assert cache.get("samples") == ["doc"]
+    now[0] += 31
+    assert cache.get("samples") is None
+    assert len(cache) == 0
+
+
+def test_lru_without_ttl():
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
@@ -0,0 +1,48 @@
+import sys
+from pathlib import Path
+
+root_path = Path(__file__).parent.parent.parent
+sys.path.append(str(root_path))
+
+from benchmarks.fakes import install_fake_embeddings
+from server.knowledge_base.kb_cache.faiss_cache import ThreadSafeFaiss
+from server.knowledge_base.kb_service.faiss_kb_service import FaissKBService
+from server.knowledge_base.migrate import create_tables
+from server.knowledge_base.utils import KnowledgeFile, get_file_path
+
+
+test_kb_name = "test_incremental"
+test_file_name = "incremental.txt"
+
+
+def write_file(paragraphs):
+    path = Path(get_file_path(test_kb_name, test_file_name))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("\n\n".join(paragraphs), encoding="utf-8")
+
+
+def test_incremental_update_not_refresh_vs_cache(monkeypatch):
+    install_fake_embeddings(dim=64)
+    create_tables()
+    kb = FaissKBService(test_kb_name)
+    if kb.exists():
+        kb.drop_kb()
+    kb.create_kb()
+    try:
+        paragraphs = [f"第{i}段。" + f"这是第{i}段的内容，用于测试增量更新。" * 10 for i in range(10)]
+        write_file(paragraphs)
+        assert kb.add_doc(KnowledgeFile(test_file_name, test_kb_name))
+
+        writes = []
+        monkeypatch.setattr(ThreadSafeFaiss, "save", lambda self, *args, **kwargs: writes.append("save"))
+        monkeypatch.setattr(ThreadSafeFaiss, "schedule_save", lambda self, *args, **kwargs: writes.append("schedule"))
+        monkeypatch.setattr(ThreadSafeFaiss, "append_wal", lambda self, op, **data: writes.append(op))
+
+        paragraphs[3] = "第3段已经修改。" * 20
+        write_file(paragraphs)
+        added, removed = kb.update_doc_incremental(KnowledgeFile(test_file_name, test_kb_name),
+                                                   not_refresh_vs_cache=True)
+        assert added > 0 and removed > 0
+        assert writes == []
+    finally:
+        kb.drop_kb()
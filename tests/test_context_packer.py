@@ -0,0 +1,35 @@
+import sys
+from pathlib import Path
+
+root_path = Path(__file__).parent.parent
+sys.path.append(str(root_path))
+
+from langchain.docstore.document import Document
+from server.chat.context_packer import merge_docs, pack_context, _estimate_tokens
+import server.chat.context_packer as context_packer
+
+
+text = "知识库问答系统的部署步骤如下：首先安装依赖，然后初始化数据库，最后启动服务并检查日志输出是否正常。"
+
+
+def test_merge_overlapping_chunks():
+    docs = [Document(page_content=text[20:], metadata={"source": "a.txt"}),
+            Document(page_content="另一个文件中的内容，与部署无关。", metadata={"source": "b.txt"}),
+            Document(page_content=text[:30], metadata={"source": "a.txt"})]
+    merged = merge_docs(docs)
+    assert [x.page_content for x in merged] == [text, "另一个文件中的内容，与部署无关。"]
+
+
+def test_drop_near_duplicates():
+    docs = [Document(page_content=text, metadata={"source": "a.txt"}),
+            Document(page_content=text[:-1] + "！", metadata={"source": "b.txt"})]
+    assert len(merge_docs(docs)) == 1
+
+
+def test_token_budget(monkeypatch):
+    monkeypatch.setattr(context_packer, "get_token_counter", lambda model_name: _estimate_tokens)
+    docs = [Document(page_content=text, metadata={"source": "a.txt"}),
+            Document(page_content="另一个文件中的内容，与部署无关。", metadata={"source": "b.txt"})]
+    context, packed = pack_context(docs, "any-model", token_budget=20)
+    assert len(packed) == 1
+    assert _estimate_tokens(context) <= 20 and text.startswith(context)
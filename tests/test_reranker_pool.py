@@ -0,0 +1,37 @@
+import sys
+from pathlib import Path
+
+root_path = Path(__file__).parent.parent
+sys.path.append(str(root_path))
+
+from langchain_core.documents import Document
+import server.reranker.reranker as reranker
+
+
+class FakeCrossEncoder:
+    def __init__(self, model_name, max_length=None, device=None):
+        self.max_length = max_length
+
+    def predict(self, sentences, batch_size=32, convert_to_numpy=True):
+        return [float(len(text)) for _, text in sentences]
+
+
+def test_eviction_stops_batcher(monkeypatch):
+    monkeypatch.setattr(reranker, "CrossEncoder", FakeCrossEncoder)
+    pool = reranker.RerankerPool(cache_num=1)
+    docs = [Document(page_content="短"), Document(page_content="较长的文本")]
+
+    first = pool.load_reranker("model-a", "cpu", max_length=512)
+    assert first.model.max_length == 512
+    assert first.rerank("q", docs, top_n=1)[0].page_content == "较长的文本"
+    assert pool.load_reranker("model-a", "cpu", max_length=1024) is not first
+
+    first._thread.join(timeout=5)
+    assert not first._thread.is_alive()
+    # 被淘汰后仍持有对象的请求在调用线程中直接计算
+    assert first.rerank("q2", docs, top_n=1)[0].page_content == "较长的文本"
+
+    second = pool.load_reranker("model-a", "cpu", max_length=1024)
+    pool.pop(second.key)
+    second._thread.join(timeout=5)
+    assert not second._thread.is_alive()
@@ -14,6 +14,7 @@ from configs import (
     OVERLAP_SIZE,
     ZH_TITLE_ENHANCE,
     VECTOR_SEARCH_TOP_K,
+    DEFAULT_SEARCH_MODE,
     SEARCH_ENGINE_TOP_K,
     HTTPX_DEFAULT_TIMEOUT,
     logger, log_verbose,
@@ -344,6 +345,7 @@ class ApiRequest:
             temperature: float = TEMPERATURE,
             max_tokens: int = None,
             prompt_name: str = "default",
+            search_mode: str = DEFAULT_SEARCH_MODE,
     ):
         '''
         对应api.py/chat/knowledge_base_chat接口
@@ -359,6 +361,7 @@ class ApiRequest:
             "temperature": temperature,
             "max_tokens": max_tokens,
             "prompt_name": prompt_name,
+            "search_mode": search_mode,
         }
 
         # print(f"received input message:")
@@ -506,6 +509,8 @@ class ApiRequest:
             knowledge_base_name: str,
             vector_store_type: str = DEFAULT_VS_TYPE,
             embed_model: str = EMBEDDING_MODEL,
+            index_type: str = "",
+            index_params: dict = {},
     ):
         '''
         对应api.py/knowledge_base/create_knowledge_base接口
@@ -514,6 +519,8 @@ class ApiRequest:
             "knowledge_base_name": knowledge_base_name,
             "vector_store_type": vector_store_type,
             "embed_model": embed_model,
+            "index_type": index_type,
+            "index_params": index_params,
         }
 
         response = self.post(
@@ -558,6 +565,8 @@ class ApiRequest:
             score_threshold: int = SCORE_THRESHOLD,
             file_name: str = "",
             metadata: dict = {},
+            search_params: dict = {},
+            search_mode: str = DEFAULT_SEARCH_MODE,
     ) -> List:
         '''
         对应api.py/knowledge_base/search_docs接口
@@ -569,6 +578,8 @@ class ApiRequest:
             "score_threshold": score_threshold,
             "file_name": file_name,
             "metadata": metadata,
+            "search_params": search_params,
+            "search_mode": search_mode,
         }
 
         response = self.post(
@@ -680,6 +691,22 @@ class ApiRequest:
         )
         return self._get_response_value(response, as_json=True)
 
+    def update_kb_index(self, knowledge_base_name, index_type, index_params: dict = {}):
+        '''
+        对应api.py/knowledge_base/update_index接口
+        '''
+        data = {
+            "knowledge_base_name": knowledge_base_name,
+            "index_type": index_type,
+            "index_params": index_params,
+        }
+
+        response = self.post(
+            "/knowledge_base/update_index",
+            json=data,
+        )
+        return self._get_response_value(response, as_json=True)
+
     def update_kb_docs(
             self,
             knowledge_base_name: str,
@@ -690,6 +717,7 @@ class ApiRequest:
             zh_title_enhance=ZH_TITLE_ENHANCE,
             docs: Dict = {},
             not_refresh_vs_cache: bool = False,
+            incremental: bool = False,
     ):
         '''
         对应api.py/knowledge_base/update_docs接口
@@ -703,6 +731,7 @@ class ApiRequest:
             "zh_title_enhance": zh_title_enhance,
             "docs": docs,
             "not_refresh_vs_cache": not_refresh_vs_cache,
+            "incremental": incremental,
         }
 
         if isinstance(data["docs"], dict):